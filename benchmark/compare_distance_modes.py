@@ -0,0 +1,206 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, The WGS-HGT Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+#
+# Compare the runtime, precision and recall of the Distance Method's
+# distance modes (protdist on MSAs vs. alignment-free k-mer distances) on
+# genomes simulated with simulate_hgts.py.
+#
+
+import sys
+import time
+import click
+import subprocess
+from os import makedirs
+from os.path import join, exists
+
+
+def parse_simulated_hgts(log_f):
+    """ Parse the log file of simulate_hgts.py.
+
+    Parameters
+    ----------
+    log_f: file descriptor
+        file descriptor to log.txt output by simulate_hgts.py
+
+    Returns
+    -------
+    expected_hgts: set
+        labels of the HGT genes in the recipient genome
+
+    Notes
+    -----
+    Orthologous replacement HGTs ('o') are reported as (donor gene, start,
+    end, recipient gene, new label, ..) and novel gene acquisitions ('n')
+    as (donor gene, start, end, new label, ..).
+    """
+    expected_hgts = set()
+    for line in log_f:
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.strip().split('\t')
+        if fields[0] == 'o':
+            expected_hgts.add(fields[5])
+        elif fields[0] == 'n':
+            expected_hgts.add(fields[4])
+    return expected_hgts
+
+
+def parse_distance_method_output(output_hgt_f):
+    """ Parse the candidate HGT genes output by the Distance Method.
+
+    Parameters
+    ----------
+    output_hgt_f: file descriptor
+        file descriptor to output of distance_method.py
+
+    Returns
+    -------
+    observed_hgts: set
+        labels of the candidate HGT genes
+    """
+    observed_hgts = set()
+    for line in output_hgt_f:
+        if line.startswith('#') or not line.strip():
+            continue
+        observed_hgts.add(line.strip().split()[0])
+    return observed_hgts
+
+
+def compute_recall(expected_hgts, observed_hgts):
+    """ Compute precision and recall of the candidate HGT genes.
+
+    Parameters
+    ----------
+    expected_hgts: set
+        labels of the simulated HGT genes
+    observed_hgts: set
+        labels of the candidate HGT genes
+
+    Returns
+    -------
+    accuracy: tuple
+        number of true-positive (tp), false-positive (fp) and false-negative
+        (fn) HGTs, precision and recall
+    """
+    tp = len(observed_hgts & expected_hgts)
+    fp = len(observed_hgts - expected_hgts)
+    fn = len(expected_hgts - observed_hgts)
+    precision = tp / float(tp + fp) if tp + fp else 0.0
+    recall = tp / float(tp + fn) if tp + fn else 0.0
+    return tp, fp, fn, precision, recall
+
+
+def launch_distance_method(distance_method_fp,
+                           query_proteome_fp,
+                           target_proteomes_dir,
+                           working_dir,
+                           distance_mode,
+                           options):
+    """ Run the Distance Method in the given distance mode.
+
+    Parameters
+    ----------
+    distance_method_fp: string
+        file path to distance_method.py
+    query_proteome_fp: string
+        file path to query proteome
+    target_proteomes_dir: string
+        dirpath to target proteomes
+    working_dir: string
+        dirpath to working directory of the run
+    distance_mode: string
+        distance mode of the Distance Method ('protdist' or 'kmer')
+    options: list
+        additional command line options of distance_method.py
+
+    Returns
+    -------
+    output_hgt_fp: string
+        file path to candidate HGT genes
+    runtime: float
+        wall-clock time of the run (seconds)
+    """
+    if not exists(working_dir):
+        makedirs(working_dir)
+    output_hgt_fp = join(working_dir, "hgts.txt")
+    command = [sys.executable, distance_method_fp, query_proteome_fp,
+               target_proteomes_dir, working_dir, output_hgt_fp,
+               "--align-software", "diamond",
+               "--distance-mode", distance_mode] + options
+    start = time.time()
+    subprocess.check_call(command)
+    return output_hgt_fp, time.time() - start
+
+
+@click.command()
+@click.option('--distance-method-fp', required=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help='File path to distance_method.py')
+@click.option('--query-proteome-fp', required=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help='Simulated recipient proteome (output of '
+                   'simulate_hgts.py)')
+@click.option('--target-proteomes-dir', required=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help='Directory of reference proteomes (including the '
+                   'simulated recipient and donor proteomes)')
+@click.option('--simulation-log-fp', required=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help='log.txt output by simulate_hgts.py')
+@click.option('--working-dir', required=True,
+              type=click.Path(resolve_path=True, readable=True, exists=False),
+              help='Working directory path')
+@click.option('--tabular-alignments-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help='Tabular alignments of the query proteome (shared by both '
+                   'runs)')
+@click.option('--kmer-size', required=False, type=int, default=3,
+              show_default=True, help='K-mer length of the k-mer mode')
+@click.option('--threads', required=False, type=int, default=1,
+              show_default=True, help='Number of threads to use')
+def _main(distance_method_fp,
+          query_proteome_fp,
+          target_proteomes_dir,
+          simulation_log_fp,
+          working_dir,
+          tabular_alignments_fp,
+          kmer_size,
+          threads):
+    """ Compare the protdist and k-mer distance modes of the Distance Method.
+    """
+    with open(simulation_log_fp, 'r') as log_f:
+        expected_hgts = parse_simulated_hgts(log_f)
+    options = ["--threads", str(threads), "--kmer-size", str(kmer_size)]
+    if tabular_alignments_fp is not None:
+        options.extend(["--tabular-alignments-fp", tabular_alignments_fp])
+    sys.stdout.write("#expected HGTs: %s\n" % len(expected_hgts))
+    sys.stdout.write("#mode\truntime (s)\tTP\tFP\tFN\tprecision\trecall\n")
+    for distance_mode in ['protdist', 'kmer']:
+        output_hgt_fp, runtime = launch_distance_method(
+            distance_method_fp=distance_method_fp,
+            query_proteome_fp=query_proteome_fp,
+            target_proteomes_dir=target_proteomes_dir,
+            working_dir=join(working_dir, distance_mode),
+            distance_mode=distance_mode,
+            options=options)
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            observed_hgts = parse_distance_method_output(output_hgt_f)
+        tp, fp, fn, precision, recall = compute_recall(expected_hgts,
+                                                       observed_hgts)
+        sys.stdout.write("%s\t%.1f\t%d\t%d\t%d\t%.2f\t%.2f\n" % (
+            distance_mode, runtime, tp, fp, fn, precision, recall))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,56 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015, The WGS-HGT Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from io import StringIO
+
+from benchmark.compare_distance_modes import (parse_simulated_hgts,
+                                              parse_distance_method_output,
+                                              compute_recall)
+
+
+class CompareDistanceModesTests(TestCase):
+    """ Tests for compare_distance_modes.py """
+
+    def test_parse_simulated_hgts(self):
+        """ Test functionality of parse_simulated_hgts()
+        """
+        log_f = StringIO(simulation_log)
+        self.assertSetEqual(parse_simulated_hgts(log_f),
+                            {'AAA98667.1_hgt_o', 'AAA98668.1_hgt_o',
+                             'AAA98665.1_hgt_n'})
+
+    def test_parse_distance_method_output(self):
+        """ Test functionality of parse_distance_method_output()
+        """
+        output_hgt_f = StringIO(
+            "\n# Candidate HGT genes: \nAAA98667.1_hgt_o\nAAA98669.1\n\n")
+        self.assertSetEqual(parse_distance_method_output(output_hgt_f),
+                            {'AAA98667.1_hgt_o', 'AAA98669.1'})
+
+    def test_compute_recall(self):
+        """ Test functionality of compute_recall()
+        """
+        expected_hgts = {'AAA98667.1_hgt_o', 'AAA98668.1_hgt_o',
+                         'AAA98665.1_hgt_n', 'AAA98664.1_hgt_n'}
+        observed_hgts = {'AAA98667.1_hgt_o', 'AAA98669.1'}
+        self.assertEqual(compute_recall(expected_hgts, observed_hgts),
+                         (1, 1, 3, 0.5, 0.25))
+        self.assertEqual(compute_recall(expected_hgts, set()),
+                         (0, 0, 4, 0.0, 0.0))
+
+
+simulation_log = """#type\tdonor\tstart\tend\trecipient\tnew label \
+recipient\tstart\tend\tstrand
+o\tAAA98667.1\t1100\t1490\tCAA0001.1\tAAA98667.1_hgt_o\t230\t620\t1
+o\tAAA98668.1\t1601\t2201\tCAA0002.1\tAAA98668.1_hgt_o\t800\t1400\t-1
+n\tAAA98665.1\t10\t400\tAAA98665.1_hgt_n\t5000\t5390\t1
+"""
+
+if __name__ == '__main__':
+    main()
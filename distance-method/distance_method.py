@@ -21,7 +21,7 @@
 #        ii.   Go to step 3 if gene has more than threshold number of homologs
 #              (min-num-homologs), otherwise go to next gene in target genome;
 #        iii.  Compute multiple sequence alignment on homolog genes using
-#              CLUSTAL;
+#              CLUSTALW, MAFFT, MUSCLE or Clustal Omega;
 #        iv.   Compute pairwise distance matrix using PHYLIP's protdist
 #              function and Z-score normalize the set of pairwise distances
 #              for each gene family and species;
@@ -40,7 +40,9 @@
 #    Requires protdist version 3.696
 #
 
+import io
 import sys
+import gzip
 import click
 import numpy
 import operator
@@ -48,10 +50,25 @@ import threading
 import subprocess
 import traceback
 import shlex
-from os.path import join, basename, isdir, exists, getsize
-from os import mkdir
+import tempfile
+import time
+import uuid
+import json
+import tracemalloc
+import resource
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+from queue import Queue
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import (join, basename, dirname, abspath, realpath, isdir,
+                     exists, getsize, getmtime, splitext)
+from os import mkdir, remove
 
 from glob import glob
+from shutil import rmtree, copyfileobj
 
 import skbio.io
 
@@ -63,6 +80,8 @@ class Command(object):
     http://stackoverflow.com/questions/1191374/subprocess-with-timeout/4825933#4825933
     https://gist.github.com/kirpit/1306188
     """
+    # status returned by run() if the command was terminated on timeout
+    TIMEOUT = 'timeout'
     process = None
     status = None
     output, error = '', ''
@@ -72,12 +91,16 @@ class Command(object):
             command = shlex.split(command)
         self.command = command
 
-    def run(self, timeout=None, **kwargs):
-        """ Run a command then return: (status, output, error). """
+    def run(self, timeout=None, input=None, **kwargs):
+        """ Run a command then return: (status, output, error).
+
+        If input (bytes) is given, it is written to the command's stdin. If
+        the command is terminated on timeout, status is Command.TIMEOUT.
+        """
         def target(**kwargs):
             try:
                 self.process = subprocess.Popen(self.command, **kwargs)
-                self.output, self.error = self.process.communicate()
+                self.output, self.error = self.process.communicate(input)
                 self.status = self.process.returncode
             except:
                 self.error = traceback.format_exc()
@@ -87,6 +110,8 @@ class Command(object):
             kwargs['stdout'] = subprocess.PIPE
         if 'stderr' not in kwargs:
             kwargs['stderr'] = subprocess.PIPE
+        if input is not None:
+            kwargs['stdin'] = subprocess.PIPE
         # thread
         thread = threading.Thread(target=target, kwargs=kwargs)
         thread.start()
@@ -94,9 +119,356 @@ class Command(object):
         if thread.is_alive():
             self.process.terminate()
             thread.join()
+            self.status = self.TIMEOUT
         return self.status, self.output, self.error
 
 
+class MemoryReport(object):
+    """Track memory usage at the boundaries of pipeline stages.
+
+    Memory is traced using tracemalloc (numpy registers its array buffers
+    with tracemalloc, so the distance tensors are included). A snapshot is
+    taken at every checkpoint and compared to the previous one to obtain the
+    growth of each stage and the allocation sites responsible for it.
+    """
+    def __init__(self, enabled=False, top=10):
+        self.enabled = enabled
+        self.top = top
+        self.stages = []
+        self.peak = 0
+        self._current = 0
+        self._snapshot = None
+        self._peak_snapshot = None
+        self._peak_current = -1
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._current = tracemalloc.get_traced_memory()[0]
+            self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        """ Take a snapshot excluding the tracemalloc internals.
+        """
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>")))
+
+    def checkpoint(self, stage):
+        """ Record the memory growth and peak of the stage that just ended.
+
+        Parameters
+        ----------
+        stage: string
+            name of the pipeline stage that just ended
+        """
+        if not self.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self._take_snapshot()
+        growth_sites = [stat for stat in
+                        snapshot.compare_to(self._snapshot, 'lineno')
+                        if stat.size_diff > 0][:self.top]
+        self.stages.append((stage, current - self._current, peak, current,
+                            growth_sites))
+        self.peak = max(self.peak, peak)
+        if current > self._peak_current:
+            self._peak_current = current
+            self._peak_snapshot = snapshot
+        self._snapshot = snapshot
+        self._current = current
+        # measure the peak of the next stage only (Python >= 3.9)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def report(self, out_f=sys.stdout):
+        """ Write the memory report and stop tracing.
+
+        Parameters
+        ----------
+        out_f: file object, optional
+            file to write the report to
+        """
+        if not self.enabled:
+            return
+        out_f.write("\n# Memory report\n")
+        out_f.write("Peak traced memory: %s\n" % _format_size(self.peak))
+        out_f.write("Stage\tGrowth\tPeak\tCurrent\n")
+        for stage, growth, peak, current, _ in self.stages:
+            out_f.write("%s\t%s\t%s\t%s\n" % (
+                stage, _format_size(growth), _format_size(peak),
+                _format_size(current)))
+        for stage, growth, _, _, growth_sites in self.stages:
+            out_f.write("\nTop allocation sites for stage '%s':\n" % stage)
+            for stat in growth_sites:
+                out_f.write("%s\t+%s\n" % (
+                    stat.traceback[0], _format_size(stat.size_diff)))
+        if self._peak_snapshot is not None:
+            out_f.write("\nTop allocation sites at largest checkpoint:\n")
+            for stat in self._peak_snapshot.statistics('lineno')[:self.top]:
+                out_f.write("%s\t%s\n" % (
+                    stat.traceback[0], _format_size(stat.size)))
+        tracemalloc.stop()
+
+
+class SparseDistanceMatrix(object):
+    """Per-gene distance matrices stored for the species present only.
+
+    For every gene the sorted indices of the species holding a member of the
+    gene family are stored with the packed (present x present) submatrix of
+    normalized distances. Memory and the outlier statistics therefore scale
+    with the number of species pairs having a distance rather than with
+    num_species^2 per gene.
+
+    Indexing a gene returns its dense num_species x num_species matrix (nan
+    for absent species) so that the object can be used in place of the dense
+    (genes, species, species) tensor for occasional access.
+    """
+    def __init__(self, total_genes, num_species, dtype='float64'):
+        self.shape = (total_genes, num_species, num_species)
+        self.dtype = numpy.dtype(dtype)
+        self.species = [numpy.empty(0, dtype=int)] * total_genes
+        self.distances = [numpy.empty((0, 0), dtype=self.dtype)] * total_genes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, gene):
+        p = numpy.empty(shape=self.shape[1:], dtype=self.dtype)
+        p.fill(numpy.nan)
+        species = self.species[gene]
+        p[numpy.ix_(species, species)] = self.distances[gene]
+        return p
+
+    @property
+    def nbytes(self):
+        return sum(s.nbytes + d.nbytes
+                   for s, d in zip(self.species, self.distances))
+
+    def set_gene(self, gene, species, distances):
+        """ Store the packed distance matrix of a gene.
+
+        Parameters
+        ----------
+        gene: integer
+            index of the gene
+        species: numpy.ndarray
+            sorted indices of the species present in the gene family
+        distances: numpy.ndarray
+            len(species) x len(species) matrix of distances ordered as species
+        """
+        self.species[gene] = numpy.asarray(species, dtype=numpy.int32)
+        self.distances[gene] = numpy.asarray(distances, dtype=self.dtype)
+
+    def resize(self, total_genes):
+        """ Keep the first total_genes genes only.
+        """
+        del self.species[total_genes:]
+        del self.distances[total_genes:]
+        self.shape = (total_genes,) + self.shape[1:]
+
+    def toarray(self):
+        """ Return the dense (genes, species, species) tensor.
+        """
+        return numpy.array([self[gene] for gene in range(len(self))],
+                           dtype=self.dtype).reshape(self.shape)
+
+
+def _format_size(size):
+    """ Format a number of bytes using binary units.
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return "%d %s" % (size, unit)
+    return "%.1f %s" % (size, unit)
+
+
+# compressed input files (see open_input())
+COMPRESSION_EXTENSIONS = ['.gz', '.zst']
+
+
+class BackgroundReader(io.RawIOBase):
+    """Raw binary stream of a file read (and decompressed) by a thread.
+
+    Reading and decompressing the next chunks overlaps with parsing the
+    previous ones; at most max_chunks chunks are held in memory.
+    """
+    def __init__(self, binary_f, chunk_size=1 << 20, max_chunks=8):
+        self._f = binary_f
+        self._chunk_size = chunk_size
+        self._chunks = Queue(max_chunks)
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._f.read(self._chunk_size)
+                self._chunks.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._error = e
+            self._chunks.put(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk:
+            if self._eof:
+                return 0
+            self._chunk = memoryview(self._chunks.get())
+            if not self._chunk:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return 0
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            while self._thread.is_alive():
+                while not self._chunks.empty():
+                    self._chunks.get_nowait()
+                self._thread.join(0.01)
+            self._f.close()
+        super(BackgroundReader, self).close()
+
+
+def strip_compression(fp):
+    """ Return a filepath without its compression extension.
+    """
+    for ext in COMPRESSION_EXTENSIONS:
+        if fp.endswith(ext):
+            return fp[:-len(ext)]
+    return fp
+
+
+def open_input(fp, binary=False):
+    """ Open an input file, decompressed if gzip (.gz) or zstd (.zst).
+
+    Parameters
+    ----------
+    fp: string
+        filepath to the input file
+    binary: boolean, optional
+        if True, open the file in binary mode
+
+    Returns
+    -------
+    input_f: file object
+        file object of the (decompressed) input file; compressed files are
+        decompressed in a background thread (see BackgroundReader)
+
+    Notes
+    -----
+        Reading zstd compressed files requires the zstandard package.
+    """
+    if fp.endswith('.gz'):
+        binary_f = gzip.open(fp, 'rb')
+    elif fp.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "The zstandard package is required to read %s" % fp)
+        binary_f = zstandard.ZstdDecompressor().stream_reader(
+            open(fp, 'rb'), closefd=True)
+    else:
+        return open(fp, 'rb' if binary else 'r')
+    input_f = io.BufferedReader(BackgroundReader(binary_f))
+    if binary:
+        return input_f
+    return io.TextIOWrapper(input_f)
+
+
+def list_proteomes(target_proteomes_dir, extensions):
+    """ List the proteome files (possibly compressed) of a directory.
+
+    Parameters
+    ----------
+    target_proteomes_dir: string
+        dirpath to proteomes
+    extensions: list
+        list of file extensions of the proteomes
+
+    Returns
+    -------
+    files: list
+        filepaths to the proteomes
+    """
+    return [f
+            for ext in extensions
+            for compression in [''] + COMPRESSION_EXTENSIONS
+            for f in glob("%s/*%s%s" % (target_proteomes_dir, ext,
+                                        compression))]
+
+
+def launch_on_input(command, input_fp, debug=False):
+    """ Run a command reading a (decompressed) input file on its stdin.
+
+    Parameters
+    ----------
+    command: list
+        command and its arguments
+    input_fp: string
+        filepath to the input file (see open_input())
+    debug: boolean, optional
+        if True, run function in debug mode
+    """
+    proc = subprocess.Popen(command,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            close_fds=True)
+
+    def feed():
+        try:
+            with open_input(input_fp, binary=True) as input_f:
+                copyfileobj(input_f, proc.stdin)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    stderr = proc.stderr.read()
+    proc.wait()
+    feeder.join()
+    if (stderr and debug):
+        print("[DEBUG] %s\n" % stderr)
+
+
+# floating point types supported for storing the normalized distance tensor
+DISTANCE_DTYPES = ['float64', 'float32', 'float16']
+DISTANCE_MODES = ['protdist', 'kmer']
+# RAM-backed filesystem for the per-family temporary files
+DEFAULT_SCRATCH_DIR = '/dev/shm' if isdir('/dev/shm') else None
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+_AMINO_ACID_CODES = numpy.full(256, -1, dtype=numpy.int64)
+_AMINO_ACID_CODES[numpy.frombuffer(
+    AMINO_ACIDS.encode(), dtype=numpy.uint8)] = numpy.arange(len(AMINO_ACIDS))
+# longest k-mer whose integer id (see _kmer_ids()) fits in an int64
+MAX_KMER_SIZE = 14
+
+
 def hamming(str1, str2):
     """Compute the Hamming distance between two strings.
 
@@ -111,11 +483,293 @@ def hamming(str1, str2):
     return sum(map(operator.ne, str1, str2))
 
 
+def _zscore_rows_numpy(distances):
+    """ Z-score normalize each row of a matrix, skipping the diagonal.
+
+    Parameters
+    ----------
+    distances: numpy.ndarray
+        square float64 matrix of pairwise distances (nan for missing)
+
+    Returns
+    -------
+    normalized: numpy.ndarray
+        distances normalized by the mean and standard deviation of their
+        row, nan on the diagonal
+    """
+    distances = distances.copy()
+    numpy.fill_diagonal(distances, numpy.nan)
+    mean, stdev = _nan_mean_stdev(distances, axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (distances - mean) / stdev
+
+
+def _nan_mean_stdev(distances, axis):
+    """ Mean and standard deviation ignoring nan, as numpy.nanmean() and
+    numpy.nanstd() compute them but without warnings (which are not thread
+    safe), nan for slices without any value.
+    """
+    missing = numpy.isnan(distances)
+    count = (~missing).sum(axis=axis, keepdims=True)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(missing, 0, distances).sum(
+            axis=axis, keepdims=True) / count
+        deviations = numpy.where(missing, 0, distances - mean)
+        stdev = numpy.sqrt((deviations * deviations).sum(
+            axis=axis, keepdims=True) / count)
+    return mean, stdev
+
+
+def _zscore_rows_loops(distances):
+    """ Loop implementation of _zscore_rows_numpy().
+    """
+    size = distances.shape[0]
+    normalized = numpy.empty((size, size))
+    for i in range(size):
+        total = 0.0
+        count = 0
+        for j in range(size):
+            if j != i and not numpy.isnan(distances[i, j]):
+                total += distances[i, j]
+                count += 1
+        mean = total / count if count else numpy.nan
+        squares = 0.0
+        for j in range(size):
+            if j != i and not numpy.isnan(distances[i, j]):
+                squares += (distances[i, j] - mean) * (distances[i, j] - mean)
+        stdev = numpy.sqrt(squares / count) if count else numpy.nan
+        for j in range(size):
+            deviation = distances[i, j] - mean
+            if j == i:
+                normalized[i, j] = numpy.nan
+            elif stdev > 0:
+                normalized[i, j] = deviation / stdev
+            elif deviation > 0:
+                normalized[i, j] = numpy.inf
+            elif deviation < 0:
+                normalized[i, j] = -numpy.inf
+            else:
+                normalized[i, j] = numpy.nan
+    return normalized
+
+
+def _hamming_matrix_numpy(cores, species_sets):
+    """ Hamming distances between two sets of binary indicator vectors.
+
+    Parameters
+    ----------
+    cores: numpy.ndarray
+        uint8 matrix of indicator vectors (one per row)
+    species_sets: numpy.ndarray
+        uint8 matrix of indicator vectors (one per row)
+
+    Returns
+    -------
+    distances: numpy.ndarray
+        int64 matrix of the number of mismatches between each row of cores
+        (rows) and each row of species_sets (columns)
+    """
+    cores = cores.astype(numpy.float64)
+    species_sets = species_sets.astype(numpy.float64)
+    return (numpy.dot(cores, 1 - species_sets.T) + numpy.dot(
+        1 - cores, species_sets.T)).astype(numpy.int64)
+
+
+def _hamming_matrix_loops(cores, species_sets):
+    """ Loop implementation of _hamming_matrix_numpy().
+    """
+    distances = numpy.zeros((cores.shape[0], species_sets.shape[0]),
+                            dtype=numpy.int64)
+    for i in range(cores.shape[0]):
+        for j in range(species_sets.shape[0]):
+            mismatches = 0
+            for k in range(cores.shape[1]):
+                if cores[i, k] != species_sets[j, k]:
+                    mismatches += 1
+            distances[i, j] = mismatches
+    return distances
+
+
+def _count_species_outliers_numpy(distances, species, stdev_offset, counts):
+    """ Count the outlier distances of the species pairs of one species.
+
+    Parameters
+    ----------
+    distances: numpy.ndarray
+        (genes, species) normalized distances between species and the
+        other species for every gene (float64, float32 or float16)
+    species: integer
+        column of the species in distances, skipped (the species pair i_i);
+        any other value if the species is not among the columns
+    stdev_offset: float
+        see count_outliers()
+    counts: numpy.ndarray
+        (genes, species) number of outlier distances, incremented in place
+
+    Returns
+    -------
+    low_bound, up_bound: numpy.ndarray
+        bounds of the non-outlier distances of each species pair
+    """
+    distances = numpy.around(distances.astype(numpy.float64), decimals=5)
+    # skip the species pair i_i
+    if 0 <= species < distances.shape[1]:
+        distances[:, species] = numpy.nan
+    # species pairs without any distance are never outliers
+    mean, stdev = _nan_mean_stdev(distances, axis=0)
+    mean, stdev = mean[0], stdev[0]
+    low_bound = numpy.around(mean - stdev_offset*stdev, decimals=5)
+    up_bound = numpy.around(mean + stdev_offset*stdev, decimals=5)
+    with numpy.errstate(invalid='ignore'):
+        counts += (distances < low_bound) | (distances > up_bound)
+    return low_bound, up_bound
+
+
+def _count_species_outliers_loops(distances, species, stdev_offset, counts):
+    """ Loop implementation of _count_species_outliers_numpy().
+
+    Distances are rounded as numpy.around() does (rint(x * 1e5) / 1e5) and
+    summed gene by gene, in the order of the NumPy reductions.
+    """
+    num_genes, num_species = distances.shape
+    rounded = numpy.empty(num_genes)
+    low_bound = numpy.empty(num_species)
+    up_bound = numpy.empty(num_species)
+    for j in range(num_species):
+        total = 0.0
+        count = 0
+        for k in range(num_genes):
+            rounded[k] = numpy.rint(
+                numpy.float64(distances[k, j]) * 100000.0) / 100000.0
+            if j != species and not numpy.isnan(rounded[k]):
+                total += rounded[k]
+                count += 1
+        if count == 0:
+            low_bound[j] = numpy.nan
+            up_bound[j] = numpy.nan
+            continue
+        mean = total / count
+        squares = 0.0
+        for k in range(num_genes):
+            if not numpy.isnan(rounded[k]):
+                squares += (rounded[k] - mean) * (rounded[k] - mean)
+        stdev = numpy.sqrt(squares / count)
+        low_bound[j] = numpy.rint(
+            (mean - stdev_offset*stdev) * 100000.0) / 100000.0
+        up_bound[j] = numpy.rint(
+            (mean + stdev_offset*stdev) * 100000.0) / 100000.0
+        for k in range(num_genes):
+            if rounded[k] < low_bound[j] or rounded[k] > up_bound[j]:
+                counts[k, j] += 1
+    return low_bound, up_bound
+
+
+# implementations of the inner loops of the normalization, clustering and
+# outlier detection stages (see set_kernels())
+KERNEL_MODES = ['auto', 'numba', 'numpy']
+NUMPY_KERNELS = {'zscore_rows': _zscore_rows_numpy,
+                 'hamming_matrix': _hamming_matrix_numpy,
+                 'count_species_outliers': _count_species_outliers_numpy}
+LOOP_KERNELS = {'zscore_rows': _zscore_rows_loops,
+                'hamming_matrix': _hamming_matrix_loops,
+                'count_species_outliers': _count_species_outliers_loops}
+# kernels in use, selected by set_kernels()
+KERNELS = {}
+_NUMBA_KERNELS = {}
+
+
+def set_kernels(mode='auto'):
+    """ Select the implementation of the inner loops (kernels).
+
+    Parameters
+    ----------
+    mode: string, optional
+        'numba' to compile the loop kernels (LOOP_KERNELS) with Numba,
+        'numpy' for the vectorized kernels (NUMPY_KERNELS), 'auto' for Numba
+        if it is installed and NumPy otherwise
+
+    Returns
+    -------
+    mode: string
+        the implementation in use ('numba' or 'numpy')
+
+    Notes
+    -----
+        Both implementations give the same results (the Z-scores up to the
+        order of the floating point additions). The Numba kernels are
+        compiled on first call, cached on disk and release the GIL, so that
+        the threads of compute_family_distances() normalize gene families
+        concurrently.
+    """
+    if mode not in KERNEL_MODES:
+        raise ValueError("Kernel mode not supported: %s" % mode)
+    if mode != 'numpy' and not _NUMBA_KERNELS:
+        try:
+            import numba
+        except ImportError:
+            if mode == 'numba':
+                raise ValueError(
+                    "The numba package is required for the numba kernels")
+        else:
+            jit = numba.njit(cache=True, nogil=True)
+            _NUMBA_KERNELS.update(
+                (name, jit(kernel)) for name, kernel in LOOP_KERNELS.items())
+    if mode == 'numpy' or not _NUMBA_KERNELS:
+        KERNELS.update(NUMPY_KERNELS)
+        return 'numpy'
+    KERNELS.update(_NUMBA_KERNELS)
+    return 'numba'
+
+
+def _kernel(name):
+    """ Return the kernel in use (selected by set_kernels()).
+    """
+    if not KERNELS:
+        set_kernels()
+    return KERNELS[name]
+
+
+def read_fasta(fp):
+    """ Read the labels and raw sequences of a FASTA file.
+
+    Parameters
+    ----------
+    fp: string
+        filepath to the FASTA file (possibly compressed, see open_input())
+
+    Returns
+    -------
+    records: list of tuples
+        (label, sequence) of each record, in file order, where label is the
+        first word of the header and sequence the residues as bytes (line
+        breaks and other whitespace removed)
+
+    Notes
+    -----
+        Unlike skbio.io.read(), no sequence object is built, so that large
+        proteomes can be read quickly and passed between processes.
+    """
+    with open_input(fp, binary=True) as fasta_f:
+        data = fasta_f.read().lstrip()
+    if not data:
+        return []
+    if not data.startswith(b'>'):
+        raise ValueError("Not a FASTA file: %s" % fp)
+    records = []
+    for record in data[1:].split(b'\n>'):
+        header, _, seq = record.partition(b'\n')
+        fields = header.split(None, 1)
+        label = fields[0].decode() if fields else ''
+        records.append((label, b''.join(seq.split())))
+    return records
+
+
 def preprocess_data(working_dir,
                     target_proteomes_dir,
                     extensions,
+                    jobs=1,
                     verbose=False):
-    """ Map each gene to sudo name (ex. 1_1 for species 1, gene 1).
+    """ Map each gene to the index of its species.
 
     Parameters
     ----------
@@ -123,61 +777,287 @@ def preprocess_data(working_dir,
         path to working directory
     target_proteomes_dir: string
         path to directory holding proteomes for all target organisms
+        (possibly compressed, see open_input())
     extensions: list
         list of extensions for reference proteomes
+    jobs: integer, optional
+        number of processes reading the proteome files
     verbose: boolean, optional
         output details about the running processes of this function
 
     Returns
     -------
     gene_map: dictionary
-        "two-way" dictionary storing gene names as keys and their pseudo
-        names as values, and vica versa
+        dictionary storing gene names as keys and the index of their
+        species as values
     ref_db: dictionary
-        dictionary storing FASTA label as key and sequence as value for the
-        reference databases
+        dictionary storing FASTA label as key and sequence (string) as value
+        for the reference databases
     species: integer
         the number of species in the reference databases
 
     Notes
     -----
-        This will facilitate easier output comparison and the 10 character
-        name limitation in PHYLIP output. This format is limited up to 9999
-        species and 99999 genes per species.
+        Species are indexed in the order of their proteome files. The genes
+        of a gene family are relabeled with short local labels only in the
+        inputs of the alignment software and protdist (see relabel_family()),
+        so that PHYLIP's 10 character name limit does not bound the number
+        of species and genes.
+
+        With jobs > 1 the proteome files are read concurrently by a process
+        pool (see read_fasta()); their records are merged in file order, so
+        the species indices and reference database do not depend on jobs.
     """
     gene_map = {}
     ref_db = {}
     if verbose:
         sys.stdout.write("Target organism\tNumber of genes\n")
     # each file contains genes for species
-    files = [f
-             for ext in extensions
-             for f in glob("%s/*%s" % (target_proteomes_dir, ext))]
-    for species, _file in enumerate(files):
+    files = list_proteomes(target_proteomes_dir, extensions)
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as pool:
+            proteomes = list(pool.map(read_fasta, files))
+    else:
+        proteomes = map(read_fasta, files)
+    for species, (_file, records) in enumerate(zip(files, proteomes)):
         if verbose:
             sys.stdout.write("%s. %s\t" % (
                 species+1, basename(_file)))
-        for gene, seq in enumerate(skbio.io.read(_file, format='fasta')):
-            label = seq.metadata['id']
-            ref_db[label] = seq
-            sudo_label = "%s_%s" % (species, gene)
+        for gene, (label, seq) in enumerate(records):
             if label in gene_map:
                 raise ValueError("Duplicate sequence labels are "
                                  "not allowed: %s" % label)
-            gene_map[label] = sudo_label
-            gene_map[sudo_label] = label
+            ref_db[label] = seq.decode()
+            gene_map[label] = species
         if verbose:
             sys.stdout.write("%s\n" % gene)
     return gene_map, ref_db, species+1
 
 
+class ReferencePanel(object):
+    """Target proteomes parsed once and shared by several runs.
+
+    distance_method() works on copies of the gene map and reference
+    database (the query proteome may be added to them), so a panel can be
+    shared by concurrent runs.
+    """
+    def __init__(self, target_proteomes_dir, extensions, working_dir,
+                 jobs=1, verbose=False):
+        self.target_proteomes_dir = target_proteomes_dir
+        self.extensions = set(extensions)
+        self.gene_map, self.ref_db, self.num_species = preprocess_data(
+            working_dir=working_dir,
+            target_proteomes_dir=target_proteomes_dir,
+            extensions=self.extensions,
+            jobs=jobs,
+            verbose=verbose)
+
+    def copy(self, target_proteomes_dir, extensions):
+        """Return copies of the gene map and reference database.
+
+        Raises ValueError if the panel was parsed from other proteomes.
+        """
+        if (target_proteomes_dir, set(extensions)) != (
+                self.target_proteomes_dir, self.extensions):
+            raise ValueError(
+                "Reference panel of %s used for %s" % (
+                    self.target_proteomes_dir, target_proteomes_dir))
+        return dict(self.gene_map), dict(self.ref_db), self.num_species
+
+
+def add_query_proteome(query_proteome_fp,
+                       gene_map,
+                       ref_db,
+                       num_species):
+    """ Map the genes of a query proteome outside the reference proteomes.
+
+    Parameters
+    ----------
+    query_proteome_fp: string
+        filepath to query proteome
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values (updated)
+    ref_db: dictionary
+        dictionary storing FASTA label as key and sequence as value for the
+        reference databases (updated)
+    num_species: integer
+        the number of species in the reference databases
+
+    Returns
+    -------
+    num_species: integer
+        the number of species including the query proteome (unchanged if
+        the query proteome is one of the reference proteomes)
+    """
+    records = read_fasta(query_proteome_fp)
+    labels = [label for label, _ in records]
+    in_references = [label in gene_map for label in labels]
+    if all(in_references):
+        return num_species
+    if any(in_references):
+        raise ValueError("Duplicate sequence labels are not allowed: %s" % (
+            labels[in_references.index(True)]))
+    for label, seq in records:
+        ref_db[label] = seq.decode()
+        gene_map[label] = num_species
+    return num_species + 1
+
+
+def database_up_to_date(database_fps, ref_fp):
+    """ Check whether a search database was built after its proteome.
+
+    Parameters
+    ----------
+    database_fps: list
+        filepaths of which at least one is written by the database builder
+    ref_fp: string
+        filepath to the reference proteome the database is built from
+
+    Returns
+    -------
+    boolean
+        True if a database file exists and is newer than the proteome
+    """
+    return any(exists(fp) and getmtime(fp) >= getmtime(ref_fp)
+               for fp in database_fps)
+
+
+def make_diamond_database(ref_fp, db_file_fp, threads=1, debug=False):
+    """ Build the DIAMOND database of a reference proteome.
+
+    Parameters
+    ----------
+    ref_fp: string
+      filepath to reference proteome
+    db_file_fp: string
+      filepath to the database (without the .dmnd extension); a database
+      newer than the reference proteome is reused
+    threads: integer
+      number of threads to use for running DIAMOND makedb
+    debug: boolean
+      if True, run function in debug mode
+    """
+    if database_up_to_date(["%s.dmnd" % db_file_fp], ref_fp):
+        return
+    # compressed proteomes are decompressed on the standard input
+    compressed_ref = strip_compression(ref_fp) != ref_fp
+    makediamonddb_command = ["diamond",
+                             "makedb",
+                             "--in", ("/dev/stdin" if compressed_ref
+                                      else ref_fp),
+                             "-d", db_file_fp,
+                             "--threads", str(threads)]
+    if compressed_ref:
+        launch_on_input(makediamonddb_command, ref_fp, debug=debug)
+        return
+    proc = subprocess.Popen(makediamonddb_command,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            close_fds=True)
+    proc.wait()
+    stdout, stderr = proc.communicate()
+    if (stderr and debug):
+        print("[DEBUG] %s\n" % stderr)
+
+
+def make_blast_database(ref_fp, db_file_fp, debug=False):
+    """ Build the BLAST database of a reference proteome.
+
+    Parameters
+    ----------
+    ref_fp: string
+      filepath to reference proteome
+    db_file_fp: string
+      filepath to the database; a database newer than the reference
+      proteome is reused
+    debug: boolean
+      if True, run function in debug mode
+    """
+    if database_up_to_date(["%s.pin" % db_file_fp, "%s.pal" % db_file_fp],
+                           ref_fp):
+        return
+    # compressed proteomes are decompressed on the standard input
+    compressed_ref = strip_compression(ref_fp) != ref_fp
+    makeblastdb_command = ["makeblastdb",
+                           "-in", "-" if compressed_ref else ref_fp,
+                           "-title", basename(ref_fp),
+                           "-out", db_file_fp,
+                           "-dbtype", "prot"]
+    if compressed_ref:
+        launch_on_input(makeblastdb_command, ref_fp, debug=debug)
+        return
+    proc = subprocess.Popen(makeblastdb_command,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            close_fds=True)
+    proc.wait()
+    stdout, stderr = proc.communicate()
+    if (stderr and debug):
+        print("[DEBUG] %s\n" % stderr)
+
+
+def write_query_coverage(alignments_f, out_f):
+    """ Replace the query length column with BLAST's qcovs column.
+
+    Parameters
+    ----------
+    alignments_f: iterable
+        lines of tabular alignments in BLAST's '6 std' format followed by
+        the query length (qlen), the alignments of a query being contiguous
+        (as output by DIAMOND)
+    out_f: file
+        output file for the alignments in BLAST's '6 std qcovs' format
+
+    Notes
+    -----
+        BLAST's qcovs is the percentage of the query covered by all the
+        HSPs of a query and subject pair, whereas DIAMOND only reports the
+        coverage of each HSP (qcovhsp). The query intervals of the HSPs of
+        each pair are merged and qcovs is rounded to an integer, as BLAST
+        does, so that min_qcovs (see HitFilter) filters on the same
+        quantity with both search software.
+    """
+    def flush(rows):
+        intervals = {}
+        for fields in rows:
+            start, end = sorted([int(fields[6]), int(fields[7])])
+            intervals.setdefault(fields[1], []).append((start, end))
+        qcovs = {}
+        for subject, hsps in intervals.items():
+            covered = 0
+            last = 0
+            for start, end in sorted(hsps):
+                start = max(start, last + 1)
+                if end >= start:
+                    covered += end - start + 1
+                    last = end
+            qcovs[subject] = int(round(100.0 * covered / int(rows[0][12])))
+        for fields in rows:
+            out_f.write("%s\t%s\n" % ("\t".join(fields[:12]),
+                                      qcovs[fields[1]]))
+
+    rows = []
+    for line in alignments_f:
+        fields = line.split()
+        if not fields:
+            continue
+        if rows and fields[0] != rows[0][0]:
+            flush(rows)
+            rows = []
+        rows.append(fields)
+    if rows:
+        flush(rows)
+
+
 def launch_diamond(query_proteome_fp,
                    ref_fp,
                    working_dir,
                    tmp_dir,
                    e_value=10e-20,
                    threads=1,
-                   debug=False):
+                   debug=False,
+                   database_dir=None):
     """ Launch DIAMOND for a query and a reference database of proteomes.
 
     Parameters
@@ -196,57 +1076,64 @@ def launch_diamond(query_proteome_fp,
       number of threads to use for running DIAMOND BLASTP
     debug: boolean
       if True, run function in debug mode
+    database_dir: string, optional
+      dirpath to the DIAMOND databases (default working_dir); a database
+      newer than its reference proteome is reused
 
     Returns
     -------
     out_file_fp: string
-      filepath to tabular alignment file output by DIAMOND
+      filepath to tabular alignment file output by DIAMOND, in BLAST's
+      '6 std qcovs' format (see write_query_coverage())
     """
-    db_file_fp = join(working_dir, "%s" % basename(ref_fp))
-    # build DIAMOND database
-    makediamonddb_command = ["diamond",
-                             "makedb",
-                             "--in", ref_fp,
-                             "-d", db_file_fp,
-                             "--threads", str(threads)]
-    proc = subprocess.Popen(makediamonddb_command,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            close_fds=True)
-    proc.wait()
-    stdout, stderr = proc.communicate()
-    if (stderr and debug):
-        print("[DEBUG] %s\n" % stderr)
+    db_file_fp = join(working_dir if database_dir is None else database_dir,
+                      "%s" % basename(ref_fp))
+    make_diamond_database(ref_fp=ref_fp,
+                          db_file_fp=db_file_fp,
+                          threads=threads,
+                          debug=debug)
 
     # launch DIAMOND
     out_file_fp = join(
         working_dir, "%s.daa" % basename(query_proteome_fp))
+    compressed_query = strip_compression(
+        query_proteome_fp) != query_proteome_fp
     diamond_command = ["diamond",
                        "blastp",
                        "-t", tmp_dir,
                        "--db", "%s.dmnd" % db_file_fp,
-                       "--query", query_proteome_fp,
+                       "--query", ("/dev/stdin" if compressed_query
+                                   else query_proteome_fp),
                        "--evalue", str(e_value),
                        "--threads", str(threads),
                        "--daa", out_file_fp,
                        "--sensitive"]
-    proc = subprocess.Popen(diamond_command,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            close_fds=True)
-    proc.wait()
-    stdout, stderr = proc.communicate()
-    if (stderr and debug):
-        print("[DEBUG] %s\n" % stderr)
+    if compressed_query:
+        launch_on_input(diamond_command, query_proteome_fp, debug=debug)
+    else:
+        proc = subprocess.Popen(diamond_command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+        proc.wait()
+        stdout, stderr = proc.communicate()
+        if (stderr and debug):
+            print("[DEBUG] %s\n" % stderr)
 
-    # convert output to tab delimited file
+    # convert output to tab delimited file, with the query length from
+    # which qcovs is computed
     out_file_conv_fp = join(
         working_dir, "%s.m8" % basename(query_proteome_fp))
+    out_file_qlen_fp = join(
+        working_dir, "%s.qlen.m8" % basename(query_proteome_fp))
     diamond_convert_command = ["diamond",
                                "view",
                                "--daa", out_file_fp,
-                               "-f", "tab",
-                               "-o", out_file_conv_fp]
+                               "--outfmt", "6", "qseqid", "sseqid",
+                               "pident", "length", "mismatch", "gapopen",
+                               "qstart", "qend", "sstart", "send", "evalue",
+                               "bitscore", "qlen",
+                               "-o", out_file_qlen_fp]
     proc = subprocess.Popen(diamond_convert_command,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
@@ -255,6 +1142,10 @@ def launch_diamond(query_proteome_fp,
     stdout, stderr = proc.communicate()
     if (stderr and debug):
         print("[DEBUG] %s\n" % stderr)
+    with open(out_file_qlen_fp, 'r') as alignments_f:
+        with open(out_file_conv_fp, 'w') as out_f:
+            write_query_coverage(alignments_f, out_f)
+    remove(out_file_qlen_fp)
 
     return out_file_conv_fp
 
@@ -264,7 +1155,8 @@ def launch_blast(query_proteome_fp,
                  working_dir,
                  e_value=10e-20,
                  threads=1,
-                 debug=False):
+                 debug=False,
+                 database_dir=None):
     """ Launch BLASTp for a query and a reference database of proteomes.
 
     Parameters
@@ -281,6 +1173,9 @@ def launch_blast(query_proteome_fp,
       number of threads to use for running BLASTP
     debug: boolean
       if True, run function in debug mode
+    database_dir: string, optional
+      dirpath to the BLAST databases (default working_dir); a database newer
+      than its reference proteome is reused
 
     Returns
     -------
@@ -288,48 +1183,319 @@ def launch_blast(query_proteome_fp,
       filepath to tabular alignment file output by
       BLASTP
     """
-    db_file_fp = join(working_dir, "%s" % basename(ref_fp))
-    # build blast database
-    makeblastdb_command = ["makeblastdb",
-                           "-in", ref_fp,
-                           "-out", db_file_fp,
-                           "-dbtype", "prot"]
-    proc = subprocess.Popen(makeblastdb_command,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            close_fds=True)
-    proc.wait()
-    stdout, stderr = proc.communicate()
-    if (stderr and debug):
-        print("[DEBUG] %s\n" % stderr)
+    db_file_fp = join(working_dir if database_dir is None else database_dir,
+                      "%s" % basename(ref_fp))
+    make_blast_database(ref_fp=ref_fp,
+                        db_file_fp=db_file_fp,
+                        debug=debug)
 
     # launch blast
     out_file_fp = join(
         working_dir, "%s.blast" % basename(query_proteome_fp))
+    compressed_query = strip_compression(
+        query_proteome_fp) != query_proteome_fp
     blastp_command = ["blastp",
                       "-db", db_file_fp,
-                      "-query", query_proteome_fp,
+                      "-query", ("-" if compressed_query
+                                 else query_proteome_fp),
                       "-evalue", str(e_value),
                       "-num_threads", str(threads),
                       "-outfmt", "6 std qcovs",
                       "-task", "blastp",
                       "-out", out_file_fp]
-    proc = subprocess.Popen(blastp_command,
+    if compressed_query:
+        launch_on_input(blastp_command, query_proteome_fp, debug=debug)
+    else:
+        proc = subprocess.Popen(blastp_command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+        proc.wait()
+        stdout, stderr = proc.communicate()
+        if (stderr and debug):
+            print("[DEBUG] %s\n" % stderr)
+
+    return out_file_fp
+
+
+def launch_cdhit(input_fp,
+                 output_fp,
+                 identity=0.95,
+                 threads=1,
+                 debug=False):
+    """ Cluster protein sequences at a sequence identity using CD-HIT.
+
+    Parameters
+    ----------
+    input_fp: string
+      filepath to protein sequences (FASTA format)
+    output_fp: string
+      filepath to output representative sequences (the clusters are output
+      to output_fp.clstr)
+    identity: float, optional
+      sequence identity threshold (between 0.4 and 1.0)
+    threads: integer, optional
+      number of threads to use for running CD-HIT
+    debug: boolean
+      if True, run function in debug mode
+
+    Returns
+    -------
+    clusters_fp: string
+      filepath to clusters output by CD-HIT
+    """
+    # word size recommended by CD-HIT for the identity threshold
+    if identity >= 0.7:
+        word_size = 5
+    elif identity >= 0.6:
+        word_size = 4
+    elif identity >= 0.5:
+        word_size = 3
+    else:
+        word_size = 2
+    cdhit_command = ["cd-hit",
+                     "-i", input_fp,
+                     "-o", output_fp,
+                     "-c", str(identity),
+                     "-n", str(word_size),
+                     "-d", "0",
+                     "-M", "0",
+                     "-T", str(threads)]
+    proc = subprocess.Popen(cdhit_command,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
                             close_fds=True)
-    proc.wait()
     stdout, stderr = proc.communicate()
     if (stderr and debug):
         print("[DEBUG] %s\n" % stderr)
+    if proc.returncode != 0:
+        raise ValueError("CD-HIT failed on %s: %s" % (input_fp, stderr))
+    return "%s.clstr" % output_fp
 
-    return out_file_fp
+
+def parse_cdhit_clusters(clusters_f):
+    """ Parse the clusters output by CD-HIT.
+
+    Parameters
+    ----------
+    clusters_f: file descriptor
+      file descriptor to clusters output by CD-HIT (.clstr)
+
+    Returns
+    -------
+    cluster_map: dictionary
+      dictionary storing representative sequence labels as keys and the
+      labels of the cluster members (representative first) as values
+    """
+    cluster_map = {}
+    members = []
+    representative = None
+    for line in list(clusters_f) + ['>Cluster']:
+        if line.startswith('>Cluster'):
+            if representative is not None:
+                cluster_map[representative] = [representative] + [
+                    member for member in members if member != representative]
+            members = []
+            representative = None
+            continue
+        label = line.split('>', 1)[1].split('...', 1)[0]
+        members.append(label)
+        if line.rstrip().endswith('*'):
+            representative = label
+    return cluster_map
+
+
+def reduce_redundancy(target_proteomes_dir,
+                      extensions,
+                      working_dir,
+                      identity=0.95,
+                      across_species=False,
+                      threads=1,
+                      verbose=False,
+                      debug=False):
+    """ Keep representatives of near-identical reference sequences.
+
+    Parameters
+    ----------
+    target_proteomes_dir: string
+      dirpath to target proteomes
+    extensions: set
+      file extensions of the target proteomes
+    working_dir: string
+      working directory path
+    identity: float, optional
+      sequence identity threshold of the clusters
+    across_species: boolean, optional
+      if True, cluster the sequences of all species together (for panels of
+      near-identical strains), otherwise cluster each species separately
+    threads: integer, optional
+      number of threads to use for running CD-HIT
+    verbose: boolean, optional
+      if True, run in verbose mode
+    debug: boolean, optional
+      if True, run function in debug mode
+
+    Returns
+    -------
+    reduced_proteomes_dir: string
+      dirpath to the representative sequences of each target proteome
+      (same filenames as the target proteomes)
+    cluster_map: dictionary
+      dictionary storing representative sequence labels as keys and the
+      labels of the cluster members as values (see parse_blast())
+
+    Notes
+    -----
+        The cluster map is stored in cluster_map.tsv of the output directory
+        (written last) with the parameters of the clustering in
+        parameters.json, and reused by later runs with the same parameters
+        and proteomes if it is newer than all of them (see
+        database_up_to_date()). Otherwise the output directory is rebuilt.
+    """
+    reduced_proteomes_dir = join(working_dir, "reduced_proteomes_c%s%s" % (
+        identity, "_across" if across_species else ""))
+    cluster_map_fp = join(reduced_proteomes_dir, "cluster_map.tsv")
+    parameters_fp = join(reduced_proteomes_dir, "parameters.json")
+    files = list_proteomes(target_proteomes_dir, extensions)
+    parameters = {'identity': identity,
+                  'across_species': across_species,
+                  'proteomes': [abspath(_file) for _file in files]}
+    cluster_map = {}
+    if exists(cluster_map_fp) and exists(parameters_fp) and all(
+            database_up_to_date([cluster_map_fp], _file) for _file in files):
+        with open(parameters_fp, 'r') as parameters_f:
+            up_to_date = json.load(parameters_f) == parameters
+        if up_to_date:
+            with open(cluster_map_fp, 'r') as cluster_map_f:
+                for line in cluster_map_f:
+                    members = line.rstrip('\n').split('\t')
+                    cluster_map[members[0]] = members
+            return reduced_proteomes_dir, cluster_map
+    # never search the reduced proteomes of a previous panel
+    if isdir(reduced_proteomes_dir):
+        rmtree(reduced_proteomes_dir)
+    mkdir(reduced_proteomes_dir)
+    with open(parameters_fp, 'w') as parameters_f:
+        json.dump(parameters, parameters_f)
+    cdhit_dir = join(reduced_proteomes_dir, "cd-hit")
+    if not isdir(cdhit_dir):
+        mkdir(cdhit_dir)
+    if across_species:
+        input_fps = [join(cdhit_dir, "all_proteomes.faa")]
+        with open(input_fps[0], 'w') as all_f:
+            for _file in files:
+                with open_input(_file) as proteome_f:
+                    for seq in skbio.io.read(proteome_f, format='fasta',
+                                             verify=False):
+                        all_f.write(">%s\n%s\n" % (seq.metadata['id'], seq))
+    else:
+        input_fps = []
+        for _file in files:
+            # CD-HIT reads its input several times, decompress it once
+            if strip_compression(_file) != _file:
+                input_fp = join(cdhit_dir, basename(strip_compression(_file)))
+                with open_input(_file, binary=True) as proteome_f:
+                    with open(input_fp, 'wb') as input_f:
+                        copyfileobj(proteome_f, input_f)
+                _file = input_fp
+            input_fps.append(_file)
+    for input_fp in input_fps:
+        clusters_fp = launch_cdhit(
+            input_fp=input_fp,
+            output_fp=join(cdhit_dir, "%s.cdhit" % basename(input_fp)),
+            identity=identity,
+            threads=threads,
+            debug=debug)
+        with open(clusters_fp, 'r') as clusters_f:
+            cluster_map.update(parse_cdhit_clusters(clusters_f))
+    # representatives keep the species (file) they come from, species
+    # without representatives (clustering across species) are not searched
+    num_seqs = 0
+    for _file in files:
+        representatives = []
+        with open_input(_file) as proteome_f:
+            for seq in skbio.io.read(proteome_f, format='fasta', verify=False):
+                num_seqs += 1
+                if seq.metadata['id'] in cluster_map:
+                    representatives.append(seq)
+        if not representatives:
+            continue
+        with open(join(reduced_proteomes_dir,
+                       basename(strip_compression(_file))),
+                  'w') as reduced_f:
+            for seq in representatives:
+                reduced_f.write(">%s\n%s\n" % (seq.metadata['id'], seq))
+    if verbose:
+        sys.stdout.write(
+            "Redundancy reduction: %s representatives of %s sequences\n" % (
+                len(cluster_map), num_seqs))
+    with open(cluster_map_fp, 'w') as cluster_map_f:
+        for representative in cluster_map:
+            cluster_map_f.write(
+                "%s\n" % "\t".join(cluster_map[representative]))
+    return reduced_proteomes_dir, cluster_map
+
+
+class HitFilter(object):
+    """Reject weak alignments while the tabular alignments are parsed.
+
+    Columns follow BLAST's '6 std qcovs' format (qseqid, sseqid, pident,
+    length, mismatch, gapopen, qstart, qend, sstart, send, evalue, bitscore,
+    qcovs); thresholds left to None are not applied. qcovs is the
+    percentage of the query covered by all the alignments (HSPs) with the
+    subject, also for DIAMOND (see write_query_coverage()). The number of
+    alignments failing each filter is kept in rejected (an alignment failing
+    several filters is counted by each of them).
+    """
+    FIELDS = {'pident': 2, 'length': 3, 'bitscore': 11, 'qcovs': 12}
+
+    def __init__(self, min_pident=None, min_qcovs=None, min_length=None,
+                 min_bitscore=None):
+        self.thresholds = [
+            (field, threshold) for field, threshold in [
+                ('pident', min_pident), ('qcovs', min_qcovs),
+                ('length', min_length), ('bitscore', min_bitscore)]
+            if threshold is not None]
+        self.rejected = dict(
+            (field, 0) for field, _ in self.thresholds)
+        self.num_hits = 0
+        self.num_rejected = 0
+
+    def __bool__(self):
+        return bool(self.thresholds)
+
+    def accept(self, fields):
+        """Return True if the alignment (split line) passes all filters."""
+        self.num_hits += 1
+        accepted = True
+        for field, threshold in self.thresholds:
+            column = self.FIELDS[field]
+            if column >= len(fields):
+                raise ValueError(
+                    "Tabular alignments have no %s column (%s)" % (
+                        field, " ".join(fields)))
+            if float(fields[column]) < threshold:
+                self.rejected[field] += 1
+                accepted = False
+        if not accepted:
+            self.num_rejected += 1
+        return accepted
+
+    def report(self, out_f=sys.stdout):
+        """Output the number of alignments rejected by each filter."""
+        out_f.write("Hit filters: rejected %s of %s alignments\n" % (
+            self.num_rejected, self.num_hits))
+        for field, threshold in self.thresholds:
+            out_f.write("  %s < %s: %s\n" % (
+                field, threshold, self.rejected[field]))
 
 
 def parse_blast(alignments_fp,
                 hits,
                 gene_map,
-                debug=False):
+                debug=False,
+                cluster_map=None,
+                hit_filter=None):
     """ Parse BLASTp alignment file into a dictionary.
 
     Parameters
@@ -340,10 +1506,17 @@ def parse_blast(alignments_fp,
       dictionary storing query (gene) names as keys and the best aligning
       reference sequences as values (one alignment per reference sequence)
     gene_map: dictionary
-      "two-way" dictionary storing gene names as keys and their pseudo
-      names as values, and vica versa
+      dictionary storing gene names as keys and the index of their
+      species as values
     debug: boolean
       if True, run function in debug mode
+    cluster_map: dictionary, optional
+      dictionary storing representative sequence labels as keys and the
+      labels of their cluster members as values (see reduce_redundancy());
+      hits to a representative are expanded to its members
+    hit_filter: HitFilter, optional
+      filters on the alignments' identity, query coverage, length and bit
+      score; rejected alignments are skipped
 
     Notes
     -----
@@ -351,286 +1524,1640 @@ def parse_blast(alignments_fp,
         sequences to which the query mapped with E-value cutoff score.
     """
     # read blastp results
-    with open(alignments_fp, 'r') as alignments_f:
+    with open_input(alignments_fp) as alignments_f:
         for line in alignments_f:
             if debug:
                 sys.stdout.write("[DEBUG] %s" % line)
-            query, ref = line.split()[:2]
-            if query not in hits:
-                hits[query] = [ref]
-            else:
-                # check that the query mapped to a different species
-                # since we only want the best homolog per species
-                if gene_map[ref].split('_')[0] not in [
-                        gene_map[gene].split('_')[0] for gene in hits[query]]:
-                    hits[query].append(ref)
+            fields = line.split()
+            if not fields:
+                continue
+            if hit_filter and not hit_filter.accept(fields):
+                continue
+            query, ref = fields[:2]
+            refs = [ref] if cluster_map is None else cluster_map.get(
+                ref, [ref])
+            for ref in refs:
+                if query not in hits:
+                    hits[query] = [ref]
+                else:
+                    # check that the query mapped to a different species
+                    # since we only want the best homolog per species
+                    if gene_map[ref] not in [
+                            gene_map[gene] for gene in hits[query]]:
+                        hits[query].append(ref)
 
 
-def launch_msa(fasta_in_fp,
-               clustal_command_fp,
-               gene_map,
-               ref_db,
-               hits,
-               query,
-               timeout):
-    """ Create MSA for all gene othologs using Clustalw.
+def filter_homologs(hits, min_num_homologs, alignments=None):
+    """ Keep the query genes with at least min_num_homologs homologs.
 
     Parameters
     ----------
-    fasta_in_fp: string
-      filepath to FASTA file of protein sequences to use as input to
-      Clustalw
-    clustal_command_fp: string
-      filepath to Clustalw command (interactive)
-    gene_map: dictionary
-      "two-way" dictionary storing gene names as keys and their pseudo
-      names as values, and vica versa
-    ref_db: dictionary
-      dictionary storing FASTA label as key and sequence as value for the
-      reference databases
     hits: dictionary
-      dictionary storing query (gene) names as keys and the best aligning
-      reference sequences as values (one alignment per reference sequence)
-    query: string
-      query gene name
-    timeout: integer
-      number of seconds to allow Clustalw to run before terminating the
-      process
-    """
-    with open(fasta_in_fp, 'w') as in_f:
-        for ref in hits[query]:
-            in_f.write(">%s\n%s\n" % (gene_map[ref], ref_db[ref]))
-
-    with open(clustal_command_fp, 'r') as clustal_command_f:
-        clustalw_command = Command("clustalw")
-        status, output, error = clustalw_command.run(
-            timeout=timeout,
-            stdin=clustal_command_f,
-            close_fds=True)
-        if status < 0:
-            sys.stdout.write(
-                "status: %s\noutput: %s\terror: %s\t" % (
-                    status, output, error))
+        dictionary storing query (gene) names as keys and the best aligning
+        reference sequences as values
+    min_num_homologs: integer
+        the minimum number of homologs (other than the query gene itself)
+    alignments: dictionary, optional
+        precomputed MSAs of the gene families, from which the dropped query
+        genes are removed
+
+    Returns
+    -------
+    hits_min_num_homologs: dictionary
+        the gene families of the kept query genes
+    max_homologs: integer
+        the largest number of homologs of a kept query gene
+    """
+    hits_min_num_homologs = {}
+    max_homologs = 0
+    for query in hits:
+        len_hits = len(hits[query])
+        if query in hits[query]:
+            len_hits -= 1
+        if len_hits >= min_num_homologs:
+            if query in hits_min_num_homologs:
+                raise ValueError("Duplicate gene names found: %s" % query)
+            hits_min_num_homologs[query] = hits[query]
+            if len_hits > max_homologs:
+                max_homologs = len_hits
+        elif alignments is not None:
+            del alignments[query]
+    return hits_min_num_homologs, max_homologs
 
 
-def compute_distances(phylip_command_fp,
-                      warnings=False):
-    """ Compute distances between each pair of sequences in the MSA.
+def parse_fasta_alignment(lines):
+    """ Parse an MSA in FASTA format.
 
     Parameters
     ----------
-    phylip_command_fp: string
-      filepath to the PHYLIP command (interactive)
-    warnings: boolean, optional
-      print warnings output by PHYLIP
+    lines: iterable of strings
+      lines of the FASTA alignment
 
-    Notes
-    -----
-        Use PHYLIP's protdist function.
+    Returns
+    -------
+    alignment: list of tuples
+      (label, aligned sequence) for each sequence, in the order of the
+      alignment
     """
-    with open(phylip_command_fp, 'r') as phylip_command_f:
-        proc = subprocess.Popen("protdist",
-                                stdin=phylip_command_f,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                close_fds=True)
-        proc.wait()
-        stdout, stderr = proc.communicate()
-        if stderr and warnings:
-            print(stderr)
+    alignment = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('>'):
+            alignment.append([line[1:].split()[0], []])
+        elif alignment:
+            alignment[-1][1].append(line)
+        else:
+            raise ValueError("FASTA alignment does not start with a label")
+    return [(label, ''.join(seq).upper()) for label, seq in alignment]
 
 
-def normalize_distances(phylip_fp,
-                        full_distance_matrix,
-                        num_species,
-                        full_distance_matrix_offset,
-                        species_set_dict,
-                        gene_bitvector_map,
-                        debug=False):
-    """ Parse and normalize the output file of PHYLIP's protdist function.
+def parse_phylip_alignment(lines):
+    """ Parse an MSA in PHYLIP (interleaved) format.
 
     Parameters
     ----------
-    phylip_fp: string
-        filepath to distance matrix output by PHYLIP's protdist function
-    full_distance_matrix: dictionary
-        complete distance matrix for pairwise alignments between all species
-        for every gene
-    num_species: integer
-        number of species in the reference database
-    full_distance_matrix_offset: integer
-        the index offset for elements in full_distance_matrix where to write
-        the next array
-    species_set_dict: dictionary
-        dictionary containing the binary indicator vectors as keys and the
-        number of genes with identical species set represented by the binary
-        vectors as values
-    gene_bitvector_map: list
-        list containing the binary indicator vector for each query gene
-    debug: boolean
-        if True, run function in debug mode
+    lines: iterable of strings
+      lines of the PHYLIP alignment, starting with the header line holding
+      the number of sequences and the alignment length
 
-    Notes
-    -----
-        Parse PHYLIP's protdist output containing the distance matrix, Z-score
-        normalize the set of pairwise distances between the gene in a species
-        and all other species and stores the results in a separate array.
+    Returns
+    -------
+    alignment: list of tuples
+      (label, aligned sequence) for each sequence, in the order of the
+      alignment
+    """
+    lines = [line.rstrip('\n') for line in lines if line.strip()]
+    if not lines:
+        return []
+    num_seqs = int(lines[0].split()[0])
+    labels = []
+    seqs = []
+    for i, line in enumerate(lines[1:]):
+        if i < num_seqs:
+            labels.append(line[:10].strip())
+            seqs.append([''.join(line[10:].split())])
+        else:
+            seqs[i % num_seqs].append(''.join(line.split()))
+    return [(label, ''.join(seq).upper())
+            for label, seq in zip(labels, seqs)]
 
-        Each normalized distance matrix is then sorted by species name and
-        added to the complete array storing distance matrices for all genes.
-        In addition, a list of missing species (species which did not include
-        a certain gene) is also maintained and used for setting nan's in array
-        cells which represent those species.
 
-        Below is an example of a parsed distance matrix
-        for 3 genes and 3 species:
-            0         1         2        (genes)
-        0_0 nan       nan       nan
-        0_1 0.53099   0.878855  0.83673
-        0_2 0.642856  1.083039  1.083039
-        1_0 0.300297  0.300297  0.702003
-        1_1 nan       nan       nan
-        1_2 0.399722  0.379156  0.356543
-        2_0 0.53099   0.53099   0.83673
-        2_1 0.399722  0.399722  0.356543
-        2_2 nan       nan       nan
+def format_phylip_alignment(alignment):
+    """ Format an MSA in PHYLIP format (as input to protdist).
 
-        (species pairs)
+    Parameters
+    ----------
+    alignment: list of tuples
+      (label, aligned sequence) for each sequence
 
-        Example of Z-score normalized distance matrix from
-        above:
-            0            1           2          (genes)
-        0_0 nan          nan         nan
-        0_1 -1.40548346  0.83861735  0.56686611
-        0_2 -1.41421356  0.70710678  0.70710678
-        1_0 -0.70710678 -0.70710678  1.41421356
-        1_1 nan          nan         nan
-        1_2 1.20493966   0.03869341 -1.24363308
-        2_0 -0.70710678 -0.70710678  1.41421356
-        2_1 0.70710678   0.70710678 -1.41421356
-        2_2 nan          nan         nan
+    Returns
+    -------
+    msa: string
+      MSA in PHYLIP format, one line per sequence
+    """
+    msa = ["%s %s\n" % (len(alignment), len(alignment[0][1]))]
+    for label, seq in alignment:
+        if len(label) > 10:
+            raise ValueError(
+                "PHYLIP labels are limited to 10 characters: %s" % label)
+        msa.append("%-10s%s\n" % (label, seq))
+    return ''.join(msa)
 
-        (species pairs)
+
+class MSABackend(ABC):
+    """Multiple sequence alignment software reading FASTA on stdin.
+
+    Subclasses define the command line, which must read the protein
+    sequences in FASTA format on stdin and write the alignment in FASTA
+    format on stdout, and the command line of profile alignment; a backend
+    lacking either can not be instantiated.
     """
-    # assume a pairwise alignment exists for all species
-    missing_species = [str(x) for x in range(0, num_species)]
-    # scan through file and remove species that exist
-    # from missing_species list
-    if exists(phylip_fp) and getsize(phylip_fp) > 0:
-        with open(phylip_fp, 'r') as phylip_f:
-            next(phylip_f)
-            for line in phylip_f:
-                if not line.startswith(' '):
-                    species = line.split()[0].split('_')[0]
-                    missing_species.remove(species)
-    else:
-        raise ValueError('%s does not exist or is empty' % phylip_fp)
+    name = None
 
-    # scan through file again, collecting alignment
-    # distances
-    orig_order_labels = []
-    p = numpy.empty(shape=(num_species, num_species))
-    p.fill(numpy.nan)
-    idx = 0
-    with open(phylip_fp, 'r') as phylip_f:
-        alignment_list = []
-        # skip first line containing number of lines in
-        # the file
-        next(phylip_f)
-        for line in phylip_f:
-            if debug:
-                sys.stdout.write("[DEBUG] %s" % line)
-            alignment_dist = line.strip().split()
-            if line.startswith(' '):
-                alignment_list.extend(alignment_dist)
-            else:
-                # new species alignment pairs
-                if alignment_list:
-                    for i in range(0, len(missing_species)):
-                        alignment_list.append(None)
-                    a = numpy.asarray(alignment_list[1:], dtype=float)
-                    a[idx] = numpy.nan
-                    p[idx] = (a - numpy.nanmean(a)) / numpy.nanstd(a)
-                    idx += 1
-                    orig_order_labels.append(alignment_list[0])
-                alignment_list = alignment_dist
-
-    # add distance on final line
-    for i in range(0, len(missing_species)):
-        alignment_list.append(None)
-    a = numpy.asarray(alignment_list[1:], dtype=float)
-    a[idx] = numpy.nan
-    p[idx] = (a - numpy.nanmean(a)) / numpy.nanstd(a)
-    orig_order_labels.append(alignment_list[0])
-
-    # add the missing species names to the labels array
-    bitvector_gene = 'I' * num_species
-    for species in missing_species:
-        orig_order_labels.append("%s_X" % species)
-        # indicate missing gene for current species
-        l = list(bitvector_gene)
-        l[int(species)] = 'O'
-        bitvector_gene = ''.join(l)
+    @abstractmethod
+    def command(self):
+        """ Return the command line of the alignment software. """
 
-    # update species set counts
-    if bitvector_gene not in species_set_dict:
-        species_set_dict[bitvector_gene] = 1
-    else:
-        species_set_dict[bitvector_gene] += 1
+    def align(self, sequences, timeout=None, tmp_dir=None):
+        """ Align protein sequences.
 
-    gene_bitvector_map[full_distance_matrix_offset] = bitvector_gene
+        Parameters
+        ----------
+        sequences: list of tuples
+          (label, sequence) for each protein sequence
+        timeout: integer, optional
+          number of seconds to allow the software to run before terminating
+          the process
+        tmp_dir: string, optional
+          dirpath for the temporary files of software that can not stream
 
-    # sort the distance matrix based on species names (S1, S2, S3 ..)
-    # in order to be consistent across all gene families
-    x = numpy.argsort(numpy.array(orig_order_labels))
+        Returns
+        -------
+        status: integer
+          exit status of the software (Command.TIMEOUT if it was
+          terminated on timeout)
+        alignment: list of tuples
+          (label, aligned sequence) for each sequence, None if the software
+          failed
+        """
+        fasta = ''.join(">%s\n%s\n" % (label, seq)
+                        for label, seq in sequences)
+        status, output, error = Command(self.command()).run(
+            timeout=timeout, input=fasta.encode(), close_fds=True,
+            cwd=tmp_dir or tempfile.gettempdir())
+        if status != 0:
+            return status, None
+        alignment = parse_fasta_alignment(output.decode().splitlines())
+        return status, alignment if alignment else None
 
-    # re-order rows and columns by ordered species name (0,1,2 ..)
-    p2 = numpy.zeros(shape=(num_species, num_species))
-    for idx_a, arr in enumerate(p):
-        t = numpy.zeros(shape=num_species)
-        for idx_b, el in enumerate(arr):
-            t[x[idx_b]] = el
-        p2[x[idx_a]] = t
-    del p
+    @abstractmethod
+    def profile_command(self, profile_fp, fasta_in_fp):
+        """ Return the command line aligning the sequences of fasta_in_fp to
+            the alignment profile_fp (FASTA on stdout).
+        """
 
-    # add normalized distance matrix for current gene
-    # to full distance matrix
-    full_distance_matrix[full_distance_matrix_offset] = p2
+    def align_profile(self, profile_fp, fasta_in_fp, timeout=None):
+        """ Align the sequences of fasta_in_fp to the alignment profile_fp.
 
+        Returns the exit status and the parsed alignment (FASTA on stdout).
+        The software runs in the directory of fasta_in_fp, so that files it
+        may write by default do not end up in the current directory.
+        """
+        profile_fp, fasta_in_fp = abspath(profile_fp), abspath(fasta_in_fp)
+        status, output, error = Command(self.profile_command(
+            profile_fp, fasta_in_fp)).run(
+                timeout=timeout, close_fds=True, cwd=dirname(fasta_in_fp))
+        if status != 0:
+            return status, None
+        return status, parse_fasta_alignment(output.decode().splitlines())
 
-def cluster_distances(species_set_dict,
-                      species_set_size,
-                      hamming_distance):
-    """ Hamming distance clustering algorithm
+    def add(self, alignment, sequences, timeout=None, tmp_dir=None):
+        """ Add sequences to an existing alignment (profile alignment).
 
-    Parameters
-    ----------
-    species_set_dict: dictionary
-        dictionary containing the binary indicator vectors as
-        keys and the number of genes with identical species
-        set represented by the binary vectors as values
-    species_set_size: integer
-        threshold number of genes in a species set to
-        allow it to form a core cluster
-    hamming_distance: integer
-        maximum number of mismatches between two binary
-        indicator vectors (ex. IIII and I0II) for the
-        genes in a candidate vector to be merged into the
-        core cluster
+        Parameters
+        ----------
+        alignment: list of tuples
+          (label, aligned sequence) for each sequence of the alignment
+        sequences: list of tuples
+          (label, sequence) for each protein sequence to add
+        timeout: integer, optional
+          number of seconds to allow the software to run before terminating
+          the process
+        tmp_dir: string, optional
+          dirpath for the temporary input files
 
-    Returns
-    -------
-    gene_clusters_list: list of tuples
-        list of tuples containing core species sets and all belonging species
-        sets (determined by the Hamming distance clustering algorithm)
+        Returns
+        -------
+        status: integer
+          exit status of the software (Command.TIMEOUT if it was
+          terminated on timeout)
+        alignment: list of tuples
+          (label, aligned sequence) for the sequences of the alignment
+          followed by the added sequences, None if the software failed
 
-    Notes
-    -----
-        Cluster gene families by species with detectable orthologs in exactly
-        the same subset of the considered species.
+        Notes
+        -----
+            The sequences are relabeled while aligned (labels may be
+            truncated by the software); the columns of the existing alignment
+            are kept except for gap columns the software may insert.
+        """
+        labels = [label for label, _ in alignment + sequences]
+        work_dir = tempfile.mkdtemp(dir=tmp_dir)
+        profile_fp = join(work_dir, "profile.fa")
+        fasta_in_fp = join(work_dir, "input.faa")
+        try:
+            with open(profile_fp, 'w') as profile_f:
+                for i, (_, seq) in enumerate(alignment):
+                    profile_f.write(">s%s\n%s\n" % (i, seq))
+            with open(fasta_in_fp, 'w') as in_f:
+                for i, (_, seq) in enumerate(sequences, len(alignment)):
+                    in_f.write(">s%s\n%s\n" % (i, seq))
+            status, added = self.align_profile(profile_fp, fasta_in_fp,
+                                               timeout=timeout)
+        finally:
+            rmtree(work_dir, ignore_errors=True)
+        if added is None or sorted(label for label, _ in added) != sorted(
+                "s%s" % i for i in range(len(labels))):
+            return status, None
+        added = sorted(added, key=lambda record: int(record[0][1:]))
+        return status, [(label, seq)
+                        for label, (_, seq) in zip(labels, added)]
 
-        Ex. Assume we have 4 genes and 5 species with the following distance
-        matrix:
+
+class ClustalWBackend(MSABackend):
+    """Clustalw (progressive alignment, optionally with a quick guide tree).
+
+    Clustalw can not read its input from stdin (it parses the input file
+    twice), so the sequences are written to a temporary file and the
+    alignment is read back in PHYLIP format.
+    """
+    name = 'clustalw'
+
+    def __init__(self, quicktree=False):
+        self.quicktree = quicktree
+        if quicktree:
+            self.name = 'clustalw-quicktree'
+
+    def command(self, fasta_in_fp, phy_msa_fp, dnd_msa_fp):
+        command = ["clustalw",
+                   "-INFILE=%s" % fasta_in_fp,
+                   "-OUTFILE=%s" % phy_msa_fp,
+                   "-NEWTREE=%s" % dnd_msa_fp,
+                   "-OUTPUT=PHYLIP",
+                   "-TYPE=PROTEIN"]
+        if self.quicktree:
+            command.append("-QUICKTREE")
+        return command
+
+    def align(self, sequences, timeout=None, tmp_dir=None):
+        fd, fasta_in_fp = tempfile.mkstemp(suffix='.faa', dir=tmp_dir)
+        fasta_in_fp = abspath(fasta_in_fp)
+        prefix = fasta_in_fp[:-len('.faa')]
+        phy_msa_fp = prefix + '.phy'
+        dnd_msa_fp = prefix + '.dnd'
+        try:
+            with open(fd, 'w') as in_f:
+                for label, seq in sequences:
+                    in_f.write(">%s\n%s\n" % (label, seq))
+            status, output, error = Command(self.command(
+                fasta_in_fp, phy_msa_fp, dnd_msa_fp)).run(
+                    timeout=timeout, close_fds=True,
+                    cwd=dirname(fasta_in_fp))
+            if status != 0 or not exists(phy_msa_fp):
+                return status, None
+            with open(phy_msa_fp, 'r') as phy_msa_f:
+                alignment = parse_phylip_alignment(phy_msa_f)
+            return status, alignment if alignment else None
+        finally:
+            for fp in [fasta_in_fp, phy_msa_fp, dnd_msa_fp]:
+                if exists(fp):
+                    remove(fp)
+
+    def profile_command(self, profile_fp, fasta_in_fp, phy_msa_fp):
+        return ["clustalw",
+                "-PROFILE1=%s" % profile_fp,
+                "-PROFILE2=%s" % fasta_in_fp,
+                "-SEQUENCES",
+                "-OUTFILE=%s" % phy_msa_fp,
+                "-OUTPUT=PHYLIP",
+                "-TYPE=PROTEIN"]
+
+    def align_profile(self, profile_fp, fasta_in_fp, timeout=None):
+        profile_fp, fasta_in_fp = abspath(profile_fp), abspath(fasta_in_fp)
+        phy_msa_fp = fasta_in_fp + '.phy'
+        status, output, error = Command(self.profile_command(
+            profile_fp, fasta_in_fp, phy_msa_fp)).run(
+                timeout=timeout, close_fds=True, cwd=dirname(fasta_in_fp))
+        if status != 0 or not exists(phy_msa_fp):
+            return status, None
+        with open(phy_msa_fp, 'r') as phy_msa_f:
+            return status, parse_phylip_alignment(phy_msa_f)
+
+
+class MafftBackend(MSABackend):
+    """MAFFT (automatic choice of strategy by family size)."""
+    name = 'mafft'
+
+    def command(self):
+        return ["mafft", "--quiet", "--amino", "--auto", "-"]
+
+    def profile_command(self, profile_fp, fasta_in_fp):
+        return ["mafft", "--quiet", "--amino", "--add", fasta_in_fp,
+                "--keeplength", profile_fp]
+
+
+class MuscleBackend(MSABackend):
+    """MUSCLE (version 3 command line)."""
+    name = 'muscle'
+
+    def command(self):
+        return ["muscle", "-quiet"]
+
+    def profile_command(self, profile_fp, fasta_in_fp):
+        return ["muscle", "-profile", "-in1", profile_fp, "-in2",
+                fasta_in_fp, "-quiet"]
+
+
+class ClustalOmegaBackend(MSABackend):
+    """Clustal Omega."""
+    name = 'clustalo'
+
+    def command(self):
+        return ["clustalo", "-i", "-", "--seqtype=Protein", "--outfmt=fa"]
+
+    def profile_command(self, profile_fp, fasta_in_fp):
+        return ["clustalo", "--profile1", profile_fp, "-i", fasta_in_fp,
+                "--seqtype=Protein", "--outfmt=fa"]
+
+
+MSA_BACKENDS = {
+    'clustalw': ClustalWBackend(),
+    'clustalw-quicktree': ClustalWBackend(quicktree=True),
+    'mafft': MafftBackend(),
+    'muscle': MuscleBackend(),
+    'clustalo': ClustalOmegaBackend()}
+
+
+def homology_search(query_proteome_fp,
+                    target_proteomes_dir,
+                    extensions,
+                    working_dir,
+                    align_software,
+                    hits,
+                    gene_map,
+                    e_value=10e-20,
+                    threads=1,
+                    debug=False,
+                    cluster_map=None,
+                    hit_filter=None,
+                    database_dir=None):
+    """ Search a query proteome against all target proteomes.
+
+    Parameters
+    ----------
+    query_proteome_fp: string
+      filepath to query proteome
+    target_proteomes_dir: string
+      dirpath to target proteomes
+    extensions: set
+      file extensions of the target proteomes
+    working_dir: string
+      working directory path
+    align_software: string
+      software to use for sequence alignment (BLAST or DIAMOND)
+    hits: dictionary
+      dictionary storing query (gene) names as keys and the best aligning
+      reference sequences as values (updated, see parse_blast())
+    gene_map: dictionary
+      dictionary storing gene names as keys and the index of their
+      species as values
+    e_value: float, optional
+      the E-value cutoff to identify orthologous genes
+    threads: integer, optional
+      number of threads to use for sequence alignment
+    debug: boolean, optional
+      if True, run function in debug mode
+    cluster_map: dictionary, optional
+      clusters of the target proteomes' sequences (see parse_blast())
+    hit_filter: HitFilter, optional
+      filters on the alignments (see parse_blast())
+    database_dir: string, optional
+      dirpath to the search databases (default working_dir)
+    """
+    files = list_proteomes(target_proteomes_dir, extensions)
+    for _file in files:
+        # launch BLASTp
+        if align_software == "blast":
+            alignments_fp = launch_blast(
+                query_proteome_fp=query_proteome_fp,
+                ref_fp=_file,
+                working_dir=working_dir,
+                e_value=e_value,
+                threads=threads,
+                debug=debug,
+                database_dir=database_dir)
+        elif align_software == "diamond":
+            alignments_fp = launch_diamond(
+                query_proteome_fp=query_proteome_fp,
+                ref_fp=_file,
+                working_dir=working_dir,
+                tmp_dir=working_dir,
+                e_value=e_value,
+                threads=threads,
+                debug=debug,
+                database_dir=database_dir)
+        else:
+            raise ValueError(
+                "Software not supported: %s" % align_software)
+
+        # generate a dictionary of orthologous genes
+        parse_blast(alignments_fp=alignments_fp,
+                    hits=hits,
+                    gene_map=gene_map,
+                    debug=debug,
+                    cluster_map=cluster_map,
+                    hit_filter=hit_filter)
+
+
+def read_msa(msa_fp):
+    """ Read an MSA in FASTA or PHYLIP format.
+
+    Parameters
+    ----------
+    msa_fp: string
+      filepath to MSA (the format is detected from the first line)
+
+    Returns
+    -------
+    alignment: list of tuples
+      (label, aligned sequence) for each sequence
+    """
+    with open(msa_fp, 'r') as msa_f:
+        lines = msa_f.readlines()
+    for line in lines:
+        if line.strip():
+            if line.startswith('>'):
+                return parse_fasta_alignment(lines)
+            break
+    return parse_phylip_alignment(lines)
+
+
+def parse_precomputed_msas(msa_dir,
+                           msa_map_fp,
+                           hits,
+                           alignments,
+                           gene_map,
+                           debug=False):
+    """ Parse precomputed MSAs of gene families into a dictionary.
+
+    Parameters
+    ----------
+    msa_dir: string
+      dirpath to MSAs of gene families (FASTA or PHYLIP format)
+    msa_map_fp: string
+      filepath to tab-separated file mapping each query gene to the
+      filename of its gene family MSA in msa_dir
+    hits: dictionary
+      dictionary storing query (gene) names as keys and the reference
+      sequences in their gene family as values (one per species)
+    alignments: dictionary
+      dictionary storing query (gene) names as keys and the MSA of their
+      gene family as values, as (gene name, aligned sequence) tuples
+    gene_map: dictionary
+      dictionary storing gene names as keys and the index of their
+      species as values
+    debug: boolean
+      if True, run function in debug mode
+
+    Notes
+    -----
+        MSA labels must be gene names of the target proteomes; labels of the
+        form 'GENE/SUFFIX' (ALF output) are matched on 'GENE'. Sequences that
+        are not in the target proteomes are ignored and only the first
+        sequence of each species is kept, as for BLAST hits.
+    """
+    family_msas = {}
+    with open(msa_map_fp, 'r') as msa_map_f:
+        for line in msa_map_f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            query, family = line.split()[:2]
+            if query in hits:
+                raise ValueError("Duplicate gene names found: %s" % query)
+            if family not in family_msas:
+                msa_fp = join(msa_dir, family)
+                if not exists(msa_fp):
+                    raise ValueError(
+                        "MSA of gene family %s does not exist" % msa_fp)
+                family_msas[family] = read_msa(msa_fp)
+            genes = []
+            species = set()
+            alignment = []
+            for label, seq in family_msas[family]:
+                gene = label if label in gene_map else label.split('/')[0]
+                if gene not in gene_map:
+                    if debug:
+                        sys.stdout.write(
+                            "[DEBUG] %s: %s not in target proteomes\n" % (
+                                family, label))
+                    continue
+                if gene_map[gene] in species:
+                    continue
+                species.add(gene_map[gene])
+                genes.append(gene)
+                alignment.append((gene, seq))
+            hits[query] = genes
+            alignments[query] = alignment
+
+
+def relabel_family(sequences):
+    """ Relabel the members of a gene family with short local labels.
+
+    Parameters
+    ----------
+    sequences: list of tuples
+      (gene name, sequence) for each member of the gene family
+
+    Returns
+    -------
+    sequences: list of tuples
+      (local label, sequence) for each member, the local label being the
+      member's index in the family ('0', '1', ..)
+    genes: list
+      gene names of the members, indexed by their local labels
+
+    Notes
+    -----
+        PHYLIP truncates names to 10 characters and the alignment software
+        may rewrite long labels, so only local labels are written to their
+        inputs; labels of the outputs are mapped back to gene names with
+        restore_labels().
+    """
+    return ([("%s" % i, seq) for i, (_, seq) in enumerate(sequences)],
+            [gene for gene, _ in sequences])
+
+
+def restore_labels(labels, genes):
+    """ Map the local labels of relabel_family() back to gene names.
+    """
+    return [genes[int(label)] for label in labels]
+
+
+def launch_msa(backend,
+               ref_db,
+               hits,
+               query,
+               timeout,
+               tmp_dir=None):
+    """ Create MSA for all gene othologs.
+
+    Parameters
+    ----------
+    backend: MSABackend
+      multiple sequence alignment software (see MSA_BACKENDS)
+    ref_db: dictionary
+      dictionary storing FASTA label as key and sequence as value for the
+      reference databases
+    hits: dictionary
+      dictionary storing query (gene) names as keys and the best aligning
+      reference sequences as values (one alignment per reference sequence)
+    query: string
+      query gene name
+    timeout: integer
+      number of seconds to allow the alignment software to run before
+      terminating the process
+    tmp_dir: string, optional
+      dirpath for temporary files (Clustalw only)
+
+    Returns
+    -------
+    status: integer
+      exit status of the alignment software (Command.TIMEOUT if it was
+      terminated on timeout)
+    alignment: list of tuples
+      (gene name, aligned sequence) for each homolog, None if the
+      alignment failed
+    """
+    sequences, genes = relabel_family(
+        [(ref, str(ref_db[ref])) for ref in hits[query]])
+    status, alignment = backend.align(sequences, timeout=timeout,
+                                      tmp_dir=tmp_dir)
+    if alignment is None:
+        return status, None
+    return status, list(zip(
+        restore_labels([label for label, _ in alignment], genes),
+        [seq for _, seq in alignment]))
+
+
+def build_reference_families(families_dir,
+                             hits,
+                             gene_map,
+                             ref_db,
+                             min_num_homologs=3,
+                             msa_backend=MSA_BACKENDS['clustalw'],
+                             timeout=120,
+                             warnings=False,
+                             verbose=False):
+    """ Cluster the reference panel into gene families and store their MSAs.
+
+    Parameters
+    ----------
+    families_dir: string
+      dirpath to output reference families (created if it does not exist)
+    hits: dictionary
+      dictionary storing reference gene names as keys and their best
+      aligning reference sequences as values (all-vs-all search of the
+      reference panel, see parse_blast())
+    gene_map: dictionary
+      dictionary storing gene names as keys and the index of their
+      species as values
+    ref_db: dictionary
+      dictionary storing FASTA label as key and sequence as value for the
+      reference databases
+    min_num_homologs: integer, optional
+      the mininum number of homologs of a gene family
+    msa_backend: MSABackend, optional
+      multiple sequence alignment software
+    timeout: integer, optional
+      number of seconds to allow the alignment software to run per family
+    warnings: boolean, optional
+      print warnings output by PHYLIP
+    verbose: boolean, optional
+      if True, run in verbose mode
+
+    Returns
+    -------
+    num_families: integer
+      number of reference families stored
+
+    Notes
+    -----
+        Genes are taken by decreasing number of homologs; each gene not yet
+        assigned seeds a family with its unassigned homologs (one per
+        species). For each family the MSA (FASTA, <family>.fa) and the
+        protdist distances (distances.npz, see protdist_distances()) are
+        stored, and families.tsv lists
+        the members of each family. families.tsv is written last and marks
+        a complete build.
+    """
+    if not isdir(families_dir):
+        mkdir(families_dir)
+    assigned = set()
+    families = []
+    for gene in sorted(hits, key=lambda gene: (-len(hits[gene]), gene)):
+        if gene in assigned:
+            continue
+        members = [gene] + [ref for ref in hits[gene]
+                            if ref not in assigned and
+                            gene_map[ref] != gene_map[gene]]
+        if len(members) - 1 < min_num_homologs:
+            continue
+        assigned.update(members)
+        families.append(members)
+    family_members = []
+    family_alignments = []
+    for members in families:
+        family = "family_%s" % len(family_members)
+        sequences, genes = relabel_family(
+            [(gene, str(ref_db[gene])) for gene in members])
+        status, alignment = msa_backend.align(sequences, timeout=timeout)
+        if alignment is None:
+            sys.stdout.write(
+                "Skipping reference family of %s: no MSA could be computed "
+                "(status %s)\n" % (members[0], status))
+            continue
+        alignment = list(zip(
+            restore_labels([label for label, _ in alignment], genes),
+            [seq for _, seq in alignment]))
+        with open(join(families_dir, "%s.fa" % family), 'w') as msa_f:
+            for label, seq in alignment:
+                msa_f.write(">%s\n%s\n" % (label, seq))
+        family_members.append(
+            (family, [label for label, _ in alignment]))
+        family_alignments.append(alignment)
+        if verbose:
+            sys.stdout.write("Built reference %s (%s genes)\n" % (
+                family, len(alignment)))
+    family_distances = {}
+    if family_alignments:
+        family_distances = dict(zip(
+            [family for family, _ in family_members],
+            protdist_distances(family_alignments, tmp_dir=families_dir,
+                               warnings=warnings)))
+    numpy.savez(join(families_dir, "distances.npz"), **family_distances)
+    with open(join(families_dir, "families.tsv"), 'w') as families_f:
+        for family, members in family_members:
+            families_f.write("%s\t%s\n" % (family, "\t".join(members)))
+    return len(family_members)
+
+
+class ReferenceFamilies(object):
+    """Reference gene families built by build_reference_families().
+
+    Query genes are assigned to the family holding most of their homologs.
+    A query gene that is a member of its family reuses the stored distances;
+    other query genes are added to the family MSA by profile alignment and
+    only their row of distances is computed (see protdist_row()). The MSAs
+    of the families are read once and cached.
+    """
+    def __init__(self, families_dir):
+        self.families_dir = families_dir
+        self.alignments = {}
+        self.members = {}
+        self.family = {}
+        with open(join(families_dir, "families.tsv"), 'r') as families_f:
+            for line in families_f:
+                family, members = line.rstrip('\n').split('\t', 1)
+                self.members[family] = members.split('\t')
+                for gene in self.members[family]:
+                    self.family[gene] = family
+        self.distances = numpy.load(join(families_dir, "distances.npz"))
+
+    def __len__(self):
+        return len(self.members)
+
+    def find_family(self, genes):
+        """ Return the family holding most of the genes (None if none). """
+        counts = {}
+        for gene in genes:
+            if gene in self.family:
+                counts[self.family[gene]] = counts.get(
+                    self.family[gene], 0) + 1
+        if not counts:
+            return None
+        return min(counts, key=lambda family: (-counts[family], family))
+
+    def alignment(self, family):
+        """ Return the MSA of a family (read from <family>.fa once). """
+        if family not in self.alignments:
+            self.alignments[family] = read_msa(
+                join(self.families_dir, "%s.fa" % family))
+        return self.alignments[family]
+
+    def query_distances(self,
+                        query,
+                        hits,
+                        gene_map,
+                        ref_db,
+                        msa_backend,
+                        timeout=None,
+                        tmp_dir=None,
+                        warnings=False):
+        """ Compute the distances between a query gene and its family.
+
+        Parameters
+        ----------
+        query: string
+          query gene name
+        hits: list
+          reference sequences to which the query gene aligned
+        gene_map: dictionary
+          dictionary storing gene names as keys and the index of their
+          species as values
+        ref_db: dictionary
+          dictionary storing FASTA label as key and sequence as value for
+          the reference databases (and query proteome)
+        msa_backend: MSABackend
+          alignment software used for profile alignment
+        timeout: integer, optional
+          number of seconds to allow the alignment software to run
+        tmp_dir: string, optional
+          dirpath for temporary files
+        warnings: boolean, optional
+          print warnings output by PHYLIP
+
+        Returns
+        -------
+        genes: list
+          gene names of the family members and the query gene, in the
+          order of the distance matrix (None if no family was found or the
+          profile alignment failed)
+        distances: numpy.ndarray
+          matrix of pairwise distances
+        """
+        family = self.find_family(hits)
+        if family is None:
+            return None, None
+        members = self.members[family]
+        distances = self.distances[family]
+        if self.family.get(query) == family:
+            return list(members), distances
+        # one gene per species: the query replaces its species' member
+        keep = [i for i, gene in enumerate(members)
+                if gene_map[gene] != gene_map[query]]
+        alignment = self.alignment(family)
+        genes, query_distances = profile_distances(
+            [alignment[i] for i in keep], distances[numpy.ix_(keep, keep)],
+            query, ref_db[query], msa_backend, timeout=timeout,
+            tmp_dir=tmp_dir, warnings=warnings)
+        if genes is None:
+            return None, None
+        return [members[i] for i in keep] + [query], query_distances
+
+
+def compute_distances(phylip_command_fp,
+                      warnings=False):
+    """ Compute distances between each pair of sequences in the MSA.
+
+    Parameters
+    ----------
+    phylip_command_fp: string
+      filepath to the PHYLIP command (interactive)
+    warnings: boolean, optional
+      print warnings output by PHYLIP
+
+    Notes
+    -----
+        Use PHYLIP's protdist function, run in the directory of the command
+        file (protdist writes its default 'outfile' to the current
+        directory).
+    """
+    with open(phylip_command_fp, 'r') as phylip_command_f:
+        proc = subprocess.Popen("protdist",
+                                stdin=phylip_command_f,
+                                cwd=dirname(abspath(phylip_command_fp)),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+        proc.wait()
+        stdout, stderr = proc.communicate()
+        if stderr and warnings:
+            print(stderr)
+
+
+def write_protdist_command(phylip_command_fp,
+                           phy_msa_fp,
+                           phylip_fp,
+                           datasets=1):
+    """ Write the interactive command for PHYLIP's protdist function.
+
+    Parameters
+    ----------
+    phylip_command_fp: string
+      filepath to the PHYLIP command (interactive)
+    phy_msa_fp: string
+      filepath to the input MSA(s) in PHYLIP format
+    phylip_fp: string
+      filepath to the output distance matrix (matrices)
+    datasets: integer, optional
+      number of MSAs concatenated in phy_msa_fp (PHYLIP's multiple data sets
+      option 'M' is used if greater than 1)
+    """
+    with open(phylip_command_fp, 'w') as phylip_command_f:
+        phylip_command_f.write('%s\nF\n%s\nR\n' % (
+            abspath(phy_msa_fp), abspath(phylip_fp)))
+        if datasets > 1:
+            phylip_command_f.write('M\nD\n%s\n' % datasets)
+        phylip_command_f.write('Y\n')
+
+
+def split_protdist_datasets(phylip_f):
+    """ Split the output of protdist run on multiple data sets.
+
+    Parameters
+    ----------
+    phylip_f: iterable
+        lines of protdist's outfile
+
+    Returns
+    -------
+    datasets: list of lists
+        lines of each distance matrix (starting with the line holding the
+        number of sequences), in the order of the input data sets
+
+    Notes
+    -----
+        A new distance matrix starts at each line holding a single integer;
+        wrapped rows hold distances (floats) and so never match.
+    """
+    datasets = []
+    for line in phylip_f:
+        fields = line.split()
+        if not fields or line.startswith("Data set"):
+            continue
+        if len(fields) == 1 and fields[0].isdigit():
+            datasets.append([])
+        elif not datasets:
+            raise ValueError(
+                "Distance matrix does not start with the number of "
+                "sequences: %s" % line)
+        datasets[-1].append(line)
+    return datasets
+
+
+def compute_distances_batch(msas,
+                            batch_msa_fp,
+                            phylip_command_fp,
+                            phylip_fp,
+                            warnings=False,
+                            debug=False):
+    """ Compute distances for several MSAs with a single protdist run.
+
+    Parameters
+    ----------
+    msas: list
+        MSAs in PHYLIP format (strings)
+    batch_msa_fp: string
+        filepath to write the concatenated MSAs to
+    phylip_command_fp: string
+        filepath to write the PHYLIP command (interactive) to
+    phylip_fp: string
+        filepath to the distance matrices output by protdist
+    warnings: boolean, optional
+        print warnings output by PHYLIP
+    debug: boolean, optional
+        if True, run function in debug mode
+
+    Returns
+    -------
+    distance_matrices: list of tuples
+        (labels, distances) parsed by parse_protdist() for each MSA, in the
+        order of msas
+
+    Notes
+    -----
+        PHYLIP's multiple data sets option processes all MSAs in one
+        process, which saves the process startup and command file I/O that
+        dominate the runtime of protdist on small gene families.
+    """
+    with open(batch_msa_fp, 'w') as batch_msa_f:
+        for msa in msas:
+            batch_msa_f.write(msa)
+    write_protdist_command(phylip_command_fp=phylip_command_fp,
+                           phy_msa_fp=batch_msa_fp,
+                           phylip_fp=phylip_fp,
+                           datasets=len(msas))
+    # protdist replaces phylip_fp, never parse a previous batch's results
+    open(phylip_fp, 'w').close()
+    compute_distances(phylip_command_fp=phylip_command_fp,
+                      warnings=warnings)
+    with open(phylip_fp, 'r') as phylip_f:
+        datasets = split_protdist_datasets(phylip_f)
+    if len(datasets) != len(msas):
+        raise ValueError(
+            "protdist output %s distance matrices for %s MSAs in %s" % (
+                len(datasets), len(msas), phylip_fp))
+    return [parse_protdist(dataset, debug=debug) for dataset in datasets]
+
+
+def protdist_distances(alignments, tmp_dir=None, warnings=False):
+    """ Compute protdist distances of MSAs in a private temporary directory.
+
+    Parameters
+    ----------
+    alignments: list
+        MSAs, each a list of (label, aligned sequence) tuples
+    tmp_dir: string, optional
+        dirpath in which the temporary directory is created
+    warnings: boolean, optional
+        print warnings output by PHYLIP
+
+    Returns
+    -------
+    distance_matrices: list of numpy.ndarray
+        square matrix of pairwise distances of each MSA, rows and columns
+        in the order of its sequences
+
+    Notes
+    -----
+        Sequences are relabeled (see relabel_family()) and all MSAs are
+        passed to a single protdist run (see compute_distances_batch()), so
+        the distances are those of the gene families aligned by
+        align_families().
+    """
+    work_dir = tempfile.mkdtemp(prefix="protdist_", dir=tmp_dir)
+    try:
+        distance_matrices = compute_distances_batch(
+            msas=[format_phylip_alignment(relabel_family(alignment)[0])
+                  for alignment in alignments],
+            batch_msa_fp=join(work_dir, "msa.phy"),
+            phylip_command_fp=join(work_dir, "protdist_command.txt"),
+            phylip_fp=join(work_dir, "msa.dis"),
+            warnings=warnings)
+    finally:
+        rmtree(work_dir, ignore_errors=True)
+    results = []
+    for labels, distances in distance_matrices:
+        order = numpy.argsort([int(label) for label in labels])
+        results.append(distances[numpy.ix_(order, order)])
+    return results
+
+
+def pair_alignments(alignment, index):
+    """ Project an MSA on the pairs of one sequence with each other one.
+
+    Parameters
+    ----------
+    alignment: list of tuples
+        (label, aligned sequence) of each sequence of the MSA
+    index: integer
+        index of the sequence to pair with the others
+
+    Returns
+    -------
+    pairs: list
+        one MSA of two sequences (sequence index first) for each other
+        sequence of the MSA, in order
+    """
+    return [[alignment[index], other]
+            for i, other in enumerate(alignment) if i != index]
+
+
+def protdist_row(alignment, index, tmp_dir=None, warnings=False):
+    """ Compute the protdist distances of one sequence of an MSA.
+
+    Parameters
+    ----------
+    alignment: list of tuples
+        (label, aligned sequence) of each sequence of the MSA
+    index: integer
+        index of the sequence whose distances are computed
+    tmp_dir, warnings:
+        see protdist_distances()
+
+    Returns
+    -------
+    row: numpy.ndarray
+        distances between the sequence and each sequence of the MSA (0 for
+        itself), the row index of protdist_distances([alignment])[0]
+
+    Notes
+    -----
+        protdist computes each distance from the two sequences only (sites
+        with a gap in either sequence are ignored), so the distances of the
+        pairs of sequences (see pair_alignments()) are those of the full
+        MSA. All pairs are passed to a single protdist run and the work is
+        linear in the number of sequences.
+    """
+    row = numpy.zeros(len(alignment))
+    others = [i for i in range(len(alignment)) if i != index]
+    if others:
+        row[others] = [distances[0, 1] for distances in protdist_distances(
+            pair_alignments(alignment, index), tmp_dir=tmp_dir,
+            warnings=warnings)]
+    return row
+
+
+def profile_distances(alignment,
+                      distances,
+                      query,
+                      seq,
+                      msa_backend,
+                      timeout=None,
+                      tmp_dir=None,
+                      warnings=False):
+    """ Add a query gene to an MSA and compute only its distances.
+
+    Parameters
+    ----------
+    alignment: list of tuples
+        (gene name, aligned sequence) of each gene of the MSA
+    distances: numpy.ndarray
+        square matrix of the pairwise distances of the genes of the MSA
+    query: string
+        query gene name
+    seq: string
+        sequence of the query gene
+    msa_backend: MSABackend
+        alignment software used for profile alignment (MSABackend.add())
+    timeout, tmp_dir, warnings:
+        see protdist_row()
+
+    Returns
+    -------
+    genes: list
+        gene names of the MSA followed by the query gene (None if the
+        profile alignment failed)
+    distances: numpy.ndarray
+        the distances of the MSA, extended with the query gene's row and
+        column
+    """
+    status, alignment = msa_backend.add(
+        alignment, [(query, str(seq))], timeout=timeout, tmp_dir=tmp_dir)
+    if alignment is None:
+        return None, None
+    row = protdist_row(alignment, len(alignment) - 1, tmp_dir=tmp_dir,
+                       warnings=warnings)
+    query_distances = numpy.empty((len(alignment), len(alignment)))
+    query_distances[:-1, :-1] = distances
+    query_distances[-1] = row
+    query_distances[:, -1] = row
+    return [label for label, _ in alignment], query_distances
+
+
+def check_kmer_size(k, name='k-mer size'):
+    """ Raise ValueError unless 1 <= k <= MAX_KMER_SIZE.
+    """
+    if not 1 <= k <= MAX_KMER_SIZE:
+        raise ValueError("%s must be between 1 and %s: %s" % (
+            name, MAX_KMER_SIZE, k))
+
+
+def _kmer_ids(seq, k):
+    """ Return the sorted distinct k-mers of a protein sequence as integers.
+
+    K-mers containing residues other than the 20 standard amino acids are
+    ignored. The ids are int64, so k is at most MAX_KMER_SIZE.
+    """
+    check_kmer_size(k)
+    residues = _AMINO_ACID_CODES[numpy.frombuffer(
+        str(seq).upper().encode(), dtype=numpy.uint8)]
+    num_kmers = max(len(residues) - k + 1, 0)
+    ids = numpy.zeros(num_kmers, dtype=numpy.int64)
+    valid = numpy.ones(num_kmers, dtype=bool)
+    for j in range(k):
+        window = residues[j:j + num_kmers]
+        ids = ids * len(AMINO_ACIDS) + window
+        valid &= window >= 0
+    return numpy.unique(ids[valid])
+
+
+def kmer_profiles(sequences, k=3):
+    """ Compute the k-mer presence profiles of protein sequences.
+
+    Parameters
+    ----------
+    sequences: list of strings
+      protein sequences
+    k: integer, optional
+      k-mer length
+
+    Returns
+    -------
+    profiles: numpy.ndarray
+      boolean array of shape (len(sequences), m) indicating the presence of
+      the m distinct k-mers found in the sequences in each sequence
+
+    Notes
+    -----
+        K-mers containing residues other than the 20 standard amino acids
+        (ex. X, gaps) are ignored.
+    """
+    kmer_ids = [_kmer_ids(seq, k) for seq in sequences]
+    kmers, columns = numpy.unique(numpy.concatenate(kmer_ids),
+                                  return_inverse=True)
+    rows = numpy.repeat(numpy.arange(len(kmer_ids)),
+                        [len(ids) for ids in kmer_ids])
+    profiles = numpy.zeros((len(kmer_ids), len(kmers)), dtype=bool)
+    profiles[rows, columns] = True
+    return profiles
+
+
+def kmer_distances(sequences, k=3):
+    """ Compute alignment-free distances between protein sequences.
+
+    Parameters
+    ----------
+    sequences: list of tuples
+      (label, sequence) for each protein sequence
+    k: integer, optional
+      k-mer length
+
+    Returns
+    -------
+    labels: list
+      sequence labels, in the order of the distance matrix
+    distances: numpy.ndarray
+      symmetric matrix of pairwise distances (zero diagonal)
+
+    Notes
+    -----
+        The distance between two sequences is estimated from the Jaccard
+        index J of their k-mer sets as -ln(2J / (1 + J)) / k, the mutation
+        rate per residue under a Poisson model (Mash distance), which is
+        comparable to protdist's distances. At least one shared k-mer is
+        assumed so that distances remain finite.
+    """
+    labels = [label for label, _ in sequences]
+    profiles = kmer_profiles([seq for _, seq in sequences], k=k).astype(
+        numpy.float64)
+    num_kmers = profiles.sum(axis=1)
+    shared = numpy.dot(profiles, profiles.T)
+    union = num_kmers[:, None] + num_kmers[None, :] - shared
+    jaccard = numpy.maximum(shared, 1) / numpy.maximum(union, 1)
+    distances = -numpy.log(2*jaccard/(1 + jaccard))/k
+    numpy.fill_diagonal(distances, 0.0)
+    return labels, distances
+
+
+class KmerIndex(object):
+    """Persistent k-mer index of the reference proteomes.
+
+    The index maps each k-mer to the reference genes containing it (in
+    compressed sparse row form) and is stored as .npy files which are
+    memory-mapped when loaded, so that it is shared between runs and
+    processes through the page cache instead of being read in memory.
+    """
+    files = ['meta', 'kmers', 'offsets', 'genes', 'gene_species']
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        for name in self.files:
+            setattr(self, name, numpy.load(
+                join(index_dir, "%s.npy" % name), mmap_mode='r'))
+        self.k, self.num_genes, self.num_species = [
+            int(x) for x in self.meta]
+
+    @classmethod
+    def exists(cls, index_dir):
+        return all(exists(join(index_dir, "%s.npy" % name))
+                   for name in cls.files)
+
+    def up_to_date(self, ref_fps):
+        """ Check whether the index was built after the reference proteomes.
+
+        The metadata file is written last (see build()), so its
+        modification time is compared to those of the proteomes, as for the
+        search databases (see database_up_to_date()).
+        """
+        return all(database_up_to_date(
+            [join(self.index_dir, "meta.npy")], ref_fp) for ref_fp in ref_fps)
+
+    @classmethod
+    def build(cls, index_dir, gene_map, ref_db, num_species, k=5):
+        """ Build the k-mer index of the reference proteomes.
+
+        Parameters
+        ----------
+        index_dir: string
+          dirpath to output index files (created if it does not exist)
+        gene_map: dictionary
+          dictionary storing gene names as keys and the index of their
+          species as values
+        ref_db: dictionary
+          dictionary storing FASTA label as key and sequence as value for
+          the reference databases
+        num_species: integer
+          the number of species in the reference databases
+        k: integer, optional
+          k-mer length
+
+        Returns
+        -------
+        index: KmerIndex
+          memory-mapped index
+        """
+        check_kmer_size(k)
+        if not isdir(index_dir):
+            mkdir(index_dir)
+        kmer_ids = []
+        gene_species = numpy.empty(len(ref_db), dtype=numpy.int32)
+        for gene, label in enumerate(ref_db):
+            kmer_ids.append(_kmer_ids(ref_db[label], k))
+            gene_species[gene] = gene_map[label]
+        genes = numpy.repeat(
+            numpy.arange(len(kmer_ids), dtype=numpy.int32),
+            [len(ids) for ids in kmer_ids])
+        kmer_ids = numpy.concatenate(kmer_ids)
+        order = numpy.argsort(kmer_ids, kind='mergesort')
+        kmer_ids = kmer_ids[order]
+        kmers, offsets = numpy.unique(kmer_ids, return_index=True)
+        arrays = {'meta': numpy.array([k, len(ref_db), num_species]),
+                  'kmers': kmers,
+                  'offsets': numpy.append(offsets, len(kmer_ids)),
+                  'genes': genes[order],
+                  'gene_species': gene_species}
+        # the metadata is written last and marks a complete index
+        for name in cls.files[1:] + cls.files[:1]:
+            numpy.save(join(index_dir, "%s.npy" % name), arrays[name])
+        return cls(index_dir)
+
+    def candidate_species(self, seq, min_shared_kmers=3):
+        """ Count the species with a gene sharing k-mers with a sequence.
+
+        Parameters
+        ----------
+        seq: string
+          protein sequence
+        min_shared_kmers: integer, optional
+          the minimum number of distinct k-mers shared with a reference gene
+
+        Returns
+        -------
+        num_species: integer
+          the number of species having at least one such gene
+        """
+        ids = _kmer_ids(seq, self.k)
+        pos = numpy.searchsorted(self.kmers, ids)
+        found = pos < len(self.kmers)
+        found[found] = self.kmers[pos[found]] == ids[found]
+        pos = pos[found]
+        starts = self.offsets[pos]
+        lengths = self.offsets[pos + 1] - starts
+        if not lengths.sum():
+            return 0
+        # positions of all genes of the matching k-mers
+        index = numpy.repeat(starts - numpy.cumsum(lengths) + lengths,
+                             lengths) + numpy.arange(lengths.sum())
+        counts = numpy.bincount(self.genes[index])
+        genes = numpy.nonzero(counts >= min_shared_kmers)[0]
+        return len(numpy.unique(self.gene_species[genes]))
+
+
+def prefilter_query_proteome(query_proteome_fp,
+                             output_fp,
+                             kmer_index,
+                             min_num_homologs=3,
+                             min_shared_kmers=3,
+                             debug=False):
+    """ Drop query genes which can not reach min_num_homologs species.
+
+    Parameters
+    ----------
+    query_proteome_fp: string
+      filepath to query proteome
+    output_fp: string
+      filepath to output the query genes kept (FASTA format)
+    kmer_index: KmerIndex
+      k-mer index of the reference proteomes
+    min_num_homologs: integer, optional
+      the mininum number of homologs for each gene to test
+    min_shared_kmers: integer, optional
+      the minimum number of distinct k-mers a query gene must share with a
+      reference gene for the gene's species to count as a candidate
+    debug: boolean, optional
+      if True, run function in debug mode
+
+    Returns
+    -------
+    kept: integer
+      number of query genes kept
+    dropped: integer
+      number of query genes dropped
+
+    Notes
+    -----
+        The prefilter is a heuristic: homologs too divergent to share
+        min_shared_kmers exact k-mers are not counted. Its intended targets
+        are ORFans and short ORFs, which the homology search would report
+        with too few homologs anyway.
+    """
+    kept = dropped = 0
+    with open(output_fp, 'w') as output_f, \
+            open_input(query_proteome_fp) as query_f:
+        for seq in skbio.io.read(query_f, format='fasta', verify=False):
+            num_species = kmer_index.candidate_species(
+                str(seq), min_shared_kmers=min_shared_kmers)
+            if num_species >= min_num_homologs:
+                output_f.write(">%s\n%s\n" % (seq.metadata['id'], seq))
+                kept += 1
+            else:
+                dropped += 1
+                if debug:
+                    sys.stdout.write(
+                        "[DEBUG] prefilter dropped %s (%s species)\n" % (
+                            seq.metadata['id'], num_species))
+    return kept, dropped
+
+
+def normalize_distances(phylip_fp,
+                        full_distance_matrix,
+                        num_species,
+                        full_distance_matrix_offset,
+                        species_set_dict,
+                        gene_bitvector_map,
+                        debug=False):
+    """ Parse and normalize the output file of PHYLIP's protdist function.
+
+    Parameters
+    ----------
+    phylip_fp: string
+        filepath to distance matrix output by PHYLIP's protdist function
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        complete distance matrix for pairwise alignments between all species
+        for every gene
+    num_species: integer
+        number of species in the reference database
+    full_distance_matrix_offset: integer
+        the index offset for elements in full_distance_matrix where to write
+        the next array
+    species_set_dict: dictionary
+        dictionary containing the binary indicator vectors as keys and the
+        number of genes with identical species set represented by the binary
+        vectors as values
+    gene_bitvector_map: list
+        list containing the binary indicator vector for each query gene
+    debug: boolean
+        if True, run function in debug mode
+
+    Notes
+    -----
+        Parse PHYLIP's protdist output containing the distance matrix, Z-score
+        normalize the set of pairwise distances between the gene in a species
+        and all other species and stores the results in a separate array.
+
+        Each normalized distance matrix is then sorted by species name and
+        added to the complete array storing distance matrices for all genes.
+        In addition, a list of missing species (species which did not include
+        a certain gene) is also maintained and used for setting nan's in array
+        cells which represent those species.
+
+        Below is an example of a parsed distance matrix
+        for 3 genes and 3 species:
+            0         1         2        (genes)
+        0_0 nan       nan       nan
+        0_1 0.53099   0.878855  0.83673
+        0_2 0.642856  1.083039  1.083039
+        1_0 0.300297  0.300297  0.702003
+        1_1 nan       nan       nan
+        1_2 0.399722  0.379156  0.356543
+        2_0 0.53099   0.53099   0.83673
+        2_1 0.399722  0.399722  0.356543
+        2_2 nan       nan       nan
+
+        (species pairs)
+
+        Example of Z-score normalized distance matrix from
+        above:
+            0            1           2          (genes)
+        0_0 nan          nan         nan
+        0_1 -1.40548346  0.83861735  0.56686611
+        0_2 -1.41421356  0.70710678  0.70710678
+        1_0 -0.70710678 -0.70710678  1.41421356
+        1_1 nan          nan         nan
+        1_2 1.20493966   0.03869341 -1.24363308
+        2_0 -0.70710678 -0.70710678  1.41421356
+        2_1 0.70710678   0.70710678 -1.41421356
+        2_2 nan          nan         nan
+
+        (species pairs)
+    """
+    if not exists(phylip_fp) or getsize(phylip_fp) == 0:
+        raise ValueError('%s does not exist or is empty' % phylip_fp)
+    with open(phylip_fp, 'r') as phylip_f:
+        labels, distances = parse_protdist(phylip_f, debug=debug)
+    # protdist files written by previous releases are labelled species_gene
+    species = [int(label.split('_')[0]) for label in labels]
+    add_normalized_distances(species=species,
+                             distances=distances,
+                             full_distance_matrix=full_distance_matrix,
+                             num_species=num_species,
+                             full_distance_matrix_offset=(
+                                 full_distance_matrix_offset),
+                             species_set_dict=species_set_dict,
+                             gene_bitvector_map=gene_bitvector_map)
+
+
+def parse_protdist(phylip_f, debug=False):
+    """ Parse a distance matrix output by PHYLIP's protdist function.
+
+    Parameters
+    ----------
+    phylip_f: iterable
+        lines of the distance matrix (starting with the line holding the
+        number of sequences)
+    debug: boolean
+        if True, run function in debug mode
+
+    Returns
+    -------
+    labels: list
+        sequence labels in the order of the distance matrix
+    distances: numpy.ndarray
+        square matrix of pairwise distances
+
+    Notes
+    -----
+        Rows of more than 7 distances are wrapped by protdist onto
+        continuation lines starting with a space.
+    """
+    labels = []
+    rows = []
+    row = None
+    phylip_f = iter(phylip_f)
+    # skip first line containing number of lines in the file
+    next(phylip_f)
+    for line in phylip_f:
+        if debug:
+            sys.stdout.write("[DEBUG] %s" % line)
+        alignment_dist = line.strip().split()
+        if not alignment_dist:
+            continue
+        if line.startswith(' '):
+            row.extend(alignment_dist)
+        else:
+            # new species alignment pairs
+            if row is not None:
+                rows.append(row)
+            labels.append(alignment_dist[0])
+            row = alignment_dist[1:]
+    if row is not None:
+        rows.append(row)
+    return labels, numpy.asarray(rows, dtype=float)
+
+
+def add_normalized_distances(species,
+                             distances,
+                             full_distance_matrix,
+                             num_species,
+                             full_distance_matrix_offset,
+                             species_set_dict,
+                             gene_bitvector_map):
+    """ Z-score normalize a gene's distance matrix and add it to the tensor.
+
+    Parameters
+    ----------
+    species: list or numpy.ndarray
+        species index of each row of distances
+    distances: numpy.ndarray
+        square matrix of pairwise distances between the gene family members
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        complete distance matrix for pairwise alignments between all species
+        for every gene
+    num_species: integer
+        number of species in the reference database
+    full_distance_matrix_offset: integer
+        the index offset for elements in full_distance_matrix where to write
+        the next array
+    species_set_dict: dictionary
+        dictionary containing the binary indicator vectors as keys and the
+        number of genes with identical species set represented by the binary
+        vectors as values
+    gene_bitvector_map: list
+        list containing the binary indicator vector for each query gene
+
+    Notes
+    -----
+        Only the species present in the gene family are normalized and
+        re-ordered (by species index), all other cells of the gene's
+        num_species x num_species matrix are nan.
+    """
+    species = numpy.asarray(species, dtype=int)
+    normalized = _kernel('zscore_rows')(
+        numpy.ascontiguousarray(distances, dtype=numpy.float64))
+
+    # sort the distance matrix based on species index in order to be
+    # consistent across all gene families
+    order = numpy.argsort(species, kind='mergesort')
+    species = species[order]
+    normalized = normalized[order][:, order]
+
+    # indicate missing genes for the species absent from the gene family
+    bitvector_gene = numpy.full(num_species, 'O')
+    bitvector_gene[species] = 'I'
+    bitvector_gene = ''.join(bitvector_gene)
+
+    # update species set counts
+    if bitvector_gene not in species_set_dict:
+        species_set_dict[bitvector_gene] = 1
+    else:
+        species_set_dict[bitvector_gene] += 1
+
+    gene_bitvector_map[full_distance_matrix_offset] = bitvector_gene
+
+    # add normalized distance matrix for current gene
+    # to full distance matrix
+    if isinstance(full_distance_matrix, SparseDistanceMatrix):
+        full_distance_matrix.set_gene(
+            full_distance_matrix_offset, species, normalized)
+    else:
+        p = numpy.empty(shape=(num_species, num_species))
+        p.fill(numpy.nan)
+        p[numpy.ix_(species, species)] = normalized
+        full_distance_matrix[full_distance_matrix_offset] = p
+
+
+def cluster_distances(species_set_dict,
+                      species_set_size,
+                      hamming_distance):
+    """ Hamming distance clustering algorithm
+
+    Parameters
+    ----------
+    species_set_dict: dictionary
+        dictionary containing the binary indicator vectors as
+        keys and the number of genes with identical species
+        set represented by the binary vectors as values
+    species_set_size: integer
+        threshold number of genes in a species set to
+        allow it to form a core cluster
+    hamming_distance: integer
+        maximum number of mismatches between two binary
+        indicator vectors (ex. IIII and I0II) for the
+        genes in a candidate vector to be merged into the
+        core cluster
+
+    Returns
+    -------
+    gene_clusters_list: list of tuples
+        list of tuples containing core species sets and all belonging species
+        sets (determined by the Hamming distance clustering algorithm)
+
+    Notes
+    -----
+        Cluster gene families by species with detectable orthologs in exactly
+        the same subset of the considered species.
+
+        If no species set holds species_set_size genes (e.g. a query
+        proteome of fewer genes), the largest species set is the only core
+        cluster and all species sets belong to it. Earlier versions
+        returned no cluster in this case, so no HGT could be detected in
+        such runs.
+
+        Ex. Assume we have 4 genes and 5 species with the following distance
+        matrix:
 
             0             1             2             3
         0_0 nan           nan           nan           nan
@@ -645,9 +3172,14 @@ def cluster_distances(species_set_dict,
         present in the four genes: IIIII (gene 0, 2 and 3), II0II (gene 1). If
         the core set threshold was 3, then there would be 1 core species set
         represented by IIIII.
+
+        The Hamming distances between the cores and all species sets are
+        computed by a single kernel call (see set_kernels()).
     """
     sorted_species_set = sorted(list(species_set_dict.items()),
                                 key=operator.itemgetter(1), reverse=True)
+    if not sorted_species_set:
+        return []
     # determine core clusters (initial species sets with more than
     # species_set_size genes)
     gene_clusters_list = []
@@ -656,37 +3188,35 @@ def cluster_distances(species_set_dict,
     # species set
     if sorted_species_set[0][1] < species_set_size:
         cluster_core = (sorted_species_set[0][0], [])
-        gene_clusters_list = []
+        gene_clusters_list = [cluster_core]
     for bitvector in sorted_species_set:
         if bitvector[1] >= species_set_size:
             cluster_core = (bitvector[0], [])
             gene_clusters_list.append(cluster_core)
+    # Hamming distances between the cluster cores and all species sets
+    bitvectors = [bv for bv, _ in sorted_species_set]
+    species_sets = (numpy.frombuffer(
+        ''.join(bitvectors).encode(), dtype=numpy.uint8).reshape(
+            len(bitvectors), -1) == ord('I')).astype(numpy.uint8)
+    core_index = dict((bv, i) for i, bv in enumerate(bitvectors))
+    distances = _kernel('hamming_matrix')(
+        species_sets[[core_index[core] for core, _ in gene_clusters_list]],
+        species_sets)
     # assign species sets with fewer than species_set_size species to core
     # clusters if the Hamming distance between the two bitvectors is less than
-    # hamming_distance
-    species_set_assigned = []
-    for idx, cluster_core in enumerate(gene_clusters_list):
-        for bitvector in sorted_species_set:
-            bv = bitvector[0]
-            if (bv not in species_set_assigned and
-                    hamming(cluster_core[0], bv) <= hamming_distance):
-                gene_clusters_list[idx][1].append(bv)
-                species_set_assigned.append(bv)
+    # hamming_distance (first such cluster)
+    close = distances <= hamming_distance
+    assigned = close.any(axis=0)
+    first_close = close.argmax(axis=0)
+    for bv, idx, is_assigned in zip(bitvectors, first_close, assigned):
+        if is_assigned:
+            gene_clusters_list[idx][1].append(bv)
     # assign the remaining species sets to the cluster with the closest core
-    # Hamming distance
-    for bitvector in sorted_species_set:
-        bv = bitvector[0]
-        if bv not in species_set_assigned:
-            min_hamming_cluster = -1
-            min_hamming_distance = sys.maxsize
-            # find cluster core with smallest Hamming distance to species set
-            for idx, cluster_core in enumerate(gene_clusters_list):
-                dist = hamming(cluster_core[0], bv)
-                if dist < min_hamming_distance:
-                    min_hamming_distance = dist
-                    min_hamming_cluster = idx
-            if min_hamming_cluster >= 0:
-                gene_clusters_list[min_hamming_cluster][1].append(bv)
+    # Hamming distance (first such cluster)
+    closest = distances.argmin(axis=0)
+    for bv, idx, is_assigned in zip(bitvectors, closest, assigned):
+        if not is_assigned:
+            gene_clusters_list[idx][1].append(bv)
 
     return gene_clusters_list
 
@@ -703,123 +3233,1321 @@ def detect_outlier_genes(species_set,
 
     Parameters
     ----------
-    species_set: list
-        list of bitvectors representing species clusters to use in detecting
-        outlier genes
-    gene_bitvector_map: list
-        list containing the binary indicator vector for each query gene
-    full_distance_matrix: dictionary
-        complete distance matrix for pairwise alignments between all species
-        for every gene
+    species_set: list
+        list of bitvectors representing species clusters to use in detecting
+        outlier genes
+    gene_bitvector_map: list
+        list containing the binary indicator vector for each query gene
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        complete distance matrix for pairwise alignments between all species
+        for every gene (float64, float32 or float16)
+    stdev_offset: integer
+        the number of standard deviations a gene's normalized distance is from
+        the mean to identify it as an outlier for a species pair
+    outlier_hgt: float
+        the fraction (value between (0,1]) of normalized pairwise distances
+        over all species-pair vectors belonging to the same gene that are
+        z-score standard deviations from the mean
+    num_species: integer
+        number of species in the reference database
+    total_genes: integer
+        total number of genes in the query genome with at least
+        min_num_homologs (determined by BLAST search)
+    debug: boolean
+        if True, run function in debug mode
+
+    Returns
+    -------
+    outlier_genes: set
+        set of atypical genes
+
+    Notes
+    -----
+        Algorithm described in section "Detecting `Outlier' Genes" of the Wei.
+        X et al. paper. The full distance matrix is represented in the format:
+
+        full_distance_matrix[#genes][#species][#species] =
+        [[[0_0, 0_1, 0_2, .., 0_n]
+          [1_0, 1_1, 1_2, .., 1_n]
+          ..
+          [n_0, n_1, n_2, .., n_n]]
+
+         [[0_0, 0_1, 0_2, .., 0_n]
+          [1_0, 1_1, 1_2, .., 1_n]
+          ..
+          [n_0, n_1, n_2, .., n_n]]
+
+          ..
+         [[0_0, 0_1, 0_2, .., 0_n]
+          [1_0, 1_1, 1_2, .., 1_n]
+          ..
+          [n_0, n_1, n_2, .., n_n]]]
+
+        The mean and standard deviation are computed for each species pair
+        including all genes.
+
+        Outlier distances are counted by count_outliers().
+    """
+    outlier_count_matrix = count_outliers(
+        full_distance_matrix=full_distance_matrix,
+        stdev_offset=stdev_offset,
+        num_species=num_species,
+        total_genes=total_genes,
+        debug=debug)
+
+    # if number of outlier distances exceeds threshold, label gene as outlier
+    outlier_genes = set(numpy.nonzero(
+        (outlier_count_matrix > num_species*outlier_hgt).any(axis=1))[
+            0].tolist())
+
+    return outlier_genes
+
+
+def count_outliers(full_distance_matrix,
+                   stdev_offset,
+                   num_species,
+                   total_genes,
+                   jobs=1,
+                   debug=False):
+    """ Count the outlier distances of each gene by species.
+
+    Parameters
+    ----------
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        complete distance matrix for pairwise alignments between all species
+        for every gene (float64, float32 or float16)
+    stdev_offset: integer
+        the number of standard deviations a gene's normalized distance is from
+        the mean to identify it as an outlier for a species pair
+    num_species: integer
+        number of species in the reference database
+    total_genes: integer
+        total number of genes in the query genome with at least
+        min_num_homologs (determined by BLAST search)
+    jobs: integer, optional
+        number of threads counting the outliers of blocks of species
+        columns (dense tensors only)
+    debug: boolean
+        if True, run function in debug mode
+
+    Returns
+    -------
+    outlier_count_matrix: numpy.ndarray
+        number of outlier distances of each gene by (column) species
+
+    Notes
+    -----
+        The distances are compared at 5 decimals. Each species row of the
+        tensor is upcast to float64 and rounded separately, therefore a
+        tensor stored in reduced precision (float32 or float16) is neither
+        copied nor modified in place. Outlier distances are counted per gene
+        and species directly instead of being stored in a flag tensor of the
+        same shape as full_distance_matrix, by a kernel (see set_kernels()).
+
+        The statistics of a species pair i_j only depend on the distances of
+        the pair, so each thread counts the outliers of a block of columns j
+        (for all species i) in place of the shared count matrix; the tensor
+        is read in place by all threads and the kernels release the GIL.
+    """
+    if isinstance(full_distance_matrix, SparseDistanceMatrix):
+        return _count_outliers_sparse(
+            full_distance_matrix=full_distance_matrix,
+            stdev_offset=stdev_offset,
+            num_species=num_species,
+            total_genes=total_genes)
+
+    outlier_count_matrix = numpy.zeros(
+        shape=(total_genes, num_species), dtype=int)
+    if debug:
+        # print the species pairs in order
+        jobs = 1
+        sys.stdout.write("[DEBUG] species_species\t")
+        for k in range(total_genes):
+            sys.stdout.write("gene # %s".ljust(12) % k)
+        sys.stdout.write("[low_bound, up_bound]\n")
+    count_species_outliers = _kernel('count_species_outliers')
+
+    def count_block(start, end):
+        # species pairs i_j of the columns j in [start, end)
+        for i in range(num_species):
+            distances = numpy.asarray(
+                full_distance_matrix[:total_genes, i, start:end])
+            if distances.dtype == numpy.float16:
+                # not supported by Numba, upcast exactly
+                distances = distances.astype(numpy.float32)
+            low_bound, up_bound = count_species_outliers(
+                distances, i - start, float(stdev_offset),
+                outlier_count_matrix[:, start:end])
+            if debug:
+                distances = numpy.around(distances.astype(numpy.float64),
+                                         decimals=5)
+                distances[:, i] = numpy.nan
+                with numpy.errstate(invalid='ignore'):
+                    outliers = (distances < low_bound) | (
+                        distances > up_bound)
+                for j in range(num_species):
+                    if i == j:
+                        continue
+                    sys.stdout.write("[DEBUG] %s_%s\t".ljust(20) % (i, j))
+                    for k, distance in enumerate(distances[:, j]):
+                        spaces = "".ljust(2)
+                        if distance < 0:
+                            spaces = "".ljust(1)
+                        if outliers[k][j]:
+                            sys.stdout.write(
+                                "%s\033[92m%s\033[0m" % (spaces, distance))
+                        else:
+                            sys.stdout.write("%s%s" % (spaces, distance))
+                    sys.stdout.write("\t[%s, %s]\n" % (
+                        low_bound[j], up_bound[j]))
+
+    bounds = numpy.linspace(0, num_species, max(min(jobs, num_species), 1) +
+                            1).astype(int)
+    if len(bounds) == 2:
+        count_block(0, num_species)
+    else:
+        with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+            futures = [executor.submit(count_block, start, end)
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+    return outlier_count_matrix
+
+
+def _count_outliers_sparse(full_distance_matrix,
+                           stdev_offset,
+                           num_species,
+                           total_genes):
+    """ Count outlier distances per gene and species on sparse storage.
+
+    Parameters
+    ----------
+    full_distance_matrix: SparseDistanceMatrix
+        packed normalized distance matrices for every gene
     stdev_offset: integer
         the number of standard deviations a gene's normalized distance is from
         the mean to identify it as an outlier for a species pair
-    outlier_hgt: float
-        the fraction (value between (0,1]) of normalized pairwise distances
-        over all species-pair vectors belonging to the same gene that are
-        z-score standard deviations from the mean
     num_species: integer
         number of species in the reference database
     total_genes: integer
         total number of genes in the query genome with at least
         min_num_homologs (determined by BLAST search)
-    debug: boolean
-        if True, run function in debug mode
 
     Returns
     -------
+    outlier_count_matrix: numpy.ndarray
+        number of outlier distances of each gene by (column) species
+
+    Notes
+    -----
+        The per species pair mean and standard deviation are accumulated
+        over the packed submatrices in two passes (sum, then sum of squared
+        deviations), with the same rounding to 5 decimals as the dense path.
+    """
+    def rounded(gene):
+        species = full_distance_matrix.species[gene]
+        distances = numpy.around(
+            full_distance_matrix.distances[gene].astype(numpy.float64),
+            decimals=5)
+        return numpy.ix_(species, species), distances
+
+    sums = numpy.zeros(shape=(num_species, num_species))
+    counts = numpy.zeros(shape=(num_species, num_species), dtype=int)
+    for gene in range(total_genes):
+        pairs, distances = rounded(gene)
+        present = ~numpy.isnan(distances)
+        sums[pairs] += numpy.where(present, distances, 0)
+        counts[pairs] += present
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    squares = numpy.zeros(shape=(num_species, num_species))
+    for gene in range(total_genes):
+        pairs, distances = rounded(gene)
+        deviations = numpy.where(
+            numpy.isnan(distances), 0, distances - mean[pairs])
+        squares[pairs] += deviations**2
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        stdev = numpy.sqrt(squares / counts)
+    low_bound = numpy.around(mean - stdev_offset*stdev, decimals=5)
+    up_bound = numpy.around(mean + stdev_offset*stdev, decimals=5)
+
+    outlier_count_matrix = numpy.zeros(
+        shape=(total_genes, num_species), dtype=int)
+    for gene in range(total_genes):
+        pairs, distances = rounded(gene)
+        with numpy.errstate(invalid='ignore'):
+            outliers = ((distances < low_bound[pairs]) |
+                        (distances > up_bound[pairs]))
+        outlier_count_matrix[gene, full_distance_matrix.species[gene]] += \
+            outliers.sum(axis=0)
+    return outlier_count_matrix
+
+
+def estimate_family_cost(sequences):
+    """ Estimate the cost and memory of aligning a gene family.
+
+    Parameters
+    ----------
+    sequences: list
+        protein sequences of the gene family
+
+    Returns
+    -------
+    cost: float
+        relative cost of the MSA and distance computation
+    memory: integer
+        estimated peak memory (bytes) of the MSA and distance computation
+
+    Notes
+    -----
+        Clustalw's pairwise alignment stage aligns every pair of sequences,
+        so its cost grows with the square of the total number of residues.
+        Memory is dominated by the profiles of the progressive alignment
+        (one column of scores per residue of the longest sequence and
+        sequence) and the pairwise distance matrix.
+    """
+    return _family_cost([len(seq) for seq in sequences])
+
+
+def _family_cost(lengths):
+    """ Estimate the cost and memory of a gene family from its lengths.
+    """
+    if not lengths:
+        return 0.0, 0
+    residues = sum(lengths)
+    cost = float(residues)**2
+    memory = 64*len(lengths)*max(lengths) + 8*len(lengths)**2
+    return cost, memory
+
+
+# cost (see estimate_family_cost()) of a gene family of 20 homologs of 400
+# residues, which the alignment software is expected to align within the
+# base timeout
+TIMEOUT_REFERENCE_COST = float(20*400)**2
+
+# default upper bound of the scaled timeout, as a multiple of the base timeout
+MAX_TIMEOUT_FACTOR = 10
+
+
+def family_timeout(sequences, timeout, max_timeout=None):
+    """ Scale the alignment timeout of a gene family to its size.
+
+    Parameters
+    ----------
+    sequences: list
+        protein sequences of the gene family
+    timeout: integer
+        number of seconds to allow the alignment software to run for a gene
+        family of the reference cost (TIMEOUT_REFERENCE_COST) or smaller
+    max_timeout: integer, optional
+        upper bound of the scaled timeout (default MAX_TIMEOUT_FACTOR times
+        timeout); timeout is used for all gene families if max_timeout is
+        timeout
+
+    Returns
+    -------
+    timeout: float
+        number of seconds to allow the alignment software to run
+
+    Notes
+    -----
+        The timeout grows linearly with the estimated cost of the alignment
+        (the square of the total number of residues), so that large families
+        are not killed after the time a typical family needs.
+    """
+    if max_timeout is None:
+        max_timeout = MAX_TIMEOUT_FACTOR*timeout
+    cost, _ = estimate_family_cost(sequences)
+    return min(max_timeout,
+               max(timeout, timeout*cost/TIMEOUT_REFERENCE_COST))
+
+
+def subsample_family(genes, query, gene_map, size):
+    """ Keep the query gene and the best homologs of a gene family.
+
+    Parameters
+    ----------
+    genes: list
+        genes of the family, in the order of the homology search (best
+        alignments first)
+    query: string
+        query gene name
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values
+    size: integer
+        maximum number of genes of the subsampled family
+
+    Returns
+    -------
+    genes: list
+        the genes of the query species (the query gene) followed by the
+        first homologs of the other species, up to size genes in total
+    """
+    kept = [gene for gene in genes if gene_map[gene] == gene_map[query]]
+    others = [gene for gene in genes if gene_map[gene] != gene_map[query]]
+    return kept + others[:max(size - len(kept), 0)]
+
+
+def write_msa_failures(msa_failures_fp, failures):
+    """ Write the gene families whose alignment failed or timed out.
+
+    Parameters
+    ----------
+    msa_failures_fp: string
+        filepath to the tab-separated output file
+    failures: list of tuples
+        (query, number of homologs, residues, timeout, software, status,
+        resolution) of each failed alignment (see align_families())
+    """
+    with open(msa_failures_fp, 'w') as failures_f:
+        failures_f.write("#query\thomologs\tresidues\ttimeout\tsoftware\t"
+                         "status\tresolution\n")
+        for failure in failures:
+            failures_f.write("%s\t%s\t%s\t%g\t%s\t%s\t%s\n" % failure)
+
+
+def schedule_families(hits, ref_db, batch_size=1):
+    """ Group gene families into batches, most expensive first.
+
+    Parameters
+    ----------
+    hits: dictionary
+        dictionary storing query (gene) names as keys and the best aligning
+        reference sequences as values, in the order the genes are stored in
+        the distance matrix
+    ref_db: dictionary
+        dictionary storing FASTA label as key and sequence as value for the
+        reference databases
+    batch_size: integer, optional
+        number of gene families per batch
+
+    Returns
+    -------
+    batches: list of tuples
+        (families, memory) for each batch, where families is a list of
+        (offset, query) tuples and memory the largest estimated memory of
+        its families, ordered by decreasing estimated cost
+
+    Notes
+    -----
+        Starting with the most expensive gene families avoids a few huge
+        families being processed last while all other workers are idle.
+    """
+    families = []
+    for offset, query in enumerate(hits):
+        cost, memory = estimate_family_cost(
+            [ref_db[ref] for ref in hits[query]])
+        families.append((cost, offset, query, memory))
+    families.sort(key=lambda family: (-family[0], family[1]))
+    batches = []
+    for i in range(0, len(families), batch_size):
+        batch = families[i:i+batch_size]
+        batches.append(([(offset, query) for _, offset, query, _ in batch],
+                        max(memory for _, _, _, memory in batch)))
+    return batches
+
+
+class MemoryBudget(object):
+    """Admit work while the estimated memory of running work fits a budget.
+
+    Work larger than the whole budget is admitted when nothing else runs, so
+    that it is never starved.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, memory):
+        with self._condition:
+            while (self.budget is not None and self.used > 0 and
+                   self.used + memory > self.budget):
+                self._condition.wait()
+            self.used += memory
+
+    def release(self, memory):
+        with self._condition:
+            self.used -= memory
+            self._condition.notify_all()
+
+
+def prepare_workspace(workspace_dir):
+    """ Create the files used to align and compute distances for a family.
+
+    Parameters
+    ----------
+    workspace_dir: string
+        dirpath to the workspace (created if it does not exist)
+
+    Returns
+    -------
+    workspace: dictionary
+        filepaths of the workspace files (keys are the variable names used
+        in distance_method())
+    """
+    if not isdir(workspace_dir):
+        mkdir(workspace_dir)
+    workspace = {
+        'workspace_dir': workspace_dir,
+        'phy_msa_fp': join(workspace_dir, "msa.phy"),
+        'phylip_fp': join(workspace_dir, "msa.dis"),
+        'phylip_command_fp': join(workspace_dir, "phylip_command.txt"),
+        'batch_msa_fp': join(workspace_dir, "msa_batch.phy"),
+        'batch_command_fp': join(workspace_dir, "phylip_batch_command.txt")}
+    for fp in ['phy_msa_fp', 'phylip_fp']:
+        open(workspace[fp], 'a').close()
+    write_protdist_command(phylip_command_fp=workspace['phylip_command_fp'],
+                           phy_msa_fp=workspace['phy_msa_fp'],
+                           phylip_fp=workspace['phylip_fp'])
+    return workspace
+
+
+def align_families(families,
+                   workspace,
+                   gene_map,
+                   ref_db,
+                   hits,
+                   timeout,
+                   msa_backend=MSA_BACKENDS['clustalw'],
+                   msa_fallback=MSA_BACKENDS['clustalw-quicktree'],
+                   alignments=None,
+                   kmer_size=None,
+                   reference_families=None,
+                   groups=None,
+                   max_timeout=None,
+                   msa_subsample_size=None,
+                   failures=None,
+                   warnings=False,
+                   verbose=False,
+                   debug=False):
+    """ Compute the MSA and distance matrix of a batch of gene families.
+
+    Parameters
+    ----------
+    families: list of tuples
+        (offset, query) of the gene families in the batch
+    workspace: dictionary
+        filepaths returned by prepare_workspace()
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values
+    ref_db: dictionary
+        dictionary storing FASTA label as key and sequence as value for the
+        reference databases
+    hits: dictionary
+        dictionary storing query (gene) names as keys and the best aligning
+        reference sequences as values
+    timeout: integer
+        base number of seconds to allow the alignment software to run per
+        call (see family_timeout())
+    msa_backend: MSABackend, optional
+        multiple sequence alignment software
+    msa_fallback: MSABackend, optional
+        alignment software to retry with if msa_backend fails (None to
+        skip the gene family instead)
+    alignments: dictionary, optional
+        precomputed MSAs of the gene families (see parse_precomputed_msas()),
+        used instead of running the alignment software
+    kmer_size: integer, optional
+        if given, distances are computed from the k-mers of the unaligned
+        sequences (kmer_distances()) instead of MSAs and protdist
+    reference_families: ReferenceFamilies, optional
+        if given, each query gene is added to its reference family by
+        profile alignment (using msa_backend) and only its distances are
+        computed
+    groups: dictionary, optional
+        query genes sharing their reference homologs (see
+        deduplicate_families()); for the first query gene of a group, the
+        reference homologs are aligned and each query gene of the group is
+        added to their MSA (see profile_distances())
+    max_timeout: integer, optional
+        upper bound of the per-family timeout scaled to the size of the gene
+        family (see family_timeout())
+    msa_subsample_size: integer, optional
+        if given, a gene family whose alignment still fails is aligned again
+        with its msa_subsample_size best homologs (see subsample_family())
+    failures: list, optional
+        list the failed alignments are appended to (see
+        write_msa_failures())
+    warnings: boolean, optional
+        print warnings output by PHYLIP
+    verbose: boolean, optional
+        if True, run in verbose mode
+    debug: boolean, optional
+        if True, run in debug mode
+
+    Returns
+    -------
+    results: list of tuples
+        (offset, query, genes, distances) for each gene family (and each
+        query gene of a group, with the offset of the group), genes being
+        the gene names of the rows of distances; genes and distances are
+        None for gene families whose MSA failed
+
+    Notes
+    -----
+        A gene family whose alignment times out (or fails) is retried with
+        msa_fallback, then with a subsample of the family. A batch of more
+        than one gene family is passed to protdist in a single run
+        (compute_distances_batch()).
+    """
+    results = []
+    msas = []
+    for offset, query in families:
+        if verbose:
+            sys.stdout.write(
+                "Computing MSA and distances for gene %s ..\n" % query)
+        if reference_families is not None:
+            labels, distances = reference_families.query_distances(
+                query=query,
+                hits=hits[query],
+                gene_map=gene_map,
+                ref_db=ref_db,
+                msa_backend=msa_backend,
+                timeout=timeout,
+                tmp_dir=workspace['workspace_dir'],
+                warnings=warnings)
+            if labels is None:
+                sys.stdout.write(
+                    "Skipping gene %s: no reference family or profile "
+                    "alignment\n" % query)
+            results.append((offset, query, labels, distances))
+            continue
+        if kmer_size is not None:
+            labels, distances = kmer_distances(
+                [(ref, ref_db[ref]) for ref in hits[query]], k=kmer_size)
+            results.append((offset, query, labels, distances))
+            continue
+        if alignments is not None:
+            alignment, genes = relabel_family(alignments[query])
+            msas.append((offset, query, genes,
+                         format_phylip_alignment(alignment)))
+            continue
+        genes = hits[query]
+        if groups and query in groups:
+            genes = [gene for gene in genes if gene != query]
+        query_timeout = family_timeout(
+            [ref_db[ref] for ref in genes], timeout, max_timeout)
+        attempts = [(msa_backend, genes)]
+        if msa_fallback is not None:
+            attempts.append((msa_fallback, genes))
+        if msa_subsample_size is not None and (
+                len(genes) > msa_subsample_size):
+            attempts.append((msa_fallback or msa_backend, subsample_family(
+                genes, query, gene_map, msa_subsample_size)))
+        alignment = None
+        for attempt, (backend, genes) in enumerate(attempts):
+            if attempt:
+                sys.stdout.write("Retrying gene %s with %s (%s homologs)\n" % (
+                    query, backend.name, len(genes)))
+            status, alignment = launch_msa(
+                backend=backend,
+                ref_db=ref_db,
+                hits={query: genes},
+                query=query,
+                timeout=query_timeout,
+                tmp_dir=workspace['workspace_dir'])
+            if alignment is not None:
+                break
+            timed_out = status == Command.TIMEOUT
+            sys.stdout.write("%s %s for gene %s (status %s)\n" % (
+                backend.name, "timed out after %g s" % query_timeout
+                if timed_out else "failed", query, status))
+            if failures is not None:
+                if attempt + 1 < len(attempts):
+                    resolution = "retry: %s, %s homologs" % (
+                        attempts[attempt + 1][0].name,
+                        len(attempts[attempt + 1][1]))
+                else:
+                    resolution = "skipped"
+                failures.append((
+                    query, len(genes), sum(len(ref_db[ref]) for ref in genes),
+                    query_timeout, backend.name,
+                    "timeout" if timed_out else status, resolution))
+        if alignment is None:
+            sys.stdout.write(
+                "Skipping gene %s: no MSA could be computed\n" % query)
+            results.append((offset, query, None, None))
+            continue
+        if groups and query in groups:
+            ref_distances = protdist_distances(
+                [alignment], tmp_dir=workspace['workspace_dir'],
+                warnings=warnings)[0]
+            for member in groups[query]:
+                genes, distances = profile_distances(
+                    alignment, ref_distances, member, ref_db[member],
+                    backend, timeout=query_timeout,
+                    tmp_dir=workspace['workspace_dir'], warnings=warnings)
+                if genes is None:
+                    sys.stdout.write(
+                        "Skipping gene %s: no profile alignment\n" % member)
+                results.append((offset, member, genes, distances))
+            continue
+        alignment, genes = relabel_family(alignment)
+        msas.append((offset, query, genes, format_phylip_alignment(alignment)))
+
+    if len(msas) == 1:
+        offset, query, genes, msa = msas[0]
+        with open(workspace['phy_msa_fp'], 'w') as phy_msa_f:
+            phy_msa_f.write(msa)
+        # protdist replaces phylip_fp, never parse a previous family's
+        # distances
+        open(workspace['phylip_fp'], 'w').close()
+        compute_distances(phylip_command_fp=workspace['phylip_command_fp'],
+                          warnings=warnings)
+        if getsize(workspace['phylip_fp']) == 0:
+            raise ValueError(
+                '%s does not exist or is empty' % workspace['phylip_fp'])
+        with open(workspace['phylip_fp'], 'r') as phylip_f:
+            labels, distances = parse_protdist(phylip_f, debug=debug)
+        results.append((offset, query, restore_labels(labels, genes),
+                        distances))
+    elif msas:
+        distance_matrices = compute_distances_batch(
+            msas=[msa for _, _, _, msa in msas],
+            batch_msa_fp=workspace['batch_msa_fp'],
+            phylip_command_fp=workspace['batch_command_fp'],
+            phylip_fp=workspace['phylip_fp'],
+            warnings=warnings,
+            debug=debug)
+        for (offset, query, genes, _), (labels, distances) in zip(
+                msas, distance_matrices):
+            results.append((offset, query, restore_labels(labels, genes),
+                            distances))
+    return results
+
+
+def compact_genes(full_distance_matrix, gene_bitvector_map, gene_id, keep):
+    """ Remove the genes without distances from the distance matrix.
+
+    Parameters
+    ----------
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        complete distance matrix for pairwise alignments between all species
+        for every gene
+    gene_bitvector_map: dictionary
+        binary indicator vector of each gene offset
+    gene_id: dictionary
+        query gene name of each gene offset
+    keep: list
+        sorted offsets of the genes to keep
+
+    Returns
+    -------
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        distance matrix holding the kept genes at offsets 0..len(keep)-1
+    gene_bitvector_map: dictionary
+        binary indicator vector of each new gene offset
+    gene_id: dictionary
+        query gene name of each new gene offset
+
+    Notes
+    -----
+        Dense matrices are compacted in place (a view of the kept genes is
+        returned) so that no copy of the tensor is made.
+    """
+    for new, old in enumerate(keep):
+        if new == old:
+            continue
+        if isinstance(full_distance_matrix, SparseDistanceMatrix):
+            full_distance_matrix.set_gene(
+                new, full_distance_matrix.species[old],
+                full_distance_matrix.distances[old])
+        else:
+            full_distance_matrix[new] = full_distance_matrix[old]
+    if isinstance(full_distance_matrix, SparseDistanceMatrix):
+        full_distance_matrix.resize(len(keep))
+    else:
+        full_distance_matrix = full_distance_matrix[:len(keep)]
+    gene_bitvector_map = {new: gene_bitvector_map[old]
+                          for new, old in enumerate(keep)}
+    gene_id = {new: gene_id[old] for new, old in enumerate(keep)}
+    return full_distance_matrix, gene_bitvector_map, gene_id
+
+
+def output_full_matrix(matrix, num_species):
+    """ Output distance matrix to stdout
+
+    One line per species pair, one column per gene (see write_results() for
+    a binary copy of the tensor).
+    """
+    matrix = numpy.asarray(matrix)
+    for row in matrix.reshape(len(matrix), num_species*num_species).T:
+        sys.stdout.write("%s\t\n" % "\t".join(map(str, row)))
+
+
+def pack_distances(full_distance_matrix, genes):
+    """ Pack the distance matrices of genes of a SparseDistanceMatrix.
+
+    Parameters
+    ----------
+    full_distance_matrix: SparseDistanceMatrix
+        normalized distances of each gene family
+    genes: list
+        offsets of the genes to pack, in order
+
+    Returns
+    -------
+    packed: dictionary
+        the concatenated species indices of the genes ('species'), delimited
+        per gene by 'species_offsets', and their concatenated flattened
+        submatrices ('packed_distances'), see unpack_distances()
+    """
+    species = [full_distance_matrix.species[gene] for gene in genes]
+    return {
+        'species': numpy.concatenate(
+            [numpy.empty(0, dtype=numpy.int32)] + species),
+        'species_offsets': numpy.cumsum(
+            [0] + [len(present) for present in species]),
+        'packed_distances': numpy.concatenate(
+            [numpy.empty(0, dtype=full_distance_matrix.dtype)] + [
+                full_distance_matrix.distances[gene].ravel()
+                for gene in genes])}
+
+
+def unpack_distances(species, species_offsets, packed_distances):
+    """ Return the (species, distances) of each gene packed by
+        pack_distances().
+    """
+    genes = []
+    start = 0
+    for gene in range(len(species_offsets) - 1):
+        present = species[species_offsets[gene]:species_offsets[gene + 1]]
+        size = len(present)**2
+        genes.append((present, packed_distances[start:start + size].reshape(
+            len(present), len(present))))
+        start += size
+    return genes
+
+
+def write_results(results_fp,
+                  full_distance_matrix,
+                  gene_bitvector_map,
+                  gene_id,
+                  gene_clusters_list,
+                  outlier_count_matrix,
+                  outlier_genes):
+    """ Save the distances, clusters and outliers of a run in NumPy format.
+
+    Parameters
+    ----------
+    results_fp: string
+        filepath to the .npz output file
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        normalized distances of each gene family
+    gene_bitvector_map: dictionary
+        binary indicator vector of each gene offset
+    gene_id: dictionary
+        query gene name of each gene offset
+    gene_clusters_list: list of tuples
+        core species sets and their species sets (see cluster_distances())
+    outlier_count_matrix: numpy.ndarray
+        number of outlier distances of each gene by species (see
+        count_outliers())
     outlier_genes: set
-        set of atypical genes
+        offsets of the outlier genes
 
     Notes
     -----
-        Algorithm described in section "Detecting `Outlier' Genes" of the Wei.
-        X et al. paper. The full distance matrix is represented in the format:
+        The file holds the arrays 'genes', 'bitvectors', 'clusters' (index
+        of the cluster of each gene in 'cluster_cores', -1 if none),
+        'cluster_cores', 'outlier_counts' and 'outliers'. Dense tensors are
+        stored as 'distances' (genes, species, species); sparse ones as the
+        concatenated species indices ('species', delimited per gene by
+        'species_offsets') and packed submatrices ('packed_distances'). Use
+        read_results() to load it back.
+    """
+    total_genes = len(gene_id)
+    genes = [gene_id[gene] for gene in range(total_genes)]
+    bitvectors = [gene_bitvector_map[gene] for gene in range(total_genes)]
+    outliers = numpy.zeros(total_genes, dtype=bool)
+    outliers[sorted(outlier_genes)] = True
+    cluster_of = {}
+    for cluster, (_, species_sets) in enumerate(gene_clusters_list):
+        for bitvector in species_sets:
+            cluster_of.setdefault(bitvector, cluster)
+    results = {
+        'genes': numpy.array(genes, dtype=str),
+        'bitvectors': numpy.array(bitvectors, dtype=str),
+        'clusters': numpy.array(
+            [cluster_of.get(bitvector, -1) for bitvector in bitvectors],
+            dtype=numpy.int32),
+        'cluster_cores': numpy.array(
+            [core for core, _ in gene_clusters_list], dtype=str),
+        'outlier_counts': numpy.asarray(outlier_count_matrix,
+                                        dtype=numpy.int32),
+        'outliers': outliers}
+    if isinstance(full_distance_matrix, SparseDistanceMatrix):
+        results.update(pack_distances(full_distance_matrix,
+                                      range(total_genes)))
+    else:
+        results['distances'] = numpy.asarray(
+            full_distance_matrix[:total_genes])
+    with open(results_fp, 'wb') as results_f:
+        numpy.savez(results_f, **results)
+
+
+def read_results(results_fp):
+    """ Load the results saved by write_results().
+
+    Parameters
+    ----------
+    results_fp: string
+        filepath to the .npz file
+
+    Returns
+    -------
+    results: dictionary
+        arrays of the file by name, 'distances' being a numpy.ndarray or a
+        SparseDistanceMatrix as written
+    """
+    with numpy.load(results_fp) as results_f:
+        results = dict(results_f.items())
+    if 'packed_distances' in results:
+        packed = results.pop('packed_distances')
+        full_distance_matrix = SparseDistanceMatrix(
+            len(results['genes']), results['outlier_counts'].shape[1],
+            dtype=packed.dtype)
+        for gene, (present, distances) in enumerate(unpack_distances(
+                results.pop('species'), results.pop('species_offsets'),
+                packed)):
+            full_distance_matrix.set_gene(gene, present, distances)
+        results['distances'] = full_distance_matrix
+    return results
+
+
+def deduplicate_families(hits):
+    """ Group the query genes sharing the same reference homologs.
+
+    Parameters
+    ----------
+    hits: dictionary
+        dictionary storing query (gene) names as keys and their gene family
+        (including the query gene) as values
+
+    Returns
+    -------
+    groups: dictionary
+        dictionary storing the first query gene of each group of at least
+        two query genes with identical reference homologs as keys and the
+        query genes of the group as values
+
+    Notes
+    -----
+        Paralogous query genes often map to the same reference homologs.
+        The reference homologs of a group (at least two) are aligned and
+        their distances computed once; each query gene of the group is then
+        added to their MSA by profile alignment and only its row of
+        distances is computed (see profile_distances()).
+    """
+    queries = {}
+    for query in hits:
+        if query not in hits[query]:
+            continue
+        key = tuple(sorted(gene for gene in hits[query] if gene != query))
+        if len(key) > 1:
+            queries.setdefault(key, []).append(query)
+    return dict((group[0], group) for group in queries.values()
+                if len(group) > 1)
+
+
+def share_families(hits, gene_map):
+    """ Group the query genes whose gene families can share one MSA.
+
+    Parameters
+    ----------
+    hits: dictionary
+        dictionary storing query (gene) names as keys and their gene family
+        (including the query gene) as values
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values
+
+    Returns
+    -------
+    groups: dictionary
+        dictionary storing the first query gene of each group of at least
+        two query genes as keys and, as values, the genes of all the gene
+        families of the group (first query gene's family first) and the
+        query genes of the group
+
+    Notes
+    -----
+        When every genome of a panel is screened (see screen_all_vs_all()),
+        the gene families of orthologous query genes overlap: each holds
+        the query gene and its best homologs in the other genomes. A query
+        gene joins the first group holding one of its family's genes whose
+        genes, with its family's, still hold at most one gene per species.
+        The genes of a group are aligned and their distances computed once;
+        each query gene's matrix is the block of its family (see
+        select_family_distances()), so the distances of the reference pairs
+        are shared by the genomes.
+    """
+    groups = OrderedDict()
+    gene_group = {}
+    for query in hits:
+        if query not in hits[query]:
+            continue
+        family = hits[query]
+        keys = []
+        for gene in family:
+            keys.extend(key for key in gene_group.get(gene, [])
+                        if key not in keys)
+        for key in keys:
+            genes, queries = groups[key]
+            merged = genes + [gene for gene in family if gene not in genes]
+            if len(set(gene_map[gene] for gene in merged)) == len(merged):
+                groups[key] = (merged, queries + [query])
+                break
+        else:
+            key = query
+            groups[key] = (list(family), [query])
+        for gene in family:
+            if key not in gene_group.setdefault(gene, []):
+                gene_group[gene].append(key)
+    return dict((key, group) for key, group in groups.items()
+                if len(group[1]) > 1)
+
+
+def select_family_distances(genes, distances, family):
+    """ Return the genes and distances of a gene family from a larger MSA.
+
+    Parameters
+    ----------
+    genes: list
+        gene names of the rows of distances
+    distances: numpy.ndarray
+        square matrix of pairwise distances
+    family: list
+        genes of the gene family
+
+    Returns
+    -------
+    genes: list
+        gene names of the rows of the family's distances
+    distances: numpy.ndarray
+        the rows and columns of the family's genes
+    """
+    family = set(family)
+    keep = [i for i, gene in enumerate(genes) if gene in family]
+    return ([genes[i] for i in keep],
+            numpy.asarray(distances)[numpy.ix_(keep, keep)])
+
+
+def compute_family_distances(hits,
+                             gene_map,
+                             ref_db,
+                             num_species,
+                             working_dir,
+                             timeout=120,
+                             distance_dtype='float64',
+                             sparse_distances=False,
+                             protdist_batch_size=1,
+                             jobs=1,
+                             memory_budget=None,
+                             msa_software='clustalw',
+                             msa_fallback='clustalw-quicktree',
+                             alignments=None,
+                             kmer_size=None,
+                             reference_families=None,
+                             scratch_dir=None,
+                             dedup_families=False,
+                             shared_families=False,
+                             max_timeout=None,
+                             msa_subsample_size=None,
+                             msa_failures_fp=None,
+                             warnings=False,
+                             verbose=False,
+                             debug=False):
+    """ Compute the normalized distances of gene families.
+
+    Parameters
+    ----------
+    hits: dictionary
+        dictionary storing query (gene) names as keys and their gene family
+        as values, in the order the genes are stored in the distance matrix
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values
+    ref_db: dictionary
+        dictionary storing FASTA label as key and sequence as value for the
+        reference databases
+    num_species: integer
+        number of species in the reference database
+    working_dir: string
+        dirpath to working directory
+    timeout, distance_dtype, sparse_distances, protdist_batch_size, jobs,
+    memory_budget, msa_software, msa_fallback, kmer_size, scratch_dir,
+    dedup_families, max_timeout, msa_subsample_size, warnings, verbose,
+    debug:
+        see distance_method()
+    alignments: dictionary, optional
+        precomputed MSAs of the gene families (see parse_precomputed_msas())
+    reference_families: ReferenceFamilies, optional
+        reference gene families the query genes are added to
+    shared_families: boolean, optional
+        if True, align the overlapping gene families of query genes (e.g.
+        orthologs of different genomes) once and take each query gene's
+        distances from the shared MSA (see share_families())
+    msa_failures_fp: string, optional
+        filepath to the record of the gene families whose alignment failed
+        or timed out, written if there are any (default
+        working_dir/msa_failures.tsv, see write_msa_failures())
+
+    Returns
+    -------
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        normalized distances of each gene family (genes without distances
+        are left empty)
+    species_set_dict: dictionary
+        number of genes (values) of each species set (keys)
+    gene_bitvector_map: dictionary
+        binary indicator vector of each gene offset
+    done: list
+        offsets of the genes with distances
+    """
+    total_genes = len(hits)
+    offsets = dict((query, offset) for offset, query in enumerate(hits))
+    # align the reference homologs shared by several query genes once
+    groups = None
+    if dedup_families and alignments is None and kmer_size is None and (
+            reference_families is None):
+        groups = deduplicate_families(hits)
+        grouped = set(query for group in groups.values() for query in group)
+        hits = OrderedDict(
+            (query, hits[query]) for query in hits
+            if query in groups or query not in grouped)
+        sys.stdout.write(
+            "Deduplicated gene families: %s groups of %s query genes share "
+            "their reference MSAs (%s reference MSAs saved)\n" % (
+                len(groups), len(grouped), len(grouped) - len(groups)))
+    shared = {}
+    if shared_families and not dedup_families and alignments is None and (
+            reference_families is None):
+        shared = share_families(hits, gene_map)
+        grouped = set(query for _, group in shared.values()
+                      for query in group)
+        query_hits = hits
+        hits = OrderedDict()
+        for query in query_hits:
+            if query in shared:
+                hits[query] = shared[query][0]
+            elif query not in grouped:
+                hits[query] = query_hits[query]
+        sys.stdout.write(
+            "Shared gene families: %s query genes share %s MSAs (%s MSAs "
+            "saved)\n" % (
+                len(grouped), len(shared), len(grouped) - len(shared)))
+    # distance matrix containing distances between all ortholog genes
+    if sparse_distances:
+        full_distance_matrix = SparseDistanceMatrix(
+            total_genes, num_species, dtype=distance_dtype)
+    else:
+        full_distance_matrix = numpy.zeros(
+            shape=(total_genes, num_species, num_species),
+            dtype=distance_dtype)
+    # dictionary to store all subsets of orthologs (keys) and
+    # their number of occurrences (values) (maximum occurrences
+    # is equal to the number of genes)
+    species_set_dict = {}
+    gene_bitvector_map = {}
+    # one workspace (MSA and PROTDIST files) per concurrent job
+    workspaces_dir = working_dir
+    if scratch_dir is not None:
+        workspaces_dir = tempfile.mkdtemp(prefix="distance_method_",
+                                          dir=scratch_dir)
+    workspaces = Queue()
+    for job in range(jobs):
+        workspaces.put(prepare_workspace(
+            workspaces_dir if jobs == 1 else join(
+                workspaces_dir, "job_%s" % job)))
+    budget = MemoryBudget(
+        memory_budget*1024*1024 if memory_budget is not None else None)
+    failures = []
 
-        full_distance_matrix[#genes][#species][#species] =
-        [[[0_0, 0_1, 0_2, .., 0_n]
-          [1_0, 1_1, 1_2, .., 1_n]
-          ..
-          [n_0, n_1, n_2, .., n_n]]
+    def run_batch(families, memory):
+        budget.acquire(memory)
+        workspace = workspaces.get()
+        try:
+            return align_families(families=families,
+                                  workspace=workspace,
+                                  gene_map=gene_map,
+                                  ref_db=ref_db,
+                                  hits=hits,
+                                  timeout=timeout,
+                                  msa_backend=MSA_BACKENDS[msa_software],
+                                  msa_fallback=MSA_BACKENDS.get(msa_fallback),
+                                  alignments=alignments,
+                                  kmer_size=kmer_size,
+                                  reference_families=reference_families,
+                                  groups=groups,
+                                  max_timeout=max_timeout,
+                                  msa_subsample_size=msa_subsample_size,
+                                  failures=failures,
+                                  warnings=warnings,
+                                  verbose=verbose,
+                                  debug=debug)
+        finally:
+            workspaces.put(workspace)
+            budget.release(memory)
 
-         [[0_0, 0_1, 0_2, .., 0_n]
-          [1_0, 1_1, 1_2, .., 1_n]
-          ..
-          [n_0, n_1, n_2, .., n_n]]
+    # generate a multiple sequence alignment and compute distances for each
+    # orthologous gene family, most expensive families first
+    done = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(run_batch, families, memory)
+                       for families, memory in schedule_families(
+                           hits=hits,
+                           ref_db=ref_db,
+                           batch_size=protdist_batch_size)]
+            for future in as_completed(futures):
+                for _, query, genes, distances in future.result():
+                    if genes is None:
+                        continue
+                    if query in shared:
+                        families = [
+                            (member,) + select_family_distances(
+                                genes, distances, query_hits[member])
+                            for member in shared[query][1]]
+                    else:
+                        families = [(query, genes, distances)]
+                    for query, genes, distances in families:
+                        # Z-score normalize distance matrix and add results
+                        # to full distance matrix (for all genes)
+                        add_normalized_distances(
+                            species=[gene_map[gene] for gene in genes],
+                            distances=distances,
+                            full_distance_matrix=full_distance_matrix,
+                            num_species=num_species,
+                            full_distance_matrix_offset=offsets[query],
+                            species_set_dict=species_set_dict,
+                            gene_bitvector_map=gene_bitvector_map)
+                        done.append(offsets[query])
+                        if verbose:
+                            sys.stdout.write(
+                                "Computed MSA and distances for gene %s .. "
+                                "(%s/%s)\n" % (
+                                    query, len(done), total_genes))
+    finally:
+        if scratch_dir is not None:
+            rmtree(workspaces_dir, ignore_errors=True)
+    if failures:
+        if msa_failures_fp is None:
+            msa_failures_fp = join(working_dir, "msa_failures.tsv")
+        write_msa_failures(msa_failures_fp, failures)
+        sys.stdout.write(
+            "%s alignments of %s gene families failed (%s timed out), see "
+            "%s\n" % (len(failures), len(set(
+                failure[0] for failure in failures)), sum(
+                failure[5] == "timeout" for failure in failures),
+                msa_failures_fp))
+    return full_distance_matrix, species_set_dict, gene_bitvector_map, done
 
-          ..
-         [[0_0, 0_1, 0_2, .., 0_n]
-          [1_0, 1_1, 1_2, .., 1_n]
-          ..
-          [n_0, n_1, n_2, .., n_n]]]
 
-        The mean and standard deviation are computed for each species pair
-        including all genes.
-    """
-    numpy.around(full_distance_matrix, decimals=5, out=full_distance_matrix)
-    outlier_flag_matrix = numpy.zeros(
-        shape=(total_genes, num_species, num_species), dtype=bool)
-    distance_vector = numpy.zeros(total_genes)
-    if debug:
-        sys.stdout.write("[DEBUG] species_species\t")
-        for k in range(total_genes):
-            sys.stdout.write("gene # %s".ljust(12) % k)
-        sys.stdout.write("[low_bound, up_bound]\n")
-    for i in range(num_species):
-        for j in range(num_species):
-            if i != j:
-                for k in range(total_genes):
-                    distance_vector[k] = full_distance_matrix[k][i][j]
-                mean = numpy.nanmean(distance_vector)
-                stdev = numpy.nanstd(distance_vector)
-                low_bound = round(mean - stdev_offset*stdev, 5)
-                up_bound = round(mean + stdev_offset*stdev, 5)
-                if debug:
-                    sys.stdout.write("[DEBUG] %s_%s\t".ljust(20) % (i, j))
-                for k, distance in enumerate(distance_vector):
-                    spaces = "".ljust(2)
-                    if distance < 0:
-                        spaces = "".ljust(1)
-                    if (distance != numpy.nan and
-                       ((distance < low_bound) or (distance > up_bound))):
-                        outlier_flag_matrix[k][i][j] = 1
-                        if debug:
-                            sys.stdout.write(
-                                "%s\033[92m%s\033[0m" % (spaces, distance))
-                    elif debug:
-                        sys.stdout.write("%s%s" % (spaces, distance))
-                if debug:
-                    sys.stdout.write("\t[%s, %s]\n" % (low_bound, up_bound))
+def detect_hgts(full_distance_matrix,
+                species_set_dict,
+                gene_bitvector_map,
+                gene_id,
+                done,
+                num_species,
+                output_hgt_fp,
+                stdev_offset=2.326,
+                outlier_hgt=0.5,
+                species_set_size=30,
+                hamming_distance=2,
+                results_fp=None,
+                jobs=1,
+                debug=False,
+                memory=None):
+    """ Cluster gene families by species and output the outlier genes.
 
-    # traverse outlier_matrix by gene and count the number of outlier
-    # distances by species
-    outlier_count_matrix = numpy.zeros(
-        shape=(total_genes, num_species), dtype=int)
-    for i in range(total_genes):
-        for j in range(num_species):
-            for k in range(num_species):
-                if outlier_flag_matrix[i][j][k]:
-                    outlier_count_matrix[i][k] += 1
+    Parameters
+    ----------
+    full_distance_matrix: numpy.ndarray or SparseDistanceMatrix
+        normalized distances of each gene family
+    species_set_dict: dictionary
+        number of genes (values) of each species set (keys)
+    gene_bitvector_map: dictionary
+        binary indicator vector of each gene offset
+    gene_id: dictionary
+        query gene name of each gene offset
+    done: list
+        offsets of the genes with distances (the other genes are removed)
+    num_species: integer
+        number of species in the reference database
+    output_hgt_fp: string
+        filepath to output file for storing detected HGTs
+    stdev_offset, outlier_hgt, species_set_size, hamming_distance, debug:
+        see distance_method()
+    results_fp: string, optional
+        filepath to output file for storing the distances, clusters and
+        outlier counts (see write_results())
+    jobs: integer, optional
+        number of threads counting the outliers (see count_outliers())
+    memory: MemoryReport, optional
+        memory report updated after each stage
 
-    # if number of outlier distances exceeds threshold, label gene as outlier
-    outlier_genes = set()
-    for i in range(total_genes):
-        for j in range(num_species):
-            if outlier_count_matrix[i][j] > num_species*outlier_hgt:
-                outlier_genes.add(i)
+    Notes
+    -----
+        The outlier distances do not depend on the cluster of a gene, they
+        are counted once for all genes (count_outliers()) and the outlier
+        genes are output cluster by cluster.
+    """
+    if memory is None:
+        memory = MemoryReport()
+    total_genes = len(gene_id)
+    if len(done) < total_genes:
+        sys.stdout.write("Skipped %s gene families without MSA\n" % (
+            total_genes - len(done)))
+        full_distance_matrix, gene_bitvector_map, gene_id = compact_genes(
+            full_distance_matrix=full_distance_matrix,
+            gene_bitvector_map=gene_bitvector_map,
+            gene_id=gene_id,
+            keep=sorted(done))
+        total_genes = len(done)
+    memory.checkpoint("distance matrices")
 
-    return outlier_genes
+    # output_full_matrix(full_distance_matrix, num_species)
+
+    # cluster gene families by species
+    gene_clusters_list = cluster_distances(
+        species_set_dict=species_set_dict,
+        species_set_size=species_set_size,
+        hamming_distance=hamming_distance)
+    memory.checkpoint("clustering")
 
+    # detect outlier genes per core cluster of genes
+    outlier_count_matrix = count_outliers(
+        full_distance_matrix=full_distance_matrix,
+        stdev_offset=stdev_offset,
+        num_species=num_species,
+        total_genes=total_genes,
+        jobs=jobs,
+        debug=debug)
+    outlier_genes = set(numpy.nonzero(
+        (outlier_count_matrix > num_species*outlier_hgt).any(axis=1))[
+            0].tolist())
+    with open(output_hgt_fp, 'w') as output_hgt_f:
+        output_hgt_f.write("\n# Candidate HGT genes: \n")
+        for _, species_set in gene_clusters_list:
+            species_set = set(species_set)
+            for gene in sorted(outlier_genes):
+                if gene_bitvector_map[gene] in species_set:
+                    output_hgt_f.write("%s\n" % gene_id[gene])
+    memory.checkpoint("outlier detection")
+    if results_fp is not None:
+        write_results(results_fp=results_fp,
+                      full_distance_matrix=full_distance_matrix,
+                      gene_bitvector_map=gene_bitvector_map,
+                      gene_id=gene_id,
+                      gene_clusters_list=gene_clusters_list,
+                      outlier_count_matrix=outlier_count_matrix,
+                      outlier_genes=outlier_genes)
 
-def output_full_matrix(matrix, num_species):
-    """ Output distance matrix to stdout
-    """
-    for i in range(num_species):
-        for j in range(num_species):
-            # for gene number
-            for k in range(len(matrix)):
-                sys.stdout.write("%s\t" % matrix[k][i][j])
-            sys.stdout.write("\n")
+    # output_full_matrix(outlier_genes, num_species)
 
 
 def distance_method(query_proteome_fp,
@@ -839,13 +4567,47 @@ def distance_method(query_proteome_fp,
                     verbose=False,
                     debug=False,
                     warnings=False,
-                    timeout=120):
+                    timeout=120,
+                    memory_report=False,
+                    distance_dtype='float64',
+                    sparse_distances=False,
+                    protdist_batch_size=1,
+                    jobs=1,
+                    memory_budget=None,
+                    msa_software='clustalw',
+                    msa_fallback='clustalw-quicktree',
+                    msa_dir=None,
+                    msa_map_fp=None,
+                    distance_mode='protdist',
+                    kmer_size=3,
+                    reference_families_dir=None,
+                    prefilter_index_dir=None,
+                    prefilter_kmer_size=5,
+                    prefilter_min_shared_kmers=3,
+                    cdhit_identity=None,
+                    cdhit_across_species=False,
+                    min_pident=None,
+                    min_qcovs=None,
+                    min_length=None,
+                    min_bitscore=None,
+                    scratch_dir=None,
+                    dedup_families=False,
+                    max_timeout=None,
+                    msa_subsample_size=None,
+                    msa_failures_fp=None,
+                    calibration_fp=None,
+                    results_fp=None,
+                    kernels='auto',
+                    reference_panel=None,
+                    database_dir=None,
+                    manifest_fp=None):
     """ Run Distance Method algorithm
 
     Parameters
     ----------
     query_proteome_fp: string
-        filepath to query proteome
+        filepath to query proteome (the proteomes and the tabular alignments
+        may be gzip or zstd compressed, see open_input())
     target_proteomes_dir: string
         dirpath to target proteomes
     working_dir: string
@@ -886,191 +4648,1577 @@ def distance_method(query_proteome_fp,
     warnings: boolean, optional
         if True, output warnings
     timeout: integer, optional
-        number of seconds to allow Clustalw to run per call
+        number of seconds to allow the alignment software to run per call
+        for a gene family of 20 homologs of 400 residues or smaller (see
+        max_timeout)
+    memory_report: boolean, optional
+        if True, trace memory allocations and output the peak memory, each
+        stage's growth and the top allocation sites
+    distance_dtype: string, optional
+        floating point type used to store the normalized distance tensor
+        ('float64', 'float32' or 'float16'); outlier calls are made at 5
+        decimals, which float32 represents exactly enough to give the same
+        calls, while float16 keeps ~3 significant digits and should only be
+        used for screening
+    sparse_distances: boolean, optional
+        if True, store for each gene only the distances between the species
+        present in its gene family (see SparseDistanceMatrix)
+    protdist_batch_size: integer, optional
+        number of gene families whose MSAs are processed by a single protdist
+        run (using PHYLIP's multiple data sets option)
+    jobs: integer, optional
+        number of gene families (batches) aligned concurrently, of
+        processes reading the reference proteomes (see preprocess_data())
+        and of threads counting the outliers (see count_outliers())
+    memory_budget: integer, optional
+        maximum estimated memory (MB) of the gene families aligned
+        concurrently (see estimate_family_cost())
+    msa_software: string, optional
+        multiple sequence alignment software (see MSA_BACKENDS)
+    msa_fallback: string, optional
+        alignment software used to retry gene families whose alignment
+        failed or timed out (None to skip them)
+    msa_dir: string, optional
+        dirpath to precomputed MSAs of gene families; if given, the homology
+        search and alignment stages are skipped
+    msa_map_fp: string, optional
+        filepath to tab-separated file mapping query genes to the filenames
+        of their gene family MSAs in msa_dir (required with msa_dir)
+    distance_mode: string, optional
+        'protdist' to compute distances from MSAs using protdist, or 'kmer'
+        to compute alignment-free distances from k-mers (for screening)
+    kmer_size: integer, optional
+        k-mer length in 'kmer' distance mode
+    reference_families_dir: string, optional
+        dirpath to reference gene families (built from the target proteomes
+        on first use, see build_reference_families()); query genes are added
+        to their family's MSA by profile alignment and only their distances
+        are computed
+    prefilter_index_dir: string, optional
+        dirpath to the k-mer index of the target proteomes (built on first
+        use, see KmerIndex); if given, query genes which can not reach
+        min_num_homologs species are dropped before the homology search
+    prefilter_kmer_size: integer, optional
+        k-mer length of the prefilter index
+    prefilter_min_shared_kmers: integer, optional
+        the minimum number of k-mers shared by a query gene and a reference
+        gene for the prefilter to count the reference species
+    cdhit_identity: float, optional
+        if given, cluster the target proteomes' sequences at this identity
+        using CD-HIT, search only the representatives and expand their hits
+        to the cluster members (see reduce_redundancy())
+    cdhit_across_species: boolean, optional
+        if True, cluster the sequences of all target proteomes together
+        rather than within each proteome
+    min_pident: float, optional
+        the minimum percent identity of the homology search alignments
+    min_qcovs: float, optional
+        the minimum query coverage (percent) of the homology search
+        alignments, over all the alignments of a query and subject pair
+        (BLAST's qcovs, see HitFilter)
+    min_length: integer, optional
+        the minimum length of the homology search alignments
+    min_bitscore: float, optional
+        the minimum bit score of the homology search alignments
+    scratch_dir: string, optional
+        dirpath under which the per-family temporary files (MSA and protdist
+        input and output files) are written, e.g. a RAM-backed filesystem
+        such as /dev/shm; the files are removed at the end of the run (by
+        default, they are written to working_dir)
+    dedup_families: boolean, optional
+        if True, the reference homologs shared by several query genes (e.g.
+        paralogs) are aligned once and each query gene is added to their
+        MSA by profile alignment (see deduplicate_families()); this changes
+        the MSAs, and so the distances, of these query genes
+    max_timeout: integer, optional
+        the timeout of each gene family's alignment is scaled to the size of
+        the family, from timeout up to max_timeout seconds (by default, 10
+        times timeout; max_timeout equal to timeout disables the scaling,
+        see family_timeout())
+    msa_subsample_size: integer, optional
+        if given, gene families whose alignment failed with msa_software and
+        msa_fallback are aligned again with their msa_subsample_size best
+        homologs (see subsample_family())
+    msa_failures_fp: string, optional
+        filepath to the record of the gene families whose alignment failed
+        or timed out (default working_dir/msa_failures.tsv)
+    calibration_fp: string, optional
+        if given, the sizes, stage times and peak memory of the run are
+        appended to this calibration table of the run estimator (see
+        write_calibration() and estimate_run())
+    results_fp: string, optional
+        filepath to output file for storing the normalized distances,
+        species sets, clusters and outlier counts of the genes in NumPy
+        .npz format (see write_results())
+    kernels: string, optional
+        implementation of the inner loops of the normalization, clustering
+        and outlier detection stages, one of KERNEL_MODES (see
+        set_kernels())
+    reference_panel: ReferencePanel, optional
+        target proteomes already parsed (e.g. by a long-running service),
+        used instead of parsing target_proteomes_dir
+    database_dir: string, optional
+        dirpath to the search databases and reduced proteomes, which are
+        reused by later runs (default working_dir)
+    manifest_fp: string, optional
+        if given, stop after the homology search and filtering and write the
+        gene family work units to manifest_fp (plan step, see run_shard()
+        and reduce_shards())
     """
+    if distance_dtype not in DISTANCE_DTYPES:
+        raise ValueError(
+            "Distance type not supported: %s" % distance_dtype)
+    if jobs < 1 or protdist_batch_size < 1:
+        raise ValueError(
+            "jobs and protdist_batch_size must be positive: %s, %s" % (
+                jobs, protdist_batch_size))
+    if msa_software not in MSA_BACKENDS or (
+            msa_fallback is not None and msa_fallback not in MSA_BACKENDS):
+        raise ValueError(
+            "Alignment software not supported: %s, %s" % (
+                msa_software, msa_fallback))
+    if max_timeout is not None and max_timeout < timeout:
+        raise ValueError("max_timeout must be at least timeout: %s, %s" % (
+            max_timeout, timeout))
+    if msa_subsample_size is not None and msa_subsample_size < 2:
+        raise ValueError(
+            "msa_subsample_size must be at least 2: %s" % msa_subsample_size)
+    if distance_mode not in DISTANCE_MODES:
+        raise ValueError("Distance mode not supported: %s" % distance_mode)
+    if distance_mode != 'kmer':
+        kmer_size = None
+    else:
+        check_kmer_size(kmer_size, 'kmer_size')
+    if prefilter_index_dir is not None:
+        check_kmer_size(prefilter_kmer_size, 'prefilter_kmer_size')
+    if reference_families_dir is not None and (
+            msa_dir is not None or distance_mode != 'protdist'):
+        raise ValueError("Reference families can not be combined with "
+                         "precomputed MSAs or the k-mer distance mode")
+    if msa_dir is not None and msa_map_fp is None:
+        raise ValueError("msa_map_fp is required with msa_dir")
+    kernels = set_kernels(kernels)
+    memory = MemoryReport(enabled=memory_report)
     if verbose:
         sys.stdout.write(
             "Begin whole-genome HGT detection using the Distance method.\n\n")
         sys.stdout.write("Query genome: %s\n" % query_proteome_fp)
+        sys.stdout.write("Kernels: %s\n" % kernels)
+
+    extensions = set(['fa', 'fasta', 'faa'])
+    extensions.update(ext)
+
+    # create working directory if doesn't exist
+    if not isdir(working_dir):
+        mkdir(working_dir)
+
+    if reference_panel is not None:
+        gene_map, ref_db, num_species = reference_panel.copy(
+            target_proteomes_dir=target_proteomes_dir,
+            extensions=extensions)
+    else:
+        gene_map, ref_db, num_species = preprocess_data(
+            working_dir=working_dir,
+            target_proteomes_dir=target_proteomes_dir,
+            extensions=extensions,
+            jobs=jobs,
+            verbose=verbose)
+    memory.checkpoint("preprocess_data")
+
+    if debug:
+        sys.stdout.write("\n[DEBUG] gene map:\n")
+        for gene in gene_map:
+            sys.stdout.write("[DEBUG] %s: %s\n" % (gene, gene_map[gene]))
+
+    kmer_index = None
+    if prefilter_index_dir is not None:
+        if KmerIndex.exists(prefilter_index_dir):
+            kmer_index = KmerIndex(prefilter_index_dir)
+        # rebuild an index of another k, of different target proteomes or
+        # older than one of them
+        if kmer_index is None or (
+                kmer_index.k, kmer_index.num_genes,
+                kmer_index.num_species) != (
+                prefilter_kmer_size, len(ref_db), num_species) or (
+                not kmer_index.up_to_date(list_proteomes(
+                    target_proteomes_dir, extensions))):
+            if verbose:
+                sys.stdout.write("\nBuilding k-mer prefilter index ..\n")
+            kmer_index = KmerIndex.build(index_dir=prefilter_index_dir,
+                                         gene_map=gene_map,
+                                         ref_db=ref_db,
+                                         num_species=num_species,
+                                         k=prefilter_kmer_size)
+
+    hit_filter = HitFilter(min_pident=min_pident,
+                           min_qcovs=min_qcovs,
+                           min_length=min_length,
+                           min_bitscore=min_bitscore)
+    search_proteomes_dir = target_proteomes_dir
+    cluster_map = None
+    if cdhit_identity is not None and tabular_alignments_fp is None and (
+            msa_dir is None):
+        if verbose:
+            sys.stdout.write("\nRunning CD-HIT ..\n")
+        search_proteomes_dir, cluster_map = reduce_redundancy(
+            target_proteomes_dir=target_proteomes_dir,
+            extensions=extensions,
+            working_dir=(working_dir if database_dir is None
+                         else database_dir),
+            identity=cdhit_identity,
+            across_species=cdhit_across_species,
+            threads=threads,
+            verbose=verbose,
+            debug=debug)
+        memory.checkpoint("redundancy reduction")
+
+    reference_families = None
+    if reference_families_dir is not None:
+        if not exists(join(reference_families_dir, "families.tsv")):
+            if verbose:
+                sys.stdout.write("\nBuilding reference gene families ..\n")
+            reference_hits = {}
+            for _file in list_proteomes(target_proteomes_dir, extensions):
+                homology_search(query_proteome_fp=_file,
+                                target_proteomes_dir=search_proteomes_dir,
+                                extensions=extensions,
+                                working_dir=working_dir,
+                                align_software=align_software,
+                                hits=reference_hits,
+                                gene_map=gene_map,
+                                e_value=e_value,
+                                threads=threads,
+                                debug=debug,
+                                cluster_map=cluster_map,
+                                hit_filter=hit_filter,
+                                database_dir=database_dir)
+            build_reference_families(
+                families_dir=reference_families_dir,
+                hits=reference_hits,
+                gene_map=gene_map,
+                ref_db=ref_db,
+                min_num_homologs=min_num_homologs,
+                msa_backend=MSA_BACKENDS[msa_software],
+                timeout=timeout,
+                warnings=warnings,
+                verbose=verbose)
+        reference_families = ReferenceFamilies(reference_families_dir)
+        if verbose:
+            sys.stdout.write("Reference gene families: %s\n" % len(
+                reference_families))
+
+    # a query proteome outside the target proteomes (ex. posted to the
+    # service) is added as a new species
+    panel_species = num_species
+    num_species = add_query_proteome(
+        query_proteome_fp=query_proteome_fp,
+        gene_map=gene_map,
+        ref_db=ref_db,
+        num_species=num_species)
+    if verbose and num_species > panel_species:
+        sys.stdout.write("Query proteome added as species %s\n" % (
+            num_species))
+
+    hits = {}
+    alignments = None
+    search_start = time.time()
+
+    # precomputed MSAs provided
+    if msa_dir is not None:
+        if verbose:
+            sys.stdout.write("\nReading precomputed MSAs ..\n")
+        alignments = {}
+        parse_precomputed_msas(msa_dir=msa_dir,
+                               msa_map_fp=msa_map_fp,
+                               hits=hits,
+                               alignments=alignments,
+                               gene_map=gene_map,
+                               debug=debug)
+    # tabular alignments provided
+    elif tabular_alignments_fp is not None:
+        if verbose:
+            sys.stdout.write("\nRunning BLASTp ..\n")
+        # generate a dictionary of orthologous genes
+        parse_blast(alignments_fp=tabular_alignments_fp,
+                    hits=hits,
+                    gene_map=gene_map,
+                    debug=debug,
+                    hit_filter=hit_filter)
+    # tabular alignments to be created
+    else:
+        search_query_fp = query_proteome_fp
+        kept = 1
+        if kmer_index is not None:
+            search_query_fp = join(working_dir, "query_prefiltered.faa")
+            kept, dropped = prefilter_query_proteome(
+                query_proteome_fp=query_proteome_fp,
+                output_fp=search_query_fp,
+                kmer_index=kmer_index,
+                min_num_homologs=min_num_homologs,
+                min_shared_kmers=prefilter_min_shared_kmers,
+                debug=debug)
+            if verbose:
+                sys.stdout.write(
+                    "\nK-mer prefilter: kept %s query genes, dropped %s\n" % (
+                        kept, dropped))
+        if verbose:
+            sys.stdout.write("\nRunning BLASTp ..\n")
+        if kept:
+            homology_search(query_proteome_fp=search_query_fp,
+                            target_proteomes_dir=search_proteomes_dir,
+                            extensions=extensions,
+                            working_dir=working_dir,
+                            align_software=align_software,
+                            hits=hits,
+                            gene_map=gene_map,
+                            e_value=e_value,
+                            threads=threads,
+                            debug=debug,
+                            cluster_map=cluster_map,
+                            hit_filter=hit_filter,
+                            database_dir=database_dir)
+    # the search databases do not hold a query proteome outside the target
+    # proteomes, add each query gene to its own gene family
+    if num_species > panel_species and alignments is None and (
+            reference_families is None):
+        for query in hits:
+            if query not in hits[query]:
+                hits[query].insert(0, query)
+    memory.checkpoint("homology search")
+    search_seconds = time.time() - search_start
+    if verbose and hit_filter:
+        hit_filter.report()
+
+    # keep only genes with >= min_num_homologs
+    hits_min_num_homologs, max_homologs = filter_homologs(
+        hits=hits,
+        min_num_homologs=min_num_homologs,
+        alignments=alignments)
+    hits.clear()
+    memory.checkpoint("homolog filtering")
+
+    if verbose:
+        sys.stdout.write(
+            "Total number of orthologous gene families with at "
+            "least %s genes: %s\n" % (
+                min_num_homologs, len(hits_min_num_homologs)))
+    if debug:
+        sys.stdout.write("[DEBUG] Blast matches:\n")
+        for query in hits_min_num_homologs:
+            sys.stdout.write(
+                "[DEBUG] %s: %s\n" % (query, hits_min_num_homologs[query]))
+    total_genes = len(hits_min_num_homologs)
+    if verbose and manifest_fp is None:
+        if reference_families is not None:
+            sys.stdout.write(
+                "\nAdding query genes to reference families ..\n")
+        elif kmer_size is not None:
+            sys.stdout.write("\nComputing %s-mer distances ..\n" % kmer_size)
+        else:
+            sys.stdout.write("\nRunning %s ..\n" % (
+                "PROTDIST" if alignments is not None
+                else "%s and PROTDIST" % msa_software))
+    if max_homologs > num_species:
+        raise ValueError(
+            "max_homologs > num_species: %s > %s " % (
+                max_homologs, num_species))
+    gene_id = dict(enumerate(hits_min_num_homologs))
+    if manifest_fp is not None:
+        write_manifest(manifest_fp=manifest_fp,
+                       hits=hits_min_num_homologs,
+                       gene_map=gene_map,
+                       ref_db=ref_db,
+                       num_species=num_species,
+                       alignments=alignments,
+                       reference_families=reference_families,
+                       settings={
+                           'timeout': timeout,
+                           'max_timeout': max_timeout,
+                           'msa_subsample_size': msa_subsample_size,
+                           'distance_dtype': distance_dtype,
+                           'sparse_distances': sparse_distances,
+                           'protdist_batch_size': protdist_batch_size,
+                           'msa_software': msa_software,
+                           'msa_fallback': msa_fallback,
+                           'kmer_size': kmer_size,
+                           'dedup_families': dedup_families,
+                           'reference_families_dir': reference_families_dir,
+                           'stdev_offset': stdev_offset,
+                           'outlier_hgt': outlier_hgt,
+                           'species_set_size': species_set_size,
+                           'hamming_distance': hamming_distance})
+        if verbose:
+            sys.stdout.write("Wrote %s work units to %s\n" % (
+                total_genes, manifest_fp))
+        return
+    msa_start = time.time()
+    full_distance_matrix, species_set_dict, gene_bitvector_map, done = \
+        compute_family_distances(hits=hits_min_num_homologs,
+                                 gene_map=gene_map,
+                                 ref_db=ref_db,
+                                 num_species=num_species,
+                                 working_dir=working_dir,
+                                 timeout=timeout,
+                                 distance_dtype=distance_dtype,
+                                 sparse_distances=sparse_distances,
+                                 protdist_batch_size=protdist_batch_size,
+                                 jobs=jobs,
+                                 memory_budget=memory_budget,
+                                 msa_software=msa_software,
+                                 msa_fallback=msa_fallback,
+                                 alignments=alignments,
+                                 kmer_size=kmer_size,
+                                 reference_families=reference_families,
+                                 scratch_dir=scratch_dir,
+                                 dedup_families=dedup_families,
+                                 max_timeout=max_timeout,
+                                 msa_subsample_size=msa_subsample_size,
+                                 msa_failures_fp=msa_failures_fp,
+                                 warnings=warnings,
+                                 verbose=verbose,
+                                 debug=debug)
+    if calibration_fp is not None:
+        query_lengths = [length for _, length in scan_proteome(
+            query_proteome_fp)]
+        costs = [estimate_family_cost(
+            [ref_db[ref] for ref in hits_min_num_homologs[query]])
+            for query in hits_min_num_homologs]
+        write_calibration(calibration_fp, {
+            'align_software': align_software,
+            'msa_software': msa_software,
+            'jobs': jobs,
+            'query_genes': len(query_lengths),
+            'query_residues': sum(query_lengths),
+            'num_species': num_species,
+            'target_sequences': len(ref_db),
+            'target_residues': sum(len(seq) for seq in ref_db.values()),
+            'families': total_genes,
+            'family_cost': sum(cost for cost, _ in costs),
+            'max_family_memory': max([memory for _, memory in costs] or [0]),
+            'tensor_bytes': full_distance_matrix.nbytes,
+            'search_seconds': "%.3f" % (
+                search_seconds if tabular_alignments_fp is None and (
+                    msa_dir is None) else 0),
+            'msa_seconds': "%.3f" % (
+                time.time() - msa_start if alignments is None and (
+                    kmer_size is None and reference_families is None)
+                else 0),
+            'peak_memory': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss*1024})
+    detect_hgts(full_distance_matrix=full_distance_matrix,
+                species_set_dict=species_set_dict,
+                gene_bitvector_map=gene_bitvector_map,
+                gene_id=gene_id,
+                done=done,
+                num_species=num_species,
+                output_hgt_fp=output_hgt_fp,
+                stdev_offset=stdev_offset,
+                outlier_hgt=outlier_hgt,
+                species_set_size=species_set_size,
+                hamming_distance=hamming_distance,
+                results_fp=results_fp,
+                jobs=jobs,
+                debug=debug,
+                memory=memory)
+    memory.report()
+
+
+def screen_all_vs_all(target_proteomes_dir,
+                      working_dir,
+                      output_dir,
+                      align_software,
+                      tabular_alignments_fp=None,
+                      ext=[],
+                      min_num_homologs=3,
+                      e_value=10e-20,
+                      threads=1,
+                      stdev_offset=2.326,
+                      outlier_hgt=0.5,
+                      species_set_size=30,
+                      hamming_distance=2,
+                      verbose=False,
+                      debug=False,
+                      warnings=False,
+                      timeout=120,
+                      distance_dtype='float64',
+                      protdist_batch_size=1,
+                      jobs=1,
+                      memory_budget=None,
+                      msa_software='clustalw',
+                      msa_fallback='clustalw-quicktree',
+                      distance_mode='protdist',
+                      kmer_size=3,
+                      min_pident=None,
+                      min_qcovs=None,
+                      min_length=None,
+                      min_bitscore=None,
+                      max_timeout=None,
+                      msa_subsample_size=None,
+                      scratch_dir=None,
+                      database_dir=None,
+                      save_results=False,
+                      kernels='auto'):
+    """ Screen every genome of a panel against all the other genomes.
+
+    Parameters
+    ----------
+    target_proteomes_dir: string
+        dirpath to the proteomes of the panel (each genome is the query of
+        one screen)
+    working_dir: string
+        dirpath to working directory
+    output_dir: string
+        dirpath to the output files storing the detected HGTs of each
+        genome (<genome>.hgt.txt)
+    tabular_alignments_fp: string, optional
+        filepath to the tabular sequence alignments of all the proteomes
+        against each other
+    align_software, ext, min_num_homologs, e_value, threads, stdev_offset,
+    outlier_hgt, species_set_size, hamming_distance, verbose, debug,
+    warnings, timeout, distance_dtype, protdist_batch_size, jobs,
+    memory_budget, msa_software, msa_fallback, distance_mode, kmer_size,
+    min_pident, min_qcovs, min_length, min_bitscore, max_timeout,
+    msa_subsample_size, scratch_dir, database_dir, kernels:
+        see distance_method()
+    save_results: boolean, optional
+        if True, the distances, clusters and outlier counts of each genome
+        are also stored in output_dir (<genome>.results.npz, see
+        write_results())
+
+    Notes
+    -----
+        The proteomes are searched once, all together, against the panel
+        and the gene families of all genomes are aligned in a single pass.
+        Each genome is excluded from its own reference set: the gene family
+        of a query gene holds the query gene and its best homologs in the
+        other genomes only, never a paralog. The overlapping gene families
+        of orthologs are aligned together once, so the distances of their
+        reference pairs are computed once for all genomes (see
+        share_families()). Each genome's genes are then stored in their own
+        distance tensor and its outliers are detected in parallel with the
+        other genomes (jobs).
+    """
+    if distance_mode not in DISTANCE_MODES:
+        raise ValueError("Distance mode not supported: %s" % distance_mode)
+    if distance_mode != 'kmer':
+        kmer_size = None
+    else:
+        check_kmer_size(kmer_size, 'kmer_size')
+    set_kernels(kernels)
+    extensions = set(['fa', 'fasta', 'faa'])
+    extensions.update(ext)
+    for dp in [working_dir, output_dir]:
+        if not isdir(dp):
+            mkdir(dp)
+    gene_map, ref_db, num_species = preprocess_data(
+        working_dir=working_dir,
+        target_proteomes_dir=target_proteomes_dir,
+        extensions=extensions,
+        jobs=jobs,
+        verbose=verbose)
+    hit_filter = HitFilter(min_pident=min_pident,
+                           min_qcovs=min_qcovs,
+                           min_length=min_length,
+                           min_bitscore=min_bitscore)
+    hits = {}
+    if tabular_alignments_fp is not None:
+        parse_blast(alignments_fp=tabular_alignments_fp,
+                    hits=hits,
+                    gene_map=gene_map,
+                    debug=debug,
+                    hit_filter=hit_filter)
+    else:
+        # one search of all the proteomes against each proteome's database
+        panel_fp = join(working_dir, "panel_proteomes.faa")
+        with open(panel_fp, 'w') as panel_f:
+            for label, seq in ref_db.items():
+                panel_f.write(">%s\n%s\n" % (label, seq))
+        if verbose:
+            sys.stdout.write("\nRunning all-vs-all homology search ..\n")
+        homology_search(query_proteome_fp=panel_fp,
+                        target_proteomes_dir=target_proteomes_dir,
+                        extensions=extensions,
+                        working_dir=working_dir,
+                        align_software=align_software,
+                        hits=hits,
+                        gene_map=gene_map,
+                        e_value=e_value,
+                        threads=threads,
+                        debug=debug,
+                        hit_filter=hit_filter,
+                        database_dir=database_dir)
+    if verbose and hit_filter:
+        hit_filter.report()
+    # exclude each genome from its own reference set
+    for query in hits:
+        hits[query] = [query] + [ref for ref in hits[query]
+                                 if gene_map[ref] != gene_map[query]]
+    hits_min_num_homologs, _ = filter_homologs(
+        hits=hits, min_num_homologs=min_num_homologs)
+    hits.clear()
+    # store the genes of each genome contiguously, in proteome order
+    order = dict((gene, i) for i, gene in enumerate(ref_db))
+    genome_hits = OrderedDict(sorted(
+        hits_min_num_homologs.items(), key=lambda item: order[item[0]]))
+    full_distance_matrix, _, gene_bitvector_map, done = \
+        compute_family_distances(hits=genome_hits,
+                                 gene_map=gene_map,
+                                 ref_db=ref_db,
+                                 num_species=num_species,
+                                 working_dir=working_dir,
+                                 timeout=timeout,
+                                 distance_dtype=distance_dtype,
+                                 protdist_batch_size=protdist_batch_size,
+                                 jobs=jobs,
+                                 memory_budget=memory_budget,
+                                 msa_software=msa_software,
+                                 msa_fallback=msa_fallback,
+                                 kmer_size=kmer_size,
+                                 scratch_dir=scratch_dir,
+                                 shared_families=True,
+                                 max_timeout=max_timeout,
+                                 msa_subsample_size=msa_subsample_size,
+                                 warnings=warnings,
+                                 verbose=verbose,
+                                 debug=debug)
+    done = set(done)
+    queries = list(genome_hits)
+    genome_ranges = {}
+    for offset, query in enumerate(queries):
+        species = gene_map[query]
+        start, _ = genome_ranges.get(species, (offset, offset))
+        genome_ranges[species] = (start, offset + 1)
+
+    def screen_genome(species, _file):
+        name = splitext(basename(strip_compression(_file)))[0]
+        output_hgt_fp = join(output_dir, "%s.hgt.txt" % name)
+        start, end = genome_ranges.get(species, (0, 0))
+        genome_done = [offset - start for offset in range(start, end)
+                       if offset in done]
+        if not genome_done:
+            with open(output_hgt_fp, 'w') as output_hgt_f:
+                output_hgt_f.write("\n# Candidate HGT genes: \n")
+            return output_hgt_fp
+        species_set_dict = {}
+        genome_bitvector_map = {}
+        for offset in genome_done:
+            bitvector = gene_bitvector_map[start + offset]
+            genome_bitvector_map[offset] = bitvector
+            species_set_dict[bitvector] = species_set_dict.get(
+                bitvector, 0) + 1
+        detect_hgts(full_distance_matrix=full_distance_matrix[start:end],
+                    species_set_dict=species_set_dict,
+                    gene_bitvector_map=genome_bitvector_map,
+                    gene_id=dict(enumerate(queries[start:end])),
+                    done=genome_done,
+                    num_species=num_species,
+                    output_hgt_fp=output_hgt_fp,
+                    stdev_offset=stdev_offset,
+                    outlier_hgt=outlier_hgt,
+                    species_set_size=species_set_size,
+                    hamming_distance=hamming_distance,
+                    results_fp=join(output_dir, "%s.results.npz" % name)
+                    if save_results else None,
+                    debug=debug)
+        return output_hgt_fp
+
+    # detect the outliers of each genome in parallel
+    files = list_proteomes(target_proteomes_dir, extensions)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(screen_genome, species, _file)
+                   for species, _file in enumerate(files)]
+        for future in as_completed(futures):
+            output_hgt_fp = future.result()
+            if verbose:
+                sys.stdout.write("Wrote %s\n" % output_hgt_fp)
+
+
+def write_manifest(manifest_fp,
+                   hits,
+                   gene_map,
+                   ref_db,
+                   num_species,
+                   settings,
+                   alignments=None,
+                   reference_families=None):
+    """ Write the gene family work units of a distance_method() run.
+
+    Parameters
+    ----------
+    manifest_fp: string
+        filepath to the manifest (JSON format)
+    hits: dictionary
+        dictionary storing query (gene) names as keys and their gene family
+        as values, in the order the genes are stored in the distance matrix
+    gene_map: dictionary
+        dictionary storing gene names as keys and the index of their
+        species as values
+    ref_db: dictionary
+        dictionary storing FASTA label as key and sequence as value for the
+        reference databases
+    num_species: integer
+        number of species in the reference database
+    settings: dictionary
+        distance_method() options used by the work units and the reduce step
+    alignments: dictionary, optional
+        precomputed MSAs of the gene families
+    reference_families: ReferenceFamilies, optional
+        reference gene families the query genes are added to
+
+    Notes
+    -----
+        Work unit i is the gene family of the gene stored at offset i of
+        the distance matrix. The manifest holds the sequences and species of
+        the genes of the work units (and of the members of their reference
+        families), so that workers do not parse the target proteomes.
+    """
+    units = []
+    sequences = {}
+    genes = set()
+    for query in hits:
+        unit = {'query': query, 'genes': hits[query]}
+        if alignments is not None:
+            unit['alignment'] = alignments[query]
+            genes.update(label for label, _ in alignments[query])
+        units.append(unit)
+        for gene in [query] + hits[query]:
+            sequences[gene] = str(ref_db[gene])
+        if reference_families is not None:
+            family = reference_families.find_family(hits[query])
+            if family is not None:
+                genes.update(reference_families.members[family])
+    genes.update(sequences)
+    with open(manifest_fp, 'w') as manifest_f:
+        json.dump({'num_species': num_species,
+                   'settings': settings,
+                   'gene_map': dict((gene, gene_map[gene])
+                                    for gene in genes if gene in gene_map),
+                   'sequences': sequences,
+                   'units': units}, manifest_f)
+
+
+def read_manifest(manifest_fp):
+    """ Read the work units written by write_manifest().
+
+    Returns
+    -------
+    manifest: dictionary
+        num_species, settings, gene_map, ref_db (sequences of the work
+        units), hits (gene family of each work unit, in work unit order)
+        and alignments (precomputed MSAs, or None)
+    """
+    with open(manifest_fp, 'r') as manifest_f:
+        manifest = json.load(manifest_f)
+    units = manifest.pop('units')
+    manifest['ref_db'] = manifest.pop('sequences')
+    manifest['hits'] = OrderedDict(
+        (unit['query'], unit['genes']) for unit in units)
+    manifest['alignments'] = None
+    if units and 'alignment' in units[0]:
+        manifest['alignments'] = dict(
+            (unit['query'], [tuple(row) for row in unit['alignment']])
+            for unit in units)
+    return manifest
+
+
+def shard_range(num_units, shard_index, num_shards):
+    """ Return the [start, end) work unit range of a shard.
+
+    Parameters
+    ----------
+    num_units: integer
+        number of work units in the manifest
+    shard_index: integer
+        index of the shard (0 to num_shards - 1, e.g. an array job's task
+        index)
+    num_shards: integer
+        number of shards the work units are split into
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError("Shard index out of range: %s of %s" % (
+            shard_index, num_shards))
+    return (num_units * shard_index // num_shards,
+            num_units * (shard_index + 1) // num_shards)
+
+
+def run_shard(manifest_fp,
+              working_dir,
+              partial_fp,
+              start=0,
+              end=None,
+              jobs=1,
+              memory_budget=None,
+              scratch_dir=None,
+              warnings=False,
+              verbose=False,
+              debug=False,
+              kernels='auto'):
+    """ Compute the distances of a range of work units of a manifest.
+
+    Parameters
+    ----------
+    manifest_fp: string
+        filepath to the manifest written by the plan step (see
+        distance_method())
+    working_dir: string
+        dirpath to working directory of the worker
+    partial_fp: string
+        filepath to the partial distances output (.npz)
+    start: integer, optional
+        index of the first work unit
+    end: integer, optional
+        index after the last work unit (default all remaining units)
+    jobs, memory_budget, scratch_dir, warnings, verbose, debug, kernels:
+        see distance_method()
+
+    Notes
+    -----
+        The partial output stores the offsets of the genes with distances
+        (offsets), their binary indicator vectors (bitvectors) and their
+        normalized distance matrices: dense (distances), or packed as in
+        write_results() if the run stores sparse distances (see
+        pack_distances()). See reduce_shards().
+    """
+    set_kernels(kernels)
+    manifest = read_manifest(manifest_fp)
+    settings = manifest['settings']
+    queries = list(manifest['hits'])[start:end]
+    hits = OrderedDict(
+        (query, manifest['hits'][query]) for query in queries)
+    reference_families = None
+    if settings['reference_families_dir'] is not None:
+        reference_families = ReferenceFamilies(
+            settings['reference_families_dir'])
+    if not isdir(working_dir):
+        mkdir(working_dir)
+    full_distance_matrix, _, gene_bitvector_map, done = \
+        compute_family_distances(
+            hits=hits,
+            gene_map=manifest['gene_map'],
+            ref_db=manifest['ref_db'],
+            num_species=manifest['num_species'],
+            working_dir=working_dir,
+            timeout=settings['timeout'],
+            distance_dtype=settings['distance_dtype'],
+            sparse_distances=settings['sparse_distances'],
+            protdist_batch_size=settings['protdist_batch_size'],
+            jobs=jobs,
+            memory_budget=memory_budget,
+            msa_software=settings['msa_software'],
+            msa_fallback=settings['msa_fallback'],
+            alignments=manifest['alignments'],
+            kmer_size=settings['kmer_size'],
+            reference_families=reference_families,
+            scratch_dir=scratch_dir,
+            dedup_families=settings['dedup_families'],
+            max_timeout=settings['max_timeout'],
+            msa_subsample_size=settings['msa_subsample_size'],
+            warnings=warnings,
+            verbose=verbose,
+            debug=debug)
+    done.sort()
+    partial = {'offsets': numpy.array(done, dtype=int) + start,
+               'bitvectors': numpy.array(
+                   [gene_bitvector_map[offset] for offset in done],
+                   dtype='U%s' % max(manifest['num_species'], 1))}
+    if isinstance(full_distance_matrix, SparseDistanceMatrix):
+        partial.update(pack_distances(full_distance_matrix, done))
+    else:
+        partial['distances'] = full_distance_matrix[done]
+    numpy.savez(partial_fp, **partial)
+    if verbose:
+        sys.stdout.write("Computed distances of %s of %s work units\n" % (
+            len(done), len(hits)))
+
+
+def reduce_shards(manifest_fp,
+                  partial_fps,
+                  output_hgt_fp,
+                  results_fp=None,
+                  jobs=1,
+                  verbose=False,
+                  debug=False,
+                  kernels='auto'):
+    """ Merge the partial distances of all shards and output HGTs.
+
+    Parameters
+    ----------
+    manifest_fp: string
+        filepath to the manifest written by the plan step
+    partial_fps: list
+        filepaths to the partial distances output by run_shard()
+    output_hgt_fp: string
+        filepath to output file for storing detected HGTs
+    results_fp, jobs, verbose, debug, kernels:
+        see distance_method()
+    """
+    set_kernels(kernels)
+    manifest = read_manifest(manifest_fp)
+    settings = manifest['settings']
+    num_species = manifest['num_species']
+    gene_id = dict(enumerate(manifest['hits']))
+    total_genes = len(gene_id)
+    if settings['sparse_distances']:
+        full_distance_matrix = SparseDistanceMatrix(
+            total_genes, num_species, dtype=settings['distance_dtype'])
+    else:
+        full_distance_matrix = numpy.zeros(
+            shape=(total_genes, num_species, num_species),
+            dtype=settings['distance_dtype'])
+    species_set_dict = {}
+    gene_bitvector_map = {}
+    done = set()
+    for partial_fp in partial_fps:
+        with numpy.load(partial_fp) as partial:
+            if 'packed_distances' in partial:
+                partial_distances = unpack_distances(
+                    partial['species'], partial['species_offsets'],
+                    partial['packed_distances'])
+            else:
+                partial_distances = partial['distances']
+            for offset, distances, bitvector in zip(
+                    partial['offsets'], partial_distances,
+                    partial['bitvectors']):
+                offset = int(offset)
+                bitvector = str(bitvector)
+                if offset in done:
+                    raise ValueError(
+                        "Work unit %s found in several partial outputs" % (
+                            offset))
+                done.add(offset)
+                if isinstance(distances, tuple):
+                    full_distance_matrix.set_gene(offset, *distances)
+                elif isinstance(full_distance_matrix, SparseDistanceMatrix):
+                    species = numpy.array([i for i, c in enumerate(bitvector)
+                                           if c == 'I'], dtype=int)
+                    full_distance_matrix.set_gene(
+                        offset, species,
+                        distances[numpy.ix_(species, species)])
+                else:
+                    full_distance_matrix[offset] = distances
+                gene_bitvector_map[offset] = bitvector
+                species_set_dict[bitvector] = species_set_dict.get(
+                    bitvector, 0) + 1
+    if verbose:
+        sys.stdout.write("Merged distances of %s of %s work units\n" % (
+            len(done), total_genes))
+    detect_hgts(full_distance_matrix=full_distance_matrix,
+                species_set_dict=species_set_dict,
+                gene_bitvector_map=gene_bitvector_map,
+                gene_id=gene_id,
+                done=sorted(done),
+                num_species=num_species,
+                output_hgt_fp=output_hgt_fp,
+                stdev_offset=settings['stdev_offset'],
+                outlier_hgt=settings['outlier_hgt'],
+                species_set_size=settings['species_set_size'],
+                hamming_distance=settings['hamming_distance'],
+                results_fp=results_fp,
+                jobs=jobs,
+                debug=debug)
+
+
+def _format_duration(seconds):
+    """ Format a number of seconds as hours, minutes and seconds.
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%d s" % seconds
+    if seconds < 3600:
+        return "%d min %d s" % divmod(seconds, 60)
+    return "%d h %d min" % (seconds // 3600, seconds % 3600 // 60)
+
+
+# fields of the calibration table of the run estimator, one row per
+# instrumented run (see write_calibration() and estimate_run())
+CALIBRATION_FIELDS = ['align_software', 'msa_software', 'jobs',
+                      'query_genes', 'query_residues', 'num_species',
+                      'target_sequences', 'target_residues', 'families',
+                      'family_cost', 'max_family_memory', 'tensor_bytes',
+                      'search_seconds', 'msa_seconds', 'peak_memory']
+# rough rates used without a calibration table: seconds per pair of query
+# and target residues (homology search) and per unit of family cost (see
+# estimate_family_cost(), MSA and protdist)
+DEFAULT_SEARCH_RATES = {'blast': 4e-11, 'diamond': 4e-13}
+DEFAULT_MSA_RATES = {'clustalw': 3e-8, 'clustalw-quicktree': 1e-8,
+                     'mafft': 5e-9, 'muscle': 1e-8, 'clustalo': 5e-9}
+# fraction of the query genes with enough homologs and fraction of the
+# species in a gene family, used without tabular alignments
+DEFAULT_FAMILY_FRACTION = 0.5
+DEFAULT_HOMOLOG_FRACTION = 0.5
+# memory of the interpreter and libraries, and of each reference sequence
+# (the Protein object and its label) and residue held in memory
+BASE_MEMORY = 100*1024*1024
+SEQUENCE_MEMORY = 2048
+RESIDUE_MEMORY = 4
+
+
+def scan_proteome(proteome_fp):
+    """ Read the labels and lengths of the sequences of a proteome.
+
+    Parameters
+    ----------
+    proteome_fp: string
+        filepath to the proteome in FASTA format (possibly compressed, see
+        open_input())
+
+    Returns
+    -------
+    lengths: list of tuples
+        (label, length) of each sequence
+    """
+    lengths = []
+    with open_input(proteome_fp) as proteome_f:
+        for line in proteome_f:
+            if line.startswith('>'):
+                lengths.append([line[1:].split()[0], 0])
+            elif lengths:
+                lengths[-1][1] += len(line.strip())
+    return [(label, length) for label, length in lengths]
+
+
+def predict_memory(target_sequences, target_residues, tensor_bytes,
+                   max_family_memory, jobs):
+    """ Predict the peak memory of a run (before calibration).
+    """
+    return (BASE_MEMORY + SEQUENCE_MEMORY*target_sequences +
+            RESIDUE_MEMORY*target_residues + tensor_bytes +
+            jobs*max_family_memory)
+
+
+def write_calibration(calibration_fp, record):
+    """ Append the measurements of a run to the calibration table.
+
+    Parameters
+    ----------
+    calibration_fp: string
+        filepath to the tab-separated calibration table (created with a
+        header line if it does not exist)
+    record: dictionary
+        value of each of CALIBRATION_FIELDS
+    """
+    new = not exists(calibration_fp)
+    with open(calibration_fp, 'a') as calibration_f:
+        if new:
+            calibration_f.write("%s\n" % "\t".join(CALIBRATION_FIELDS))
+        calibration_f.write("%s\n" % "\t".join(
+            str(record[field]) for field in CALIBRATION_FIELDS))
+
+
+def read_calibration(calibration_fp=None):
+    """ Fit the rates of the run estimator to the calibration table.
+
+    Parameters
+    ----------
+    calibration_fp: string, optional
+        filepath to the calibration table (see write_calibration()); if
+        None, the default rates are returned
+
+    Returns
+    -------
+    calibration: dictionary
+        'search_rates' and 'msa_rates' (seconds per unit of work of each
+        software), 'family_fraction', 'homolog_fraction' and
+        'memory_scale' (ratio of the measured to the predicted peak memory)
 
-    extensions = set(['fa', 'fasta', 'faa'])
-    extensions.update(ext)
+    Raises
+    ------
+    ValueError
+        if the header of the table lacks one of CALIBRATION_FIELDS
 
-    # create working directory if doesn't exist
-    if not isdir(working_dir):
-        mkdir(working_dir)
+    Notes
+    -----
+        Each rate is the median over the runs of the table, so that a few
+        runs slowed down by a busy node do not skew the estimate. Malformed
+        rows (e.g. the truncated last row of a run interrupted while
+        writing it) are skipped.
+    """
+    samples = {'search_rates': {}, 'msa_rates': {}, 'family_fraction': [],
+               'homolog_fraction': [], 'memory_scale': []}
+    if calibration_fp is not None:
+        with open(calibration_fp, 'r') as calibration_f:
+            header = calibration_f.readline().split()
+            missing = [field for field in CALIBRATION_FIELDS
+                       if field not in header]
+            if missing:
+                raise ValueError(
+                    "Calibration table %s lacks the columns: %s" % (
+                        calibration_fp, ", ".join(missing)))
+            for line_number, line in enumerate(calibration_f, 2):
+                if not line.strip():
+                    continue
+                row = dict(zip(header, line.split()))
+                try:
+                    if len(line.split()) != len(header):
+                        raise ValueError("%s fields" % len(line.split()))
+                    values = dict(
+                        (field, float(value)) for field, value in row.items()
+                        if field not in ['align_software', 'msa_software'])
+                except ValueError as error:
+                    sys.stdout.write(
+                        "Skipping malformed row %s of calibration table %s "
+                        "(%s)\n" % (line_number, calibration_fp, error))
+                    continue
+                search_work = values['query_residues'] * values[
+                    'target_residues']
+                if search_work and values['search_seconds']:
+                    samples['search_rates'].setdefault(
+                        row['align_software'], []).append(
+                            values['search_seconds'] / search_work)
+                if values['family_cost'] and values['msa_seconds']:
+                    samples['msa_rates'].setdefault(
+                        row['msa_software'], []).append(
+                            values['msa_seconds'] * values['jobs'] /
+                            values['family_cost'])
+                if values['query_genes']:
+                    samples['family_fraction'].append(
+                        values['families'] / values['query_genes'])
+                if values['families'] and values['target_sequences']:
+                    samples['homolog_fraction'].append(
+                        numpy.sqrt(values['family_cost'] /
+                                   values['families']) /
+                        (values['num_species'] * values['target_residues'] /
+                         values['target_sequences']))
+                samples['memory_scale'].append(
+                    values['peak_memory'] / predict_memory(
+                        values['target_sequences'],
+                        values['target_residues'], values['tensor_bytes'],
+                        values['max_family_memory'], values['jobs']))
+    calibration = {
+        'search_rates': dict(DEFAULT_SEARCH_RATES),
+        'msa_rates': dict(DEFAULT_MSA_RATES),
+        'family_fraction': DEFAULT_FAMILY_FRACTION,
+        'homolog_fraction': DEFAULT_HOMOLOG_FRACTION,
+        'memory_scale': 1.0}
+    for rates in ['search_rates', 'msa_rates']:
+        for software, values in samples[rates].items():
+            calibration[rates][software] = float(numpy.median(values))
+    for fraction in ['family_fraction', 'homolog_fraction', 'memory_scale']:
+        if samples[fraction]:
+            calibration[fraction] = float(numpy.median(samples[fraction]))
+    return calibration
 
-    gene_map, ref_db, num_species = preprocess_data(
-        working_dir=working_dir,
-        target_proteomes_dir=target_proteomes_dir,
-        extensions=extensions,
-        verbose=verbose)
 
-    if debug:
-        sys.stdout.write("\n[DEBUG] gene map:\n")
-        for gene in gene_map:
-            sys.stdout.write("[DEBUG] %s: %s\n" % (gene, gene_map[gene]))
+def estimate_run(query_proteome_fp,
+                 target_proteomes_dir,
+                 extensions,
+                 tabular_alignments_fp=None,
+                 min_num_homologs=3,
+                 align_software='diamond',
+                 msa_software='clustalw',
+                 jobs=1,
+                 distance_dtype='float64',
+                 calibration_fp=None):
+    """ Estimate the run time and peak memory of distance_method().
 
-    if verbose:
-        sys.stdout.write("\nRunning BLASTp ..\n")
-    hits = {}
+    Parameters
+    ----------
+    query_proteome_fp, target_proteomes_dir, tabular_alignments_fp,
+    min_num_homologs, align_software, msa_software, jobs, distance_dtype:
+        see distance_method()
+    extensions: list
+        list of extensions for reference proteomes
+    calibration_fp: string, optional
+        filepath to the calibration table of earlier runs (see
+        read_calibration())
 
-    # tabular alignments provided
+    Returns
+    -------
+    estimate: dictionary
+        the input sizes, the predicted number of gene families
+        ('families', counted from tabular_alignments_fp if given), the size
+        of the distance tensor ('tensor_bytes'), the time of the homology
+        search and of the MSA and distance stage ('search_seconds',
+        'msa_seconds') and the peak memory ('peak_memory')
+    """
+    calibration = read_calibration(calibration_fp)
+    gene_map = {}
+    lengths = {}
+    files = list_proteomes(target_proteomes_dir, extensions)
+    for species, _file in enumerate(files):
+        for label, length in scan_proteome(_file):
+            gene_map[label] = species
+            lengths[label] = length
+    num_species = len(files)
+    query_lengths = [length for _, length in scan_proteome(
+        query_proteome_fp)]
+    target_residues = sum(lengths.values())
+    mean_length = float(target_residues) / max(len(lengths), 1)
     if tabular_alignments_fp is not None:
-        # generate a dictionary of orthologous genes
+        hits = {}
         parse_blast(alignments_fp=tabular_alignments_fp,
                     hits=hits,
-                    gene_map=gene_map,
-                    debug=debug)
-    # tabular alignments to be created
+                    gene_map=gene_map)
+        families = []
+        for query in hits:
+            if len(hits[query]) - (query in hits[query]) >= (
+                    min_num_homologs):
+                families.append([lengths[ref] for ref in hits[query]])
     else:
-        files = [f
-                 for e in extensions
-                 for f in glob("%s/*%s" % (target_proteomes_dir, e))]
-        for _file in files:
-            # launch BLASTp
+        num_families = int(round(
+            calibration['family_fraction'] * len(query_lengths)))
+        homologs = max(int(round(
+            calibration['homolog_fraction'] * num_species)), 1)
+        families = [[int(round(mean_length))] * homologs] * num_families
+    costs = [_family_cost(family) for family in families]
+    family_cost = sum(cost for cost, _ in costs)
+    max_family_memory = max([memory for _, memory in costs] or [0])
+    tensor_bytes = len(families) * num_species**2 * numpy.dtype(
+        distance_dtype).itemsize
+    search_seconds = 0.0
+    if tabular_alignments_fp is None:
+        search_seconds = calibration['search_rates'][align_software] * sum(
+            query_lengths) * target_residues
+    return OrderedDict([
+        ('num_species', num_species),
+        ('query_genes', len(query_lengths)),
+        ('query_residues', sum(query_lengths)),
+        ('target_sequences', len(lengths)),
+        ('target_residues', target_residues),
+        ('families', len(families)),
+        ('families_counted', tabular_alignments_fp is not None),
+        ('family_cost', family_cost),
+        ('max_family_memory', max_family_memory),
+        ('tensor_bytes', tensor_bytes),
+        ('jobs', jobs),
+        ('search_seconds', search_seconds),
+        ('msa_seconds', calibration['msa_rates'][msa_software] *
+         family_cost / jobs),
+        ('peak_memory', int(calibration['memory_scale'] * predict_memory(
+            len(lengths), target_residues, tensor_bytes, max_family_memory,
+            jobs))),
+        ('memory_scale', calibration['memory_scale'])])
+
+
+def suggest_jobs(estimate, cpus, node_memory=None):
+    """ Choose the number of concurrent alignment jobs of a node.
+
+    Parameters
+    ----------
+    estimate: dictionary
+        estimate returned by estimate_run()
+    cpus: integer
+        number of CPUs of the node
+    node_memory: integer, optional
+        memory (MB) of the node
+
+    Returns
+    -------
+    jobs: integer
+        the number of CPUs, or fewer if the gene families aligned
+        concurrently would not fit in node_memory
+    """
+    jobs = max(cpus, 1)
+    if node_memory is not None and estimate['max_family_memory']:
+        fixed = estimate['peak_memory'] / estimate['memory_scale'] - (
+            estimate['jobs'] * estimate['max_family_memory'])
+        fit = int((node_memory*1024*1024 / estimate['memory_scale'] -
+                   fixed) // estimate['max_family_memory'])
+        jobs = max(min(jobs, fit), 1)
+    return jobs
+
+
+def write_estimate(estimate, out_f=sys.stdout):
+    """ Write the estimate of a run returned by estimate_run().
+    """
+    out_f.write("Species: %s\n" % estimate['num_species'])
+    out_f.write("Query genes: %s (%s residues)\n" % (
+        estimate['query_genes'], estimate['query_residues']))
+    out_f.write("Target sequences: %s (%s residues)\n" % (
+        estimate['target_sequences'], estimate['target_residues']))
+    out_f.write("Gene families: %s (%s)\n" % (
+        estimate['families'], "counted from the alignments"
+        if estimate['families_counted'] else "predicted"))
+    out_f.write("Distance tensor: %s\n" % _format_size(
+        estimate['tensor_bytes']))
+    out_f.write("Homology search: %s\n" % _format_duration(
+        estimate['search_seconds']))
+    out_f.write("MSA and distances: %s (%s jobs)\n" % (
+        _format_duration(estimate['msa_seconds']), estimate['jobs']))
+    out_f.write("Peak memory: %s\n" % _format_size(estimate['peak_memory']))
+
+
+# distance_method() options which can be set per service job
+SERVICE_JOB_OPTIONS = ['tabular_alignments_fp', 'min_num_homologs', 'e_value',
+                       'stdev_offset', 'outlier_hgt', 'species_set_size',
+                       'hamming_distance', 'timeout', 'min_pident',
+                       'min_qcovs', 'min_length', 'min_bitscore']
+
+
+def read_hgt_candidates(output_hgt_fp):
+    """ Read the candidate HGT genes output by distance_method().
+    """
+    with open(output_hgt_fp, 'r') as output_hgt_f:
+        return [line.strip() for line in output_hgt_f
+                if line.strip() and not line.startswith('#')]
+
+
+class DistanceMethodService(object):
+    """Run distance_method() jobs against a reference panel kept in memory.
+
+    The target proteomes are parsed and their search databases built once;
+    jobs are queued and at most max_jobs of them run concurrently, each in
+    its own directory working_dir/jobs/<job_id>. Search databases are not
+    built when jobs only use tabular alignments (build_databases=False).
+
+    Jobs read their inputs from uploaded content; server-side filepaths are
+    only accepted inside input_dir (never if input_dir is None). Finished
+    jobs and their directories are removed job_ttl seconds after they end
+    (never if job_ttl is None), or earlier with remove().
+    """
+    def __init__(self, target_proteomes_dir, working_dir, align_software,
+                 ext=['fa', 'fasta', 'faa'], max_jobs=1, threads=1,
+                 build_databases=True, input_dir=None, job_ttl=86400,
+                 verbose=False, **options):
+        self.target_proteomes_dir = target_proteomes_dir
+        self.working_dir = working_dir
+        self.input_dir = input_dir
+        self.job_ttl = job_ttl
+        self.align_software = align_software
+        self.ext = list(ext)
+        self.threads = threads
+        self.verbose = verbose
+        self.options = options
+        extensions = set(['fa', 'fasta', 'faa'])
+        extensions.update(ext)
+        for dir_fp in [working_dir, join(working_dir, "jobs")]:
+            if not isdir(dir_fp):
+                mkdir(dir_fp)
+        self.panel = ReferencePanel(target_proteomes_dir=target_proteomes_dir,
+                                    extensions=extensions,
+                                    working_dir=working_dir,
+                                    jobs=threads,
+                                    verbose=verbose)
+        self.database_dir = join(working_dir, "databases")
+        if not isdir(self.database_dir):
+            mkdir(self.database_dir)
+        for ref_fp in (list_proteomes(target_proteomes_dir, extensions)
+                       if build_databases else []):
+            db_file_fp = join(self.database_dir, basename(ref_fp))
             if align_software == "blast":
-                alignments_fp = launch_blast(
-                    query_proteome_fp=query_proteome_fp,
-                    ref_fp=_file,
-                    working_dir=working_dir,
-                    e_value=e_value,
-                    threads=threads,
-                    debug=debug)
-            elif align_software == "diamond":
-                alignments_fp = launch_diamond(
-                    query_proteome_fp=query_proteome_fp,
-                    ref_fp=_file,
-                    working_dir=working_dir,
-                    tmp_dir=working_dir,
-                    e_value=e_value,
-                    threads=threads,
-                    debug=debug)
+                make_blast_database(ref_fp=ref_fp, db_file_fp=db_file_fp)
             else:
-                raise ValueError(
-                    "Software not supported: %s" % align_software)
+                make_diamond_database(ref_fp=ref_fp, db_file_fp=db_file_fp,
+                                      threads=threads)
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
 
-            # generate a dictionary of orthologous genes
-            parse_blast(alignments_fp=alignments_fp,
-                        hits=hits,
-                        gene_map=gene_map,
-                        debug=debug)
+    def input_fp(self, fp):
+        """Return the real path of an input file of a job.
 
-    # keep only genes with >= min_num_homologs
-    hits_min_num_homologs = {}
-    max_homologs = 0
-    for query in hits:
-        len_hits = len(hits[query])
-        if query in hits[query]:
-            len_hits -= 1
-        if len_hits >= min_num_homologs:
-            if query in hits_min_num_homologs:
-                raise ValueError("Duplicate gene names found: %s" % query)
-            hits_min_num_homologs[query] = hits[query]
-            if len_hits > max_homologs:
-                max_homologs = len_hits
-    hits.clear()
+        Raises ValueError if the file is not inside input_dir (relative
+        paths are relative to input_dir).
+        """
+        if self.input_dir is None:
+            raise ValueError(
+                "Filepaths are not accepted, upload the content: %s" % fp)
+        input_dir = realpath(self.input_dir)
+        real_fp = realpath(join(input_dir, fp))
+        if not real_fp.startswith(join(input_dir, '')):
+            raise ValueError("Filepath outside the input directory: %s" % fp)
+        return real_fp
 
-    if verbose:
-        sys.stdout.write(
-            "Total number of orthologous gene families with at "
-            "least %s genes: %s\n" % (
-                min_num_homologs, len(hits_min_num_homologs)))
-    if debug:
-        sys.stdout.write("[DEBUG] Blast matches:\n")
-        for query in hits_min_num_homologs:
-            sys.stdout.write(
-                "[DEBUG] %s: %s\n" % (query, hits_min_num_homologs[query]))
-    # generate command for CLUSTALW
-    phy_msa_fp = join(working_dir, "msa.phy")
-    open(phy_msa_fp, 'a').close()
-    dnd_msa_fp = join(working_dir, "msa.dnd")
-    open(dnd_msa_fp, 'a').close()
-    phylip_fp = join(working_dir, "msa.dis")
-    open(phylip_fp, 'a').close()
-    # create fasta file for each gene family and run CLUSTALW
-    fasta_in_fp = join(working_dir, "input.faa")
-    clustal_command_fp = join(working_dir, "clustal_command.txt")
-    with open(clustal_command_fp, 'w') as clustal_command_f:
-        clustal_command_f.write(
-            '1\n%s\n2\n9\n1\n4\n\n1\n%s\n%s\nX\n\nX\n' % (
-                fasta_in_fp, phy_msa_fp, dnd_msa_fp))
-    phylip_command_fp = join(working_dir, "phylip_command.txt")
-    with open(phylip_command_fp, 'w') as phylip_command_f:
-        phylip_command_f.write('%s\nF\n%s\nR\nY\n' % (phy_msa_fp, phylip_fp))
+    def submit(self, query_proteome=None, query_proteome_fp=None,
+               tabular_alignments=None, options=None):
+        """Queue a job and return its ID.
 
-    total_genes = len(hits_min_num_homologs)
-    if verbose:
-        sys.stdout.write("\nRunning CLUSTALW and PROTDIST ..\n")
-    if max_homologs > num_species:
-        raise ValueError(
-            "max_homologs > num_species: %s > %s " % (
-                max_homologs, num_species))
-    # distance matrix containing distances between all ortholog genes
-    full_distance_matrix = numpy.zeros(
-        shape=(total_genes, num_species, num_species), dtype=float)
-    # dictionary to store all subsets of orthologs (keys) and
-    # their number of occurrences (values) (maximum occurrences
-    # is equal to the number of genes)
-    species_set_dict = {}
-    gene_bitvector_map = {}
-    gene_id = {}
-    for i, query in enumerate(hits_min_num_homologs):
-        if verbose:
-            print("Computing MSA and distances for gene %s .. (%s/%s)" % (
-                query, i+1, total_genes))
-        gene_id[i] = query
-        # generate a multiple sequence alignment
-        # for each orthologous gene family
-        launch_msa(fasta_in_fp=fasta_in_fp,
-                   clustal_command_fp=clustal_command_fp,
-                   ref_db=ref_db,
-                   gene_map=gene_map,
-                   hits=hits_min_num_homologs,
-                   query=query,
-                   timeout=timeout)
-
-        # compute distances between each pair of sequences in MSA
-        compute_distances(phylip_command_fp=phylip_command_fp,
-                          warnings=warnings)
+        Parameters
+        ----------
+        query_proteome: string, optional
+            query proteome (FASTA format)
+        query_proteome_fp: string, optional
+            filepath to query proteome inside input_dir (if query_proteome
+            is not given)
+        tabular_alignments: string, optional
+            tabular alignments of the query proteome (see parse_blast()),
+            instead of the tabular_alignments_fp option
+        options: dictionary, optional
+            distance_method() options of the job (see SERVICE_JOB_OPTIONS);
+            tabular_alignments_fp must be inside input_dir
+        """
+        options = dict(options or {})
+        unknown = sorted(set(options) - set(SERVICE_JOB_OPTIONS))
+        if unknown:
+            raise ValueError("Options not supported: %s" % ", ".join(unknown))
+        if (query_proteome is None) == (query_proteome_fp is None):
+            raise ValueError(
+                "Either query_proteome or query_proteome_fp is required")
+        if tabular_alignments is not None and (
+                'tabular_alignments_fp' in options):
+            raise ValueError("Either tabular_alignments or "
+                             "tabular_alignments_fp is allowed")
+        if query_proteome_fp is not None:
+            query_proteome_fp = self.input_fp(query_proteome_fp)
+        if 'tabular_alignments_fp' in options:
+            options['tabular_alignments_fp'] = self.input_fp(
+                options['tabular_alignments_fp'])
+        self.expire()
+        job_id = uuid.uuid4().hex
+        job_dir = join(self.working_dir, "jobs", job_id)
+        mkdir(job_dir)
+        if query_proteome is not None:
+            query_proteome_fp = join(job_dir, "query.faa")
+            with open(query_proteome_fp, 'w') as query_f:
+                query_f.write(query_proteome)
+        if tabular_alignments is not None:
+            options['tabular_alignments_fp'] = join(job_dir, "alignments.txt")
+            with open(options['tabular_alignments_fp'], 'w') as alignments_f:
+                alignments_f.write(tabular_alignments)
+        with self._lock:
+            self.jobs[job_id] = {'job_id': job_id,
+                                 'status': 'queued',
+                                 'submitted': time.time()}
+        self._executor.submit(self._run, job_id, job_dir, query_proteome_fp,
+                              options)
+        return job_id
 
-        # Z-score normalize distance matrix and add results
-        # to full distance matrix (for all genes)
-        normalize_distances(phylip_fp=phylip_fp,
-                            full_distance_matrix=full_distance_matrix,
-                            num_species=num_species,
-                            full_distance_matrix_offset=i,
-                            species_set_dict=species_set_dict,
-                            gene_bitvector_map=gene_bitvector_map,
-                            debug=debug)
+    def status(self, job_id):
+        """Return the status, HGT candidates and timing of a job.
 
-    # output_full_matrix(full_distance_matrix, num_species)
+        Raises KeyError for unknown jobs.
+        """
+        with self._lock:
+            return dict(self.jobs[job_id])
 
-    # cluster gene families by species
-    gene_clusters_dict = cluster_distances(
-        species_set_dict=species_set_dict,
-        species_set_size=species_set_size,
-        hamming_distance=hamming_distance)
+    def remove(self, job_id):
+        """Remove a finished job and its directory.
 
-    # detect outlier genes per core cluster of genes
-    with open(output_hgt_fp, 'w') as output_hgt_f:
-        output_hgt_f.write("\n# Candidate HGT genes: \n")
-        for core_cluster in gene_clusters_dict:
-            outlier_genes = detect_outlier_genes(
-                species_set=gene_clusters_dict[core_cluster],
-                gene_bitvector_map=gene_bitvector_map,
-                full_distance_matrix=full_distance_matrix,
-                stdev_offset=stdev_offset,
-                outlier_hgt=outlier_hgt,
-                num_species=num_species,
-                total_genes=total_genes,
-                debug=debug)
+        Raises KeyError for unknown jobs and ValueError for jobs which are
+        queued or running.
+        """
+        with self._lock:
+            if self.jobs[job_id]['status'] in ['queued', 'running']:
+                raise ValueError("Job %s is %s" % (
+                    job_id, self.jobs[job_id]['status']))
+            del self.jobs[job_id]
+        rmtree(join(self.working_dir, "jobs", job_id), ignore_errors=True)
 
-            if outlier_genes:
-                for gene in outlier_genes:
-                    output_hgt_f("%s\n" % gene_id[gene])
+    def expire(self):
+        """Remove the jobs finished more than job_ttl seconds ago.
+        """
+        if self.job_ttl is None:
+            return
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if now - job.get('finished', now) > self.job_ttl]
+        for job_id in expired:
+            try:
+                self.remove(job_id)
+            except KeyError:
+                # removed meanwhile
+                pass
 
-    # output_full_matrix(outlier_genes, num_species)
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def _run(self, job_id, job_dir, query_proteome_fp, options):
+        started = time.time()
+        self._update(job_id, status='running')
+        kwargs = dict(self.options)
+        kwargs.update(options)
+        output_hgt_fp = join(job_dir, "hgts.txt")
+        try:
+            distance_method(query_proteome_fp=query_proteome_fp,
+                            target_proteomes_dir=self.target_proteomes_dir,
+                            working_dir=job_dir,
+                            output_hgt_fp=output_hgt_fp,
+                            align_software=self.align_software,
+                            ext=self.ext,
+                            threads=self.threads,
+                            verbose=self.verbose,
+                            reference_panel=self.panel,
+                            database_dir=self.database_dir,
+                            **kwargs)
+            fields = {'status': 'done',
+                      'hgts': read_hgt_candidates(output_hgt_fp)}
+        except Exception as e:
+            fields = {'status': 'failed', 'error': "%s: %s" % (
+                type(e).__name__, e)}
+            if self.verbose:
+                traceback.print_exc()
+        finished = time.time()
+        with self._lock:
+            fields['finished'] = finished
+            fields['timing'] = {
+                'queued': started - self.jobs[job_id]['submitted'],
+                'run': finished - started}
+            self.jobs[job_id].update(fields)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of a DistanceMethodService (self.server.service).
+
+    POST /jobs with a JSON object holding query_proteome (FASTA) or
+    query_proteome_fp, and optionally tabular_alignments and options,
+    queues a job and returns its job_id (filepaths must be inside the
+    service's input directory); GET /jobs/<job_id> returns the job's
+    status, HGT candidates (hgts) and timing (seconds queued and running);
+    DELETE /jobs/<job_id> removes a finished job.
+    """
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != "/jobs":
+            return self._send_json(404, {'error': "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode())
+            job_id = self.server.service.submit(
+                query_proteome=request.get('query_proteome'),
+                query_proteome_fp=request.get('query_proteome_fp'),
+                tabular_alignments=request.get('tabular_alignments'),
+                options=request.get('options'))
+        except (ValueError, AttributeError) as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send_json(202, {'job_id': job_id})
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self._send_json(404, {'error': "Not found"})
+        try:
+            self._send_json(200, self.server.service.status(parts[1]))
+        except KeyError:
+            self._send_json(404, {'error': "Unknown job: %s" % parts[1]})
+
+    def do_DELETE(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self._send_json(404, {'error': "Not found"})
+        try:
+            self.server.service.remove(parts[1])
+        except KeyError:
+            return self._send_json(
+                404, {'error': "Unknown job: %s" % parts[1]})
+        except ValueError as e:
+            return self._send_json(409, {'error': str(e)})
+        self._send_json(200, {'job_id': parts[1], 'status': 'deleted'})
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ServiceHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server of a DistanceMethodService.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ServiceRequestHandler)
+        self.service = service
 
 
 @click.command()
@@ -1094,6 +6242,82 @@ def distance_method(query_proteome_fp,
                               file_okay=True),
               help="Tabular alignments in m6 format (output from BLAST or "
                    "DIAMOND)")
+@click.option('--msa-dir', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory of precomputed MSAs of gene families (FASTA or "
+                   "PHYLIP format); the homology search and alignment "
+                   "stages are skipped")
+@click.option('--msa-map-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help="Tab-separated file mapping query genes to the filenames "
+                   "of their gene family MSAs in --msa-dir")
+@click.option('--distance-mode', type=click.Choice(DISTANCE_MODES),
+              required=False, default='protdist', show_default=True,
+              help="Compute distances from MSAs using protdist, or from "
+                   "k-mers of the unaligned sequences (alignment-free, for "
+                   "first-pass screening)")
+@click.option('--kmer-size', type=click.IntRange(1, MAX_KMER_SIZE),
+              required=False, default=3, show_default=True,
+              help="K-mer length for --distance-mode kmer")
+@click.option('--reference-families-dir', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=False),
+              help="Directory of reference gene families (built from the "
+                   "target proteomes on first use); query genes are added "
+                   "to their family's MSA by profile alignment")
+@click.option('--prefilter-index-dir', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=False),
+              help="Directory of the k-mer index of the target proteomes "
+                   "(built on first use); query genes sharing k-mers with "
+                   "fewer than --min-num-homologs species are dropped "
+                   "before the homology search")
+@click.option('--prefilter-kmer-size', type=click.IntRange(1, MAX_KMER_SIZE),
+              required=False, default=5, show_default=True,
+              help="K-mer length of the prefilter index")
+@click.option('--prefilter-min-shared-kmers', type=int, required=False,
+              default=3, show_default=True,
+              help="Minimum number of k-mers shared with a reference gene "
+                   "for the prefilter to count its species")
+@click.option('--cdhit-identity', type=float, required=False,
+              help="Cluster the target proteomes' sequences at this identity "
+                   "using CD-HIT and search only the representatives (hits "
+                   "are expanded to the cluster members)")
+@click.option('--cdhit-across-species', type=bool, required=False,
+              default=False, show_default=True,
+              help="Cluster the sequences of all target proteomes together "
+                   "rather than within each proteome")
+@click.option('--scratch-dir', required=False, default=DEFAULT_SCRATCH_DIR,
+              show_default=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory (preferably RAM-backed) for the per-family "
+                   "temporary files, removed at the end of the run")
+@click.option('--dedup-families', type=bool, required=False, default=False,
+              show_default=True,
+              help="Align the reference homologs shared by several query "
+                   "genes (e.g. paralogs) once and add each query gene by "
+                   "profile alignment (changes their MSAs and distances)")
+@click.option('--manifest-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=True),
+              help="Stop after the homology search and write the gene "
+                   "family work units to this manifest (see the shard and "
+                   "reduce commands)")
+@click.option('--min-pident', type=float, required=False,
+              help="The minimum percent identity of the homology search "
+                   "alignments")
+@click.option('--min-qcovs', type=float, required=False,
+              help="The minimum query coverage (percent) of the homology "
+                   "search alignments, over all the alignments of a query "
+                   "and subject pair (BLAST's qcovs; requires a 13th qcovs "
+                   "column in --tabular-alignments-fp)")
+@click.option('--min-length', type=int, required=False,
+              help="The minimum length of the homology search alignments")
+@click.option('--min-bitscore', type=float, required=False,
+              help="The minimum bit score of the homology search alignments")
 @click.option('--ext', multiple=True, type=str, required=False,
               default=['fa', 'fasta', 'faa'], show_default=True,
               help="File extensions of target proteomes (multiple extensions "
@@ -1135,14 +6359,98 @@ def distance_method(query_proteome_fp,
 @click.option('--warnings', type=bool, required=False, default=False,
               show_default=True, help="Print program warnings")
 @click.option('--timeout', type=int, required=False, default=120,
-              show_default=True, help="Number of seconds to allow Clustalw "
-                                      "to run per call")
+              show_default=True, help="Number of seconds to allow the "
+                                      "alignment software to run per call")
+@click.option('--memory-report', type=bool, required=False, default=False,
+              show_default=True, help="Trace memory allocations and report "
+                                      "the peak memory, the growth of each "
+                                      "pipeline stage and the top allocation "
+                                      "sites")
+@click.option('--distance-dtype', type=click.Choice(DISTANCE_DTYPES),
+              required=False, default='float64', show_default=True,
+              help="Floating point type used to store the normalized "
+                   "distance tensor (float32 halves and float16 quarters its "
+                   "memory; float16 is only precise to ~3 digits)")
+@click.option('--sparse-distances', type=bool, required=False, default=False,
+              show_default=True, help="Store for each gene only the distances "
+                                      "between the species present in its "
+                                      "gene family (for reference panels "
+                                      "with patchy species coverage)")
+@click.option('--protdist-batch-size', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families whose MSAs "
+                                      "are processed by a single protdist "
+                                      "run (PHYLIP's multiple data sets "
+                                      "mode)")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families aligned "
+                                      "concurrently (most expensive first), "
+                                      "of processes reading the reference "
+                                      "proteomes and of outlier detection "
+                                      "threads")
+@click.option('--memory-budget', type=int, required=False, default=None,
+              help="Maximum estimated memory (MB) of the gene families "
+                   "aligned concurrently")
+@click.option('--msa-software', type=click.Choice(sorted(MSA_BACKENDS)),
+              required=False, default='clustalw', show_default=True,
+              help="Software to use for multiple sequence alignment")
+@click.option('--msa-fallback',
+              type=click.Choice(sorted(MSA_BACKENDS) + ['none']),
+              required=False, default='clustalw-quicktree',
+              show_default=True, help="Software to retry with when the "
+                                      "multiple sequence alignment of a gene "
+                                      "family fails or times out")
+@click.option('--max-timeout', type=int, required=False, default=None,
+              help="Scale the alignment timeout of each gene family to its "
+                   "size, from --timeout (20 homologs of 400 residues) up to "
+                   "this number of seconds (default: 10 times --timeout; "
+                   "set to --timeout for a fixed timeout)")
+@click.option('--msa-subsample-size', type=int, required=False,
+              default=None,
+              help="Align a gene family whose alignment still fails again "
+                   "with this number of its best homologs")
+@click.option('--msa-failures-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=True),
+              help="Output file recording the gene families whose alignment "
+                   "failed or timed out [default: "
+                   "WORKING_DIR/msa_failures.tsv]")
+@click.option('--calibration-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=True),
+              help="Append the sizes, stage times and peak memory of the run "
+                   "to this calibration table (see the estimate command)")
+@click.option('--results-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=True),
+              help="Output file (.npz) storing the normalized distances, "
+                   "species sets, clusters and outlier counts of the genes")
+@click.option('--kernels', type=click.Choice(KERNEL_MODES),
+              required=False, default='auto', show_default=True,
+              help="Implementation of the normalization, clustering and "
+                   "outlier detection loops (auto: numba if installed)")
 def distance_method_main(query_proteome_fp,
                          target_proteomes_dir,
                          working_dir,
                          output_hgt_fp,
                          align_software,
                          tabular_alignments_fp,
+                         msa_dir,
+                         msa_map_fp,
+                         distance_mode,
+                         kmer_size,
+                         reference_families_dir,
+                         prefilter_index_dir,
+                         prefilter_kmer_size,
+                         prefilter_min_shared_kmers,
+                         cdhit_identity,
+                         cdhit_across_species,
+                         scratch_dir,
+                         dedup_families,
+                         manifest_fp,
+                         min_pident,
+                         min_qcovs,
+                         min_length,
+                         min_bitscore,
                          ext,
                          min_num_homologs,
                          e_value,
@@ -1154,7 +6462,21 @@ def distance_method_main(query_proteome_fp,
                          verbose,
                          debug,
                          warnings,
-                         timeout):
+                         timeout,
+                         memory_report,
+                         distance_dtype,
+                         sparse_distances,
+                         protdist_batch_size,
+                         jobs,
+                         memory_budget,
+                         msa_software,
+                         msa_fallback,
+                         max_timeout,
+                         msa_subsample_size,
+                         msa_failures_fp,
+                         calibration_fp,
+                         results_fp,
+                         kernels):
     """ Run the Distance-Method HGT detection algorithm.
     """
     distance_method(query_proteome_fp=query_proteome_fp,
@@ -1174,8 +6496,455 @@ def distance_method_main(query_proteome_fp,
                     verbose=verbose,
                     debug=debug,
                     warnings=warnings,
-                    timeout=timeout)
+                    timeout=timeout,
+                    memory_report=memory_report,
+                    distance_dtype=distance_dtype,
+                    sparse_distances=sparse_distances,
+                    protdist_batch_size=protdist_batch_size,
+                    jobs=jobs,
+                    memory_budget=memory_budget,
+                    msa_software=msa_software,
+                    msa_fallback=(None if msa_fallback == 'none'
+                                  else msa_fallback),
+                    msa_dir=msa_dir,
+                    msa_map_fp=msa_map_fp,
+                    distance_mode=distance_mode,
+                    kmer_size=kmer_size,
+                    reference_families_dir=reference_families_dir,
+                    prefilter_index_dir=prefilter_index_dir,
+                    prefilter_kmer_size=prefilter_kmer_size,
+                    prefilter_min_shared_kmers=prefilter_min_shared_kmers,
+                    cdhit_identity=cdhit_identity,
+                    cdhit_across_species=cdhit_across_species,
+                    min_pident=min_pident,
+                    min_qcovs=min_qcovs,
+                    min_length=min_length,
+                    min_bitscore=min_bitscore,
+                    scratch_dir=scratch_dir,
+                    dedup_families=dedup_families,
+                    max_timeout=max_timeout,
+                    msa_subsample_size=msa_subsample_size,
+                    msa_failures_fp=msa_failures_fp,
+                    calibration_fp=calibration_fp,
+                    results_fp=results_fp,
+                    kernels=kernels,
+                    manifest_fp=manifest_fp)
+
+
+@click.command()
+@click.argument('target-proteomes-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=True))
+@click.argument('working-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=True))
+@click.option('--align-software', type=click.Choice(['diamond', 'blast']),
+              required=False, default='diamond', show_default=True,
+              help="Software to use for blasting sequences")
+@click.option('--ext', multiple=True, type=str, required=False,
+              default=['fa', 'fasta', 'faa'], show_default=True,
+              help="File extensions of target proteomes (multiple extensions "
+                   "can be given by calling --ext ext1 --ext ext2)")
+@click.option('--host', type=str, required=False, default='127.0.0.1',
+              show_default=True, help="Address the service listens on")
+@click.option('--port', type=int, required=False, default=8080,
+              show_default=True, help="Port the service listens on")
+@click.option('--max-jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of query proteomes processed "
+                                      "concurrently")
+@click.option('--threads', type=int, required=False, default=1,
+              show_default=True, help="Number of threads to use")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families aligned "
+                                      "concurrently per query proteome")
+@click.option('--msa-software', type=click.Choice(sorted(MSA_BACKENDS)),
+              required=False, default='clustalw', show_default=True,
+              help="Software to use for multiple sequence alignment")
+@click.option('--scratch-dir', required=False, default=DEFAULT_SCRATCH_DIR,
+              show_default=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory (preferably RAM-backed) for the per-family "
+                   "temporary files")
+@click.option('--input-dir', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory of the input files jobs may refer to by "
+                   "filepath (by default jobs must upload their inputs)")
+@click.option('--job-ttl', type=int, required=False, default=86400,
+              show_default=True,
+              help="Number of seconds finished jobs and their files are "
+                   "kept (0 to keep them until deleted)")
+@click.option('--verbose', type=bool, required=False, default=False,
+              show_default=True, help="Run in verbose mode")
+def distance_method_serve(target_proteomes_dir,
+                          working_dir,
+                          align_software,
+                          ext,
+                          host,
+                          port,
+                          max_jobs,
+                          threads,
+                          jobs,
+                          msa_software,
+                          scratch_dir,
+                          input_dir,
+                          job_ttl,
+                          verbose):
+    """ Serve Distance Method jobs over HTTP with the target proteomes
+        loaded once (see ServiceRequestHandler)
+    """
+    service = DistanceMethodService(target_proteomes_dir=target_proteomes_dir,
+                                    working_dir=working_dir,
+                                    align_software=align_software,
+                                    ext=ext,
+                                    max_jobs=max_jobs,
+                                    threads=threads,
+                                    input_dir=input_dir,
+                                    job_ttl=job_ttl or None,
+                                    verbose=verbose,
+                                    jobs=jobs,
+                                    msa_software=msa_software,
+                                    scratch_dir=scratch_dir)
+    server = ServiceHTTPServer((host, port), service)
+    sys.stdout.write("Serving on http://%s:%s\n" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown(wait=False)
+
+
+@click.command()
+@click.argument('manifest-fp', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=True))
+@click.argument('working-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=True))
+@click.argument('partial-fp', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=True))
+@click.option('--start', type=int, required=False, default=0,
+              show_default=True, help="Index of the first work unit")
+@click.option('--end', type=int, required=False, default=None,
+              help="Index after the last work unit (default all remaining "
+                   "work units)")
+@click.option('--num-shards', type=int, required=False, default=None,
+              help="Split the work units into this number of shards and "
+                   "process shard --shard-index (instead of --start/--end)")
+@click.option('--shard-index', type=int, required=False, default=None,
+              help="Index of the shard to process (e.g. the array job's "
+                   "task index)")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families aligned "
+                                      "concurrently (most expensive first)")
+@click.option('--memory-budget', type=int, required=False, default=None,
+              help="Maximum estimated memory (MB) of the gene families "
+                   "aligned concurrently")
+@click.option('--scratch-dir', required=False, default=DEFAULT_SCRATCH_DIR,
+              show_default=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory (preferably RAM-backed) for the per-family "
+                   "temporary files, removed at the end of the run")
+@click.option('--verbose', type=bool, required=False, default=False,
+              show_default=True, help="Run in verbose mode")
+@click.option('--debug', type=bool, required=False, default=False,
+              show_default=True, help="Run in debug mode")
+@click.option('--warnings', type=bool, required=False, default=False,
+              show_default=True, help="Output warnings")
+@click.option('--kernels', type=click.Choice(KERNEL_MODES),
+              required=False, default='auto', show_default=True,
+              help="Implementation of the normalization, clustering and "
+                   "outlier detection loops (auto: numba if installed)")
+def distance_method_shard(manifest_fp,
+                          working_dir,
+                          partial_fp,
+                          start,
+                          end,
+                          num_shards,
+                          shard_index,
+                          jobs,
+                          memory_budget,
+                          scratch_dir,
+                          verbose,
+                          debug,
+                          warnings,
+                          kernels):
+    """ Compute the distances of a shard of the work units of a manifest
+    """
+    if num_shards is not None:
+        if shard_index is None:
+            raise click.UsageError("--shard-index is required with "
+                                   "--num-shards")
+        with open(manifest_fp, 'r') as manifest_f:
+            num_units = len(json.load(manifest_f)['units'])
+        start, end = shard_range(num_units=num_units,
+                                 shard_index=shard_index,
+                                 num_shards=num_shards)
+    run_shard(manifest_fp=manifest_fp,
+              working_dir=working_dir,
+              partial_fp=partial_fp,
+              start=start,
+              end=end,
+              jobs=jobs,
+              memory_budget=memory_budget,
+              scratch_dir=scratch_dir,
+              warnings=warnings,
+              verbose=verbose,
+              debug=debug,
+              kernels=kernels)
+
+
+@click.command()
+@click.argument('manifest-fp', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=True))
+@click.argument('output-hgt-fp', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=True))
+@click.argument('partial-fps', nargs=-1, required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=True))
+@click.option('--verbose', type=bool, required=False, default=False,
+              show_default=True, help="Run in verbose mode")
+@click.option('--debug', type=bool, required=False, default=False,
+              show_default=True, help="Run in debug mode")
+@click.option('--results-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=False,
+                              file_okay=True),
+              help="Output file (.npz) storing the normalized distances, "
+                   "species sets, clusters and outlier counts of the genes")
+@click.option('--kernels', type=click.Choice(KERNEL_MODES),
+              required=False, default='auto', show_default=True,
+              help="Implementation of the normalization, clustering and "
+                   "outlier detection loops (auto: numba if installed)")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of outlier detection threads")
+def distance_method_reduce(manifest_fp,
+                           output_hgt_fp,
+                           partial_fps,
+                           verbose,
+                           debug,
+                           results_fp,
+                           kernels,
+                           jobs):
+    """ Merge the partial distances of all shards and output HGTs
+    """
+    reduce_shards(manifest_fp=manifest_fp,
+                  partial_fps=partial_fps,
+                  output_hgt_fp=output_hgt_fp,
+                  results_fp=results_fp,
+                  jobs=jobs,
+                  verbose=verbose,
+                  debug=debug,
+                  kernels=kernels)
+
+
+@click.command()
+@click.argument('query-proteome-fp', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=True))
+@click.argument('target-proteomes-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=False))
+@click.option('--tabular-alignments-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help="Tabular alignments of the run (the gene families are "
+                   "counted instead of predicted)")
+@click.option('--calibration-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help="Calibration table written by earlier runs "
+                   "(distance_method.py --calibration-fp)")
+@click.option('--align-software', type=click.Choice(['blast', 'diamond']),
+              required=False, default='diamond', show_default=True,
+              help="Software used for the homology search")
+@click.option('--msa-software', type=click.Choice(sorted(MSA_BACKENDS)),
+              required=False, default='clustalw', show_default=True,
+              help="Software used for multiple sequence alignment")
+@click.option('--ext', multiple=True, type=str, required=False,
+              default=['fa', 'fasta', 'faa'], show_default=True,
+              help="File extensions of target proteomes (multiple extensions "
+                   "can be given by calling --ext ext1 --ext ext2)")
+@click.option('--min-num-homologs', type=int, required=False, default=3,
+              show_default=True, help="The mininum number of homologs "
+                                      "for each gene to test")
+@click.option('--distance-dtype', type=click.Choice(DISTANCE_DTYPES),
+              required=False, default='float64', show_default=True,
+              help="Floating point type used to store the normalized "
+                   "distance tensor")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families aligned "
+                                      "concurrently")
+@click.option('--cpus', type=int, required=False, default=None,
+              help="Number of CPUs of the node; if given, --jobs is chosen "
+                   "to fit the CPUs and --node-memory")
+@click.option('--node-memory', type=int, required=False, default=None,
+              help="Memory (MB) of the node")
+def distance_method_estimate(query_proteome_fp,
+                             target_proteomes_dir,
+                             tabular_alignments_fp,
+                             calibration_fp,
+                             align_software,
+                             msa_software,
+                             ext,
+                             min_num_homologs,
+                             distance_dtype,
+                             jobs,
+                             cpus,
+                             node_memory):
+    """ Estimate the run time and peak memory of a run
+    """
+    options = dict(query_proteome_fp=query_proteome_fp,
+                   target_proteomes_dir=target_proteomes_dir,
+                   extensions=set(['fa', 'fasta', 'faa']) | set(ext),
+                   tabular_alignments_fp=tabular_alignments_fp,
+                   min_num_homologs=min_num_homologs,
+                   align_software=align_software,
+                   msa_software=msa_software,
+                   distance_dtype=distance_dtype,
+                   calibration_fp=calibration_fp)
+    try:
+        read_calibration(calibration_fp)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--calibration-fp')
+    estimate = estimate_run(jobs=jobs, **options)
+    if cpus is not None:
+        jobs = suggest_jobs(estimate, cpus=cpus, node_memory=node_memory)
+        estimate = estimate_run(jobs=jobs, **options)
+    write_estimate(estimate)
+    if cpus is not None:
+        sys.stdout.write("Suggested --jobs: %s\n" % jobs)
+
+
+@click.command()
+@click.argument('target-proteomes-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=True,
+                                file_okay=False))
+@click.argument('working-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=True))
+@click.argument('output-dir', required=True,
+                type=click.Path(resolve_path=True, readable=True, exists=False,
+                                file_okay=False))
+@click.option('--align-software', type=click.Choice(['diamond', 'blast']),
+              required=False, default='diamond', show_default=True,
+              help="Software to use for blasting sequences")
+@click.option('--tabular-alignments-fp', required=False,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=True),
+              help="Tabular alignments of all the proteomes against each "
+                   "other")
+@click.option('--distance-mode', type=click.Choice(DISTANCE_MODES),
+              required=False, default='protdist', show_default=True,
+              help="Compute distances from MSAs using protdist, or from "
+                   "k-mers of the unaligned sequences (faster, for "
+                   "screening)")
+@click.option('--kmer-size', type=click.IntRange(1, MAX_KMER_SIZE),
+              required=False, default=3, show_default=True,
+              help="K-mer length in the kmer distance mode")
+@click.option('--ext', multiple=True, type=str, required=False,
+              default=['fa', 'fasta', 'faa'], show_default=True,
+              help="File extensions of target proteomes (multiple extensions "
+                   "can be given by calling --ext ext1 --ext ext2)")
+@click.option('--min-num-homologs', type=int, required=False, default=3,
+              show_default=True, help="The mininum number of homologs "
+                                      "for each gene to test")
+@click.option('--e-value', type=float, required=False, default=10e-20,
+              show_default=True, help="The E-value cutoff to identify "
+                                      "orthologous genes")
+@click.option('--threads', type=int, required=False, default=1,
+              show_default=True, help="Number of threads to use")
+@click.option('--jobs', type=int, required=False, default=1,
+              show_default=True, help="Number of gene families aligned and "
+                                      "genomes screened (or proteomes read) "
+                                      "concurrently")
+@click.option('--msa-software', type=click.Choice(sorted(MSA_BACKENDS)),
+              required=False, default='clustalw', show_default=True,
+              help="Software to use for multiple sequence alignment")
+@click.option('--timeout', type=int, required=False, default=120,
+              show_default=True, help="Number of seconds to allow the "
+                                      "alignment software to run per call")
+@click.option('--scratch-dir', required=False, default=DEFAULT_SCRATCH_DIR,
+              show_default=True,
+              type=click.Path(resolve_path=True, readable=True, exists=True,
+                              file_okay=False),
+              help="Directory (preferably RAM-backed) for the per-family "
+                   "temporary files, removed at the end of the run")
+@click.option('--verbose', type=bool, required=False, default=False,
+              show_default=True, help="Run in verbose mode")
+@click.option('--debug', type=bool, required=False, default=False,
+              show_default=True, help="Run in debug mode")
+@click.option('--warnings', type=bool, required=False, default=False,
+              show_default=True, help="Print program warnings")
+@click.option('--save-results', type=bool, required=False, default=False,
+              show_default=True,
+              help="Also store the distances, clusters and outlier counts "
+                   "of each genome (OUTPUT_DIR/<genome>.results.npz)")
+@click.option('--kernels', type=click.Choice(KERNEL_MODES),
+              required=False, default='auto', show_default=True,
+              help="Implementation of the normalization, clustering and "
+                   "outlier detection loops (auto: numba if installed)")
+def distance_method_all_vs_all(target_proteomes_dir,
+                               working_dir,
+                               output_dir,
+                               align_software,
+                               tabular_alignments_fp,
+                               distance_mode,
+                               kmer_size,
+                               ext,
+                               min_num_homologs,
+                               e_value,
+                               threads,
+                               jobs,
+                               msa_software,
+                               timeout,
+                               scratch_dir,
+                               verbose,
+                               debug,
+                               warnings,
+                               save_results,
+                               kernels):
+    """ Screen every genome of a panel against all the other genomes
+    """
+    screen_all_vs_all(target_proteomes_dir=target_proteomes_dir,
+                      working_dir=working_dir,
+                      output_dir=output_dir,
+                      align_software=align_software,
+                      tabular_alignments_fp=tabular_alignments_fp,
+                      distance_mode=distance_mode,
+                      kmer_size=kmer_size,
+                      ext=ext,
+                      min_num_homologs=min_num_homologs,
+                      e_value=e_value,
+                      threads=threads,
+                      jobs=jobs,
+                      msa_software=msa_software,
+                      timeout=timeout,
+                      scratch_dir=scratch_dir,
+                      verbose=verbose,
+                      debug=debug,
+                      warnings=warnings,
+                      save_results=save_results,
+                      kernels=kernels)
+
+
+# subcommands of distance_method.py (default: run distance_method_main())
+COMMANDS = {'all-vs-all': distance_method_all_vs_all,
+            'estimate': distance_method_estimate,
+            'serve': distance_method_serve,
+            'shard': distance_method_shard,
+            'reduce': distance_method_reduce}
 
 
 if __name__ == "__main__":
-    distance_method_main()
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](args=sys.argv[2:], prog_name="%s %s" % (
+            basename(sys.argv[0]), sys.argv[1]))
+    else:
+        distance_method_main()
@@ -11,8 +11,19 @@
 from unittest import TestCase, main
 from shutil import rmtree
 from tempfile import mkdtemp
-from os import makedirs
-from os.path import join, exists
+from os import makedirs, listdir, utime, remove
+from os.path import join, exists, isdir, basename, abspath, getmtime
+import sys
+import gzip
+import json
+import time
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from io import StringIO
+from contextlib import redirect_stdout
+from collections import OrderedDict
+from threading import Thread
+from importlib.util import find_spec
 import numpy
 import numpy.testing as npt
 import pandas as pd
@@ -21,13 +32,98 @@ from skbio.util import remove_files
 import skbio.io
 
 from distance_method import (preprocess_data,
+                             Command,
                              parse_blast,
+                             parse_cdhit_clusters,
+                             reduce_redundancy,
+                             open_input,
+                             read_fasta,
+                             list_proteomes,
+                             strip_compression,
+                             BackgroundReader,
+                             DistanceMethodService,
+                             ServiceHTTPServer,
+                             read_manifest,
+                             write_manifest,
+                             shard_range,
+                             run_shard,
+                             reduce_shards,
+                             unpack_distances,
+                             HitFilter,
+                             write_query_coverage,
                              normalize_distances,
                              cluster_distances,
                              detect_outlier_genes,
                              launch_blast,
                              launch_diamond,
-                             distance_method)
+                             distance_method,
+                             MemoryReport,
+                             SparseDistanceMatrix,
+                             parse_protdist,
+                             write_protdist_command,
+                             split_protdist_datasets,
+                             estimate_family_cost,
+                             schedule_families,
+                             family_timeout,
+                             subsample_family,
+                             align_families,
+                             prepare_workspace,
+                             write_msa_failures,
+                             estimate_run,
+                             suggest_jobs,
+                             write_calibration,
+                             read_calibration,
+                             CALIBRATION_FIELDS,
+                             DEFAULT_MSA_RATES,
+                             DEFAULT_SEARCH_RATES,
+                             deduplicate_families,
+                             share_families,
+                             select_family_distances,
+                             screen_all_vs_all,
+                             MemoryBudget,
+                             compact_genes,
+                             parse_fasta_alignment,
+                             parse_phylip_alignment,
+                             format_phylip_alignment,
+                             compute_distances_batch,
+                             MSABackend,
+                             MSA_BACKENDS,
+                             compute_family_distances,
+                             parse_precomputed_msas,
+                             kmer_profiles,
+                             kmer_distances,
+                             protdist_distances,
+                             protdist_row,
+                             pair_alignments,
+                             build_reference_families,
+                             ReferenceFamilies,
+                             add_query_proteome,
+                             KmerIndex,
+                             prefilter_query_proteome,
+                             relabel_family,
+                             restore_labels,
+                             add_normalized_distances,
+                             detect_hgts,
+                             read_results,
+                             count_outliers,
+                             set_kernels,
+                             KERNELS,
+                             NUMPY_KERNELS,
+                             LOOP_KERNELS)
+
+
+class StubBackend(MSABackend):
+    """ MSA backend whose commands echo their input (the tests override
+        align() or the commands).
+    """
+    def command(self):
+        return [sys.executable, "-c",
+                "import sys; sys.stdout.write(sys.stdin.read())"]
+
+    def profile_command(self, profile_fp, fasta_in_fp):
+        return [sys.executable, "-c",
+                "import sys; sys.stdout.write(open(sys.argv[1]).read() + "
+                "open(sys.argv[2]).read())", profile_fp, fasta_in_fp]
 
 
 class DistanceMethodTests(TestCase):
@@ -138,35 +234,19 @@ class DistanceMethodTests(TestCase):
         gene_map, ref_db, species = preprocess_data(self.working_dir,
                                                     self.target_proteomes_dir,
                                                     ['fa', 'fasta', 'faa'])
-        gene_map_exp = {'G1_SE001': '0_0', 'G1_SE002': '1_0',
-                        'G1_SE003': '2_0', 'G1_SE004': '3_0',
-                        '0_0': 'G1_SE001', '1_0': 'G1_SE002',
-                        '2_0': 'G1_SE003', '3_0': 'G1_SE004',
-                        'G2_SE001': '0_1', 'G2_SE002': '1_1',
-                        'G2_SE003': '2_1', 'G2_SE004': '3_1',
-                        '0_1': 'G2_SE001', '1_1': 'G2_SE002',
-                        '2_1': 'G2_SE003', '3_1': 'G2_SE004',
-                        'G3_SE001': '0_2', 'G3_SE002': '1_2',
-                        'G3_SE003': '2_2', 'G3_SE004': '3_2',
-                        '0_2': 'G3_SE001', '1_2': 'G3_SE002',
-                        '2_2': 'G3_SE003', '3_2': 'G3_SE004',
-                        'G4_SE001': '0_3', 'G4_SE002': '1_3',
-                        'G4_SE003': '2_3', 'G4_SE004': '3_3',
-                        '0_3': 'G4_SE001', '1_3': 'G4_SE002',
-                        '2_3': 'G4_SE003', '3_3': 'G4_SE004',
-                        'G5_SE001': '0_4', 'G5_SE002': '1_4',
-                        'G5_SE003': '2_4', 'G5_SE004': '3_4',
-                        '0_4': 'G5_SE001', '1_4': 'G5_SE002',
-                        '2_4': 'G5_SE003', '3_4': 'G5_SE004'}
+        gene_map_exp = {}
+        for gene in range(1, 6):
+            for species in range(1, 5):
+                gene_map_exp['G%s_SE00%s' % (gene, species)] = species - 1
         ref_db_exp = {}
         for seq in skbio.io.read(self.species_1_fp, format='fasta'):
-            ref_db_exp[seq.metadata['id']] = seq
+            ref_db_exp[seq.metadata['id']] = str(seq)
         for seq in skbio.io.read(self.species_2_fp, format='fasta'):
-            ref_db_exp[seq.metadata['id']] = seq
+            ref_db_exp[seq.metadata['id']] = str(seq)
         for seq in skbio.io.read(self.species_3_fp, format='fasta'):
-            ref_db_exp[seq.metadata['id']] = seq
+            ref_db_exp[seq.metadata['id']] = str(seq)
         for seq in skbio.io.read(self.species_4_fp, format='fasta'):
-            ref_db_exp[seq.metadata['id']] = seq
+            ref_db_exp[seq.metadata['id']] = str(seq)
         num_species_exp = 4
         self.assertDictEqual(gene_map, gene_map_exp)
         self.assertDictEqual(ref_db, ref_db_exp)
@@ -185,24 +265,315 @@ class DistanceMethodTests(TestCase):
                                  'G5_SE004'],
                     'G2_SE001': ['G2_SE001', 'G2_SE002', 'G2_SE003',
                                  'G2_SE004']}
-        gene_map = {'G1_SE001': '0_0', 'G1_SE002': '1_0', 'G1_SE003': '2_0',
-                    'G1_SE004': '3_0', '0_0': 'G1_SE001', '1_0': 'G1_SE002',
-                    '2_0': 'G1_SE003', '3_0': 'G1_SE004', 'G2_SE001': '0_1',
-                    'G2_SE002': '1_1', 'G2_SE003': '2_1', 'G2_SE004': '3_1',
-                    '0_1': 'G2_SE001', '1_1': 'G2_SE002', '2_1': 'G2_SE003',
-                    '3_1': 'G2_SE004', 'G3_SE001': '0_2', 'G3_SE002': '1_2',
-                    'G3_SE003': '2_2', 'G3_SE004': '3_2', '0_2': 'G3_SE001',
-                    '1_2': 'G3_SE002', '2_2': 'G3_SE003', '3_2': 'G3_SE004',
-                    'G4_SE001': '0_3', 'G4_SE002': '1_3', 'G4_SE003': '2_3',
-                    'G4_SE004': '3_3', '0_3': 'G4_SE001', '1_3': 'G4_SE002',
-                    '2_3': 'G4_SE003', '3_3': 'G4_SE004', 'G5_SE001': '0_4',
-                    'G5_SE002': '1_4', 'G5_SE003': '2_4', 'G5_SE004': '3_4',
-                    '0_4': 'G5_SE001', '1_4': 'G5_SE002', '2_4': 'G5_SE003',
-                    '3_4': 'G5_SE004'}
+        gene_map = {}
+        for gene in range(1, 6):
+            for species in range(1, 5):
+                gene_map['G%s_SE00%s' % (gene, species)] = species - 1
         hits = {}
         parse_blast(self.blast_fp, hits, gene_map)
         self.assertDictEqual(hits, hits_exp)
 
+    def test_open_input(self):
+        """ Test open_input() decompresses gzip files in the background
+        """
+        proteome = ">G1_SE001\nMKVLA\n>G2_SE001\nMKVLAW\n" * 1000
+        plain_fp = join(self.working_dir, "proteome.faa")
+        with open(plain_fp, 'w') as plain_f:
+            plain_f.write(proteome)
+        gzip_fp = join(self.working_dir, "proteome.faa.gz")
+        with gzip.open(gzip_fp, 'wt') as gzip_f:
+            gzip_f.write(proteome)
+        for fp in [plain_fp, gzip_fp]:
+            with open_input(fp) as input_f:
+                self.assertEqual(input_f.read(), proteome)
+            with open_input(fp, binary=True) as input_f:
+                self.assertEqual(input_f.read(), proteome.encode())
+            with open_input(fp) as input_f:
+                seqs = list(skbio.io.read(input_f, format='fasta',
+                                          verify=False))
+            self.assertEqual(len(seqs), 2000)
+        # closing the file before the end stops the thread
+        with gzip.open(gzip_fp, 'rb') as gzip_f:
+            reader = BackgroundReader(gzip_f, chunk_size=7, max_chunks=2)
+            self.assertEqual(reader.read(5), proteome[:5].encode())
+            reader.close()
+            self.assertFalse(reader._thread.is_alive())
+        self.assertEqual(strip_compression(gzip_fp), plain_fp)
+        self.assertEqual(strip_compression(plain_fp), plain_fp)
+        self.assertListEqual(
+            list_proteomes(self.working_dir, ['faa']), [plain_fp, gzip_fp])
+
+    def test_read_fasta(self):
+        """ Test read_fasta() and preprocess_data() with a process pool
+        """
+        proteomes_dir = join(self.working_dir, "proteomes")
+        makedirs(proteomes_dir)
+        with open(join(proteomes_dir, "a.faa"), 'w') as fasta_f:
+            fasta_f.write("\n>A0 gene A0\nMKV\nLA\r\n>A1\n\nMKW\n>A2\n")
+        with gzip.open(join(proteomes_dir, "b.faa.gz"), 'wt') as fasta_f:
+            fasta_f.write(">B0\nMKVLA\n>B1\nmkvla")
+        with open(join(proteomes_dir, "c.faa"), 'w') as fasta_f:
+            fasta_f.write(">C0\nMKVLAW\n")
+        self.assertListEqual(
+            read_fasta(join(proteomes_dir, "a.faa")),
+            [('A0', b'MKVLA'), ('A1', b'MKW'), ('A2', b'')])
+        self.assertListEqual(
+            read_fasta(join(proteomes_dir, "b.faa.gz")),
+            [('B0', b'MKVLA'), ('B1', b'mkvla')])
+        # species are indexed in the order of the proteome files
+        species = [basename(fp)[0].upper()
+                   for fp in list_proteomes(proteomes_dir, ['faa'])]
+        genes = sorted(['A0', 'A1', 'A2', 'B0', 'B1', 'C0'],
+                       key=lambda gene: (species.index(gene[0]), gene))
+        gene_map_exp = [(gene, species.index(gene[0])) for gene in genes]
+        for jobs in [1, 2]:
+            gene_map, ref_db, num_species = preprocess_data(
+                self.working_dir, proteomes_dir, ['faa'], jobs=jobs)
+            self.assertListEqual(list(gene_map.items()), gene_map_exp)
+            self.assertDictEqual(ref_db, {
+                'A0': 'MKVLA', 'A1': 'MKW', 'A2': '', 'B0': 'MKVLA',
+                'B1': 'mkvla', 'C0': 'MKVLAW'})
+            self.assertEqual(num_species, 3)
+        with open(join(proteomes_dir, "d.faa"), 'w') as fasta_f:
+            fasta_f.write(">B1\nMKVLA\n")
+        with self.assertRaisesRegex(ValueError, "Duplicate sequence labels"):
+            preprocess_data(self.working_dir, proteomes_dir, ['faa'], jobs=2)
+        with open(join(proteomes_dir, "d.faa"), 'w') as fasta_f:
+            fasta_f.write("MKVLA\n")
+        with self.assertRaisesRegex(ValueError, "Not a FASTA file"):
+            read_fasta(join(proteomes_dir, "d.faa"))
+
+    def test_parse_blast_hit_filter(self):
+        """ Test parse_blast() skips alignments rejected by a HitFilter
+        """
+        gene_map = {}
+        for gene in range(1, 6):
+            for species in range(1, 5):
+                gene_map['G%s_SE00%s' % (gene, species)] = species - 1
+        hit_filter = HitFilter(min_pident=55, min_qcovs=96)
+        hits = {}
+        parse_blast(self.blast_fp, hits, gene_map, hit_filter=hit_filter)
+        self.assertDictEqual(hits, {
+            'G1_SE001': ['G1_SE001', 'G1_SE002', 'G1_SE003', 'G1_SE004'],
+            'G2_SE001': ['G2_SE001', 'G2_SE003', 'G2_SE004'],
+            'G3_SE001': ['G3_SE001', 'G3_SE002', 'G3_SE003', 'G3_SE004'],
+            'G4_SE001': ['G4_SE001'],
+            'G5_SE001': ['G5_SE001', 'G5_SE003', 'G5_SE004']})
+        self.assertEqual((hit_filter.num_hits, hit_filter.num_rejected),
+                         (25, 6))
+        self.assertDictEqual(hit_filter.rejected, {'pident': 3, 'qcovs': 3})
+        out_f = StringIO()
+        hit_filter.report(out_f)
+        self.assertEqual(out_f.getvalue(),
+                         "Hit filters: rejected 6 of 25 alignments\n"
+                         "  pident < 55: 3\n  qcovs < 96: 3\n")
+        self.assertFalse(HitFilter())
+        with self.assertRaises(ValueError):
+            HitFilter(min_qcovs=50).accept(['G1_SE001', 'G1_SE002'])
+
+    def test_deduplicate_families(self):
+        """ Test functionality of deduplicate_families()
+        """
+        hits = OrderedDict([
+            ('G1_SE001', ['G1_SE001', 'G1_SE002', 'G1_SE003']),
+            ('G2_SE001', ['G2_SE001', 'G1_SE003', 'G1_SE002']),
+            ('G3_SE001', ['G3_SE001', 'G1_SE002', 'G2_SE003']),
+            ('G4_SE001', ['G4_SE001', 'G1_SE002', 'G1_SE003'])])
+        self.assertDictEqual(deduplicate_families(hits), {
+            'G1_SE001': ['G1_SE001', 'G2_SE001', 'G4_SE001']})
+        del hits['G2_SE001']
+        del hits['G4_SE001']
+        self.assertDictEqual(deduplicate_families(hits), {})
+
+    def test_share_families(self):
+        """ Test functionality of share_families()
+        """
+        hits = OrderedDict([
+            ('G1_SE001', ['G1_SE001', 'G1_SE002', 'G1_SE003']),
+            ('G1_SE002', ['G1_SE002', 'G1_SE001', 'G1_SE003', 'G1_SE004']),
+            ('G1_SE003', ['G1_SE003', 'G1_SE001', 'G1_SE002']),
+            ('G1_SE004', ['G1_SE004', 'G1_SE002', 'G2_SE003']),
+            ('G2_SE001', ['G2_SE001', 'G1_SE004', 'G2_SE003']),
+            ('G2_SE002', ['G2_SE001', 'G2_SE003'])])
+        gene_map = dict((gene, int(gene[-1]))
+                        for family in hits.values() for gene in family)
+        # overlapping families with one gene per species share an MSA
+        self.assertDictEqual(share_families(hits, gene_map), {
+            'G1_SE001': (['G1_SE001', 'G1_SE002', 'G1_SE003', 'G1_SE004'],
+                         ['G1_SE001', 'G1_SE002', 'G1_SE003']),
+            'G1_SE004': (['G1_SE004', 'G1_SE002', 'G2_SE003', 'G2_SE001'],
+                         ['G1_SE004', 'G2_SE001'])})
+        genes = ['G1_SE001', 'G1_SE002', 'G1_SE003', 'G1_SE004']
+        distances = numpy.arange(16, dtype=float).reshape(4, 4)
+        family_genes, family_distances = select_family_distances(
+            genes, distances, ['G1_SE003', 'G1_SE001', 'G1_SE004'])
+        self.assertListEqual(family_genes,
+                             ['G1_SE001', 'G1_SE003', 'G1_SE004'])
+        npt.assert_array_equal(family_distances,
+                               distances[numpy.ix_([0, 2, 3], [0, 2, 3])])
+
+    def test_dedup_families(self):
+        """ Test align_families() aligns the shared reference homologs once
+        """
+        class PadBackend(StubBackend):
+            name = 'pad'
+
+            def align(self, sequences, timeout=None, tmp_dir=None):
+                aligned.append(len(sequences))
+                return 0, list(sequences)
+
+            def profile_command(self, profile_fp, fasta_in_fp):
+                # append the new sequences padded to the profile length
+                return [sys.executable, "-c", (
+                    "import sys\n"
+                    "profile = open(sys.argv[1]).read().split()\n"
+                    "new = open(sys.argv[2]).read().split()\n"
+                    "length = len(profile[1])\n"
+                    "new[1::2] = [(s + '-' * length)[:length] "
+                    "for s in new[1::2]]\n"
+                    "sys.stdout.write('\\n'.join(profile + new))\n"),
+                    profile_fp, fasta_in_fp]
+
+        aligned = []
+        gene_map = {'Q0': 0, 'Q1': 0, 'Q2': 0, 'R1': 1, 'R2': 2, 'R3': 3}
+        ref_db = {'Q0': 'MKVLAW', 'Q1': 'MKWLA', 'Q2': 'WWPPAA',
+                  'R1': 'MKVLAA', 'R2': 'MKVLAC', 'R3': 'MKVLCC'}
+        hits = OrderedDict([('Q0', ['Q0', 'R1', 'R2', 'R3']),
+                            ('Q1', ['Q1', 'R3', 'R2', 'R1']),
+                            ('Q2', ['Q2', 'R1', 'R2'])])
+        groups = deduplicate_families(hits)
+        self.assertDictEqual(groups, {'Q0': ['Q0', 'Q1']})
+        results = align_families(
+            [(0, 'Q0')], prepare_workspace(join(self.working_dir, "ws")),
+            gene_map, ref_db, hits, 10, msa_backend=PadBackend(),
+            msa_fallback=None, groups=groups)
+        # one MSA of the reference homologs, one row per query gene
+        self.assertListEqual(aligned, [3])
+        self.assertListEqual([query for _, query, _, _ in results],
+                             ['Q0', 'Q1'])
+        for _, query, genes, distances in results:
+            self.assertListEqual(genes, ['R1', 'R2', 'R3', query])
+            npt.assert_almost_equal(distances, protdist_distances([[
+                (gene, (ref_db[gene] + '-' * 6)[:6]) for gene in genes]])[0])
+        # the statistics are reported without verbose
+        MSA_BACKENDS['pad'] = PadBackend()
+        out_f = StringIO()
+        try:
+            with redirect_stdout(out_f):
+                done = compute_family_distances(
+                    hits, gene_map, ref_db, 4, self.working_dir,
+                    msa_software='pad', msa_fallback=None,
+                    dedup_families=True)[3]
+        finally:
+            del MSA_BACKENDS['pad']
+        self.assertListEqual(sorted(done), [0, 1, 2])
+        self.assertIn("Deduplicated gene families: 1 groups of 2 query genes "
+                      "share their reference MSAs (1 reference MSAs saved)",
+                      out_f.getvalue())
+
+    def test_reduce_redundancy(self):
+        """ Test reduce_redundancy() reuses an up to date cluster map only
+        """
+        proteomes_dir = join(self.working_dir, "proteomes")
+        makedirs(proteomes_dir)
+        for species in range(2):
+            with open(join(proteomes_dir, "s%s.faa" % species), 'w') as f:
+                f.write(">G0_S%s\nMKVLAAGIVA\n>G1_S%s\nMKVLAAGIVA\n"
+                        ">G2_S%s\nWPWPWPWPWP\n" % ((species,)*3))
+        reduced_dir, cluster_map = reduce_redundancy(
+            proteomes_dir, ['faa'], self.working_dir, identity=0.9)
+        self.assertDictEqual(cluster_map, {
+            'G0_S0': ['G0_S0', 'G1_S0'], 'G2_S0': ['G2_S0'],
+            'G0_S1': ['G0_S1', 'G1_S1'], 'G2_S1': ['G2_S1']})
+        cluster_map_fp = join(reduced_dir, "cluster_map.tsv")
+        mtime = getmtime(cluster_map_fp) - 10
+        utime(cluster_map_fp, (mtime, mtime))
+        for species in range(2):
+            proteome_fp = join(proteomes_dir, "s%s.faa" % species)
+            utime(proteome_fp, (mtime - 10, mtime - 10))
+        # reused
+        self.assertTupleEqual(
+            reduce_redundancy(proteomes_dir, ['faa'], self.working_dir,
+                              identity=0.9), (reduced_dir, cluster_map))
+        self.assertEqual(getmtime(cluster_map_fp), mtime)
+        # rebuilt for an edited proteome
+        with open(join(proteomes_dir, "s1.faa"), 'w') as f:
+            f.write(">G0_S1\nMKVLAAGIVA\n")
+        _, cluster_map = reduce_redundancy(
+            proteomes_dir, ['faa'], self.working_dir, identity=0.9)
+        self.assertListEqual(cluster_map['G0_S1'], ['G0_S1'])
+        # rebuilt for a removed proteome, whose reduced proteome is removed
+        remove(join(proteomes_dir, "s1.faa"))
+        _, cluster_map = reduce_redundancy(
+            proteomes_dir, ['faa'], self.working_dir, identity=0.9)
+        self.assertNotIn('G0_S1', cluster_map)
+        self.assertListEqual(sorted(listdir(reduced_dir)), [
+            'cd-hit', 'cluster_map.tsv', 'parameters.json', 's0.faa'])
+
+    def test_parse_cdhit_clusters(self):
+        """ Test functionality of parse_cdhit_clusters()
+        """
+        clusters_f = StringIO(
+            ">Cluster 0\n"
+            "0\t862aa, >G1_SE002... at 99.42%\n"
+            "1\t862aa, >G1_SE001... *\n"
+            ">Cluster 1\n"
+            "0\t412aa, >G2_SE001... *\n")
+        self.assertDictEqual(parse_cdhit_clusters(clusters_f), {
+            'G1_SE001': ['G1_SE001', 'G1_SE002'], 'G2_SE001': ['G2_SE001']})
+
+    def test_parse_blast_cluster_map(self):
+        """ Test parse_blast() expands hits to cluster members
+        """
+        gene_map = {'G1_SE001': 0, 'G1_SE002': 1, 'G1_SE003': 2,
+                    'G1_SE004': 3, 'G2_SE002': 1}
+        alignments_fp = join(self.working_dir, "reduced.m8")
+        with open(alignments_fp, 'w') as alignments_f:
+            alignments_f.write("G1_SE001\tG1_SE001\nG1_SE001\tG1_SE003\n")
+        hits = {}
+        parse_blast(alignments_fp, hits, gene_map, cluster_map={
+            'G1_SE001': ['G1_SE001', 'G1_SE002', 'G2_SE002'],
+            'G1_SE003': ['G1_SE003', 'G1_SE004']})
+        # a single homolog is kept per species
+        self.assertDictEqual(hits, {'G1_SE001': [
+            'G1_SE001', 'G1_SE002', 'G1_SE003', 'G1_SE004']})
+
+    def test_parse_precomputed_msas(self):
+        """ Test functionality of parse_precomputed_msas()
+        """
+        gene_map = {'G1_SE001': 0, 'G1_SE002': 1, 'G1_SE003': 2,
+                    'G2_SE001': 0, 'G2_SE002': 1}
+        msa_dir = join(self.working_dir, "msas")
+        makedirs(msa_dir)
+        with open(join(msa_dir, "MSA_1_aa.fa"), 'w') as msa_f:
+            msa_f.write(">G1_SE001/SE001\nMKV-LA\n>G1_SE002/SE002\nMK-ALA\n"
+                        ">G1_SE009/SE009\nMKVALA\n>G2_SE002/SE002\nMKVAL-\n"
+                        ">G1_SE003/SE003\nmkvala\n")
+        with open(join(msa_dir, "MSA_2_aa.phy"), 'w') as msa_f:
+            msa_f.write(" 2 4\nG2_SE001  MKV-\nG2_SE002  MK-A\n")
+        msa_map_fp = join(self.working_dir, "msa_map.txt")
+        with open(msa_map_fp, 'w') as msa_map_f:
+            msa_map_f.write("# query\tfamily\nG1_SE001\tMSA_1_aa.fa\n\n"
+                            "G2_SE001\tMSA_2_aa.phy\n")
+        hits = {}
+        alignments = {}
+        parse_precomputed_msas(msa_dir, msa_map_fp, hits, alignments,
+                               gene_map)
+        self.assertDictEqual(hits, {
+            'G1_SE001': ['G1_SE001', 'G1_SE002', 'G1_SE003'],
+            'G2_SE001': ['G2_SE001', 'G2_SE002']})
+        self.assertDictEqual(alignments, {
+            'G1_SE001': [('G1_SE001', 'MKV-LA'), ('G1_SE002', 'MK-ALA'),
+                         ('G1_SE003', 'MKVALA')],
+            'G2_SE001': [('G2_SE001', 'MKV-'), ('G2_SE002', 'MK-A')]})
+        # duplicate queries and missing MSAs
+        self.assertRaises(ValueError, parse_precomputed_msas, msa_dir,
+                          msa_map_fp, hits, alignments, gene_map)
+        with open(msa_map_fp, 'w') as msa_map_f:
+            msa_map_f.write("G1_SE001\tMSA_3_aa.fa\n")
+        self.assertRaises(ValueError, parse_precomputed_msas, msa_dir,
+                          msa_map_fp, {}, {}, gene_map)
+
     def test_normalize_distances(self):
         """ Test functionality of normalize_distances()
 
@@ -248,6 +619,210 @@ class DistanceMethodTests(TestCase):
         self.assertDictEqual(species_set_dict, species_set_dict_exp)
         self.assertDictEqual(gene_bitvector_map, gene_bitvector_map_exp)
 
+    def test_normalize_distances_missing_species(self):
+        """ Test normalize_distances() for a gene absent from a species
+
+        Phylip alignments (species 1 has no homolog):
+        2_1         0.000000  0.300000  0.500000
+        0_4         0.300000  0.000000  0.400000
+        3_0         0.500000  0.400000  0.000000
+        """
+        phylip_fp = join(self.working_dir, "distances_missing.txt")
+        with open(phylip_fp, 'w') as tmp:
+            tmp.write(phylip_output_missing_species)
+        full_distance_matrix_exp = numpy.array(
+            [[[numpy.nan, numpy.nan, -1.0, 1.0],
+              [numpy.nan, numpy.nan, numpy.nan, numpy.nan],
+              [-1.0, numpy.nan, numpy.nan, 1.0],
+              [-1.0, numpy.nan, 1.0, numpy.nan]]])
+        for sparse in [False, True]:
+            species_set_dict = {}
+            gene_bitvector_map = {}
+            if sparse:
+                full_distance_matrix = SparseDistanceMatrix(1, 4)
+            else:
+                full_distance_matrix = numpy.zeros(shape=(1, 4, 4))
+            normalize_distances(phylip_fp=phylip_fp,
+                                full_distance_matrix=full_distance_matrix,
+                                num_species=4,
+                                full_distance_matrix_offset=0,
+                                species_set_dict=species_set_dict,
+                                gene_bitvector_map=gene_bitvector_map)
+            if sparse:
+                npt.assert_array_equal(full_distance_matrix.species[0],
+                                       [0, 2, 3])
+                full_distance_matrix = full_distance_matrix.toarray()
+            npt.assert_almost_equal(full_distance_matrix,
+                                    full_distance_matrix_exp)
+            self.assertDictEqual(species_set_dict, {'IOII': 1})
+            self.assertDictEqual(gene_bitvector_map, {0: 'IOII'})
+
+    def test_parse_protdist_wrapped_rows(self):
+        """ Test parse_protdist() joins rows wrapped onto several lines
+        """
+        lines = ["    9\n"]
+        for i in range(9):
+            row = ["%.6f" % abs(i - j) for j in range(9)]
+            lines.append("%s_0        %s\n" % (i, "  ".join(row[:7])))
+            lines.append("  %s\n" % "  ".join(row[7:]))
+        labels, distances = parse_protdist(lines)
+        self.assertListEqual(labels, ["%s_0" % i for i in range(9)])
+        self.assertEqual(distances.shape, (9, 9))
+        self.assertEqual(distances[0][8], 8.0)
+        self.assertEqual(distances[8][7], 1.0)
+
+    def test_write_protdist_command(self):
+        """ Test functionality of write_protdist_command()
+        """
+        phylip_command_fp = join(self.working_dir, "phylip_command.txt")
+        phy_msa_fp = join(self.working_dir, "msa.phy")
+        phylip_fp = join(self.working_dir, "msa.dis")
+        write_protdist_command(phylip_command_fp, phy_msa_fp, phylip_fp)
+        with open(phylip_command_fp, 'r') as phylip_command_f:
+            self.assertEqual(phylip_command_f.read(),
+                             "%s\nF\n%s\nR\nY\n" % (phy_msa_fp, phylip_fp))
+        write_protdist_command(phylip_command_fp, phy_msa_fp, phylip_fp,
+                               datasets=12)
+        with open(phylip_command_fp, 'r') as phylip_command_f:
+            self.assertEqual(phylip_command_f.read(),
+                             "%s\nF\n%s\nR\nM\nD\n12\nY\n" % (
+                                 phy_msa_fp, phylip_fp))
+        # relative paths are made absolute (protdist runs in the directory
+        # of the command file, not in the current directory)
+        write_protdist_command(phylip_command_fp, "msa.phy", "msa.dis")
+        with open(phylip_command_fp, 'r') as phylip_command_f:
+            self.assertEqual(phylip_command_f.read(),
+                             "%s\nF\n%s\nR\nY\n" % (
+                                 abspath("msa.phy"), abspath("msa.dis")))
+
+    def test_split_protdist_datasets(self):
+        """ Test functionality of split_protdist_datasets()
+        """
+        outfile = ("Data set # 1:\n\n" + phylip_output + "\n" +
+                   "Data set # 2:\n\n" + phylip_output_missing_species)
+        datasets = split_protdist_datasets(outfile.splitlines(True))
+        self.assertEqual(len(datasets), 2)
+        self.assertListEqual(datasets[0], phylip_output.splitlines(True))
+        self.assertListEqual(
+            datasets[1], phylip_output_missing_species.splitlines(True))
+        labels, distances = parse_protdist(datasets[1])
+        self.assertListEqual(labels, ['2_1', '0_4', '3_0'])
+        npt.assert_almost_equal(distances, [[0.0, 0.3, 0.5],
+                                            [0.3, 0.0, 0.4],
+                                            [0.5, 0.4, 0.0]])
+        self.assertRaises(ValueError, split_protdist_datasets,
+                          ["2_1  0.000000  0.300000\n"])
+
+    def test_parse_fasta_alignment(self):
+        """ Test functionality of parse_fasta_alignment()
+        """
+        alignment = parse_fasta_alignment(
+            [">0_1 desc\n", "mkv-l\n", "aa\n", "\n", ">2_0\n", "MK-ALAA\n"])
+        self.assertListEqual(alignment, [('0_1', 'MKV-LAA'),
+                                         ('2_0', 'MK-ALAA')])
+        self.assertRaises(ValueError, parse_fasta_alignment, ["MKV\n"])
+
+    def test_parse_phylip_alignment(self):
+        """ Test parse_phylip_alignment() on interleaved Clustalw output
+        """
+        lines = [" 2 14\n",
+                 "0_1        MKV-LAAAAA WQ\n",
+                 "2_0        MK-ALAAAAA W-\n",
+                 "\n",
+                 "           LA\n",
+                 "           LL\n"]
+        self.assertListEqual(parse_phylip_alignment(lines),
+                             [('0_1', 'MKV-LAAAAAWQLA'),
+                              ('2_0', 'MK-ALAAAAAW-LL')])
+        self.assertListEqual(parse_phylip_alignment([]), [])
+
+    def test_format_phylip_alignment(self):
+        """ Test format_phylip_alignment() output is parsed back
+        """
+        alignment = [('0_1', 'MKV-LAA'), ('2_0', 'MK-ALAA')]
+        msa = format_phylip_alignment(alignment)
+        self.assertEqual(msa, "2 7\n0_1       MKV-LAA\n2_0       MK-ALAA\n")
+        self.assertListEqual(
+            parse_phylip_alignment(msa.splitlines(True)), alignment)
+        self.assertRaises(ValueError, format_phylip_alignment,
+                          [('0123456789_1', 'MKV')])
+
+    def test_relabel_family(self):
+        """ Test local labels of gene families beyond 9,999 species
+        """
+        gene_map = {'G100000_SE12000': 12000, 'G1_SE001': 0,
+                    'G2_SE004': 3}
+        sequences = [('G100000_SE12000', 'MKV-LAA'), ('G1_SE001', 'MK-ALAA'),
+                     ('G2_SE004', 'MKVALAA')]
+        alignment, genes = relabel_family(sequences)
+        self.assertListEqual(alignment, [('0', 'MKV-LAA'), ('1', 'MK-ALAA'),
+                                         ('2', 'MKVALAA')])
+        labels = [label for label, _ in parse_phylip_alignment(
+            format_phylip_alignment(alignment).splitlines(True))]
+        self.assertListEqual(restore_labels(labels[::-1], genes),
+                             ['G2_SE004', 'G1_SE001', 'G100000_SE12000'])
+        species_set_dict = {}
+        gene_bitvector_map = {}
+        full_distance_matrix = SparseDistanceMatrix(1, 12001)
+        add_normalized_distances(
+            species=[gene_map[gene] for gene in genes],
+            distances=numpy.array([[0.0, 0.3, 0.5],
+                                   [0.3, 0.0, 0.4],
+                                   [0.5, 0.4, 0.0]]),
+            full_distance_matrix=full_distance_matrix,
+            num_species=12001,
+            full_distance_matrix_offset=0,
+            species_set_dict=species_set_dict,
+            gene_bitvector_map=gene_bitvector_map)
+        npt.assert_array_equal(full_distance_matrix.species[0],
+                               [0, 3, 12000])
+        self.assertEqual(gene_bitvector_map[0].count('I'), 3)
+        self.assertEqual(gene_bitvector_map[0][12000], 'I')
+
+    def test_msa_backend(self):
+        """ Test MSABackend streams sequences on stdin and parses stdout
+        """
+        class EchoBackend(StubBackend):
+            name = 'echo'
+
+            def __init__(self, code):
+                self.code = code
+
+            def command(self):
+                return [sys.executable, "-c", self.code]
+
+        sequences = [('0_1', 'MKVLAA'), ('2_0', 'MKALAA')]
+        status, alignment = EchoBackend(
+            "import sys; sys.stdout.write(sys.stdin.read())").align(
+                sequences, timeout=30)
+        self.assertEqual(status, 0)
+        self.assertListEqual(alignment, sequences)
+        status, alignment = EchoBackend(
+            "import sys; sys.exit(1)").align(sequences, timeout=30)
+        self.assertEqual(status, 1)
+        self.assertIsNone(alignment)
+        status, alignment = EchoBackend(
+            "import time; time.sleep(30)").align(sequences, timeout=0.5)
+        self.assertEqual(status, Command.TIMEOUT)
+        self.assertIsNone(alignment)
+        self.assertListEqual(
+            MSA_BACKENDS['clustalw-quicktree'].command("in", "out", "dnd"),
+            ["clustalw", "-INFILE=in", "-OUTFILE=out", "-NEWTREE=dnd",
+             "-OUTPUT=PHYLIP", "-TYPE=PROTEIN", "-QUICKTREE"])
+        self.assertEqual(MSA_BACKENDS['mafft'].command()[-1], "-")
+        # the interface of a backend is checked when it is instantiated
+        status, alignment = StubBackend().add(
+            sequences[:1], sequences[1:], timeout=30)
+        self.assertEqual(status, 0)
+        self.assertListEqual(alignment, sequences)
+
+        class NoProfileBackend(MSABackend):
+            def command(self):
+                return ["cat"]
+
+        with self.assertRaises(TypeError):
+            NoProfileBackend()
+
     def test_cluster_distances(self):
         """ Test functionality of cluster_distances()
         """
@@ -265,6 +840,13 @@ class DistanceMethodTests(TestCase):
             self.assertTrue(core_cluster_exp in gene_clusters_list_act)
         for core_cluster_act in gene_clusters_list_act:
             self.assertTrue(core_cluster_act in gene_clusters_list_exp)
+        # the largest species set is the only core under the threshold
+        self.assertListEqual(cluster_distances(
+            species_set_dict={'IIII': 5, 'IIIO': 2, 'OOII': 1},
+            species_set_size=30, hamming_distance=1),
+            [('IIII', ['IIII', 'IIIO', 'OOII'])])
+        self.assertListEqual(cluster_distances(
+            species_set_dict={}, species_set_size=30, hamming_distance=2), [])
 
     def test_detect_outlier_genes(self):
         """ Test functionality of detect_outlier_genes()
@@ -272,27 +854,7 @@ class DistanceMethodTests(TestCase):
         species_set = ['IIII']
         gene_bitvector_map = {0: 'IIII', 1: 'IIII', 2: 'IIII',
                               3: 'IIII', 4: 'IIII'}
-        full_distance_matrix = numpy.array(
-            [[[numpy.nan, 1.20467207, 0.03920422, -1.24387629],
-              [0.70710678, numpy.nan, -1.41421356, 0.70710678],
-              [0.70710678, 1.41421356, numpy.nan, -0.70710678],
-              [1.24387629, 1.20467207, 0.03920422, numpy.nan]],
-             [[numpy.nan, 1.26889551, -1.175214, -0.09368151],
-              [1.16820922, numpy.nan, -1.27436935, 0.10616013],
-              [0.50122985, 0.89462587, numpy.nan, -1.39585572],
-              [0.55177142, 0.85179386, -1.40356529, numpy.nan]],
-             [[numpy.nan, 1.33958186, -1.06239803, -0.27718382],
-              [1.2373387, numpy.nan, -0.02558867, -1.21175004],
-              [0.284687, 1.05732936, numpy.nan, -1.34201637],
-              [0.78533243, 0.62588164, -1.41121407, numpy.nan]],
-             [[numpy.nan, 1.38826553, -0.92766886, -0.46059667],
-              [1.15415521, numpy.nan, -1.2848518, 0.13069659],
-              [0.28409367, 1.05773152, numpy.nan, -1.34182519],
-              [0.26316662, 1.0717693, -1.33493592, numpy.nan]],
-             [[numpy.nan, 1.25537801, -1.19162122, -0.06375679],
-              [1.04237928, numpy.nan, -1.3488877, 0.30650842],
-              [0.25673322, 1.07602786, numpy.nan, -1.33276108],
-              [0.38082407, 0.989092, -1.36991607, numpy.nan]]])
+        full_distance_matrix = numpy.array(outlier_distances)
         outlier_genes_exp = set([0])
         outlier_genes = detect_outlier_genes(
             species_set=species_set,
@@ -304,6 +866,685 @@ class DistanceMethodTests(TestCase):
             total_genes=5)
         self.assertSetEqual(outlier_genes, outlier_genes_exp)
 
+    def test_detect_outlier_genes_reduced_precision(self):
+        """ Test detect_outlier_genes() on float32 and float16 tensors
+        """
+        gene_bitvector_map = {0: 'IIII', 1: 'IIII', 2: 'IIII',
+                              3: 'IIII', 4: 'IIII'}
+        for dtype in ['float64', 'float32', 'float16']:
+            full_distance_matrix = numpy.array(outlier_distances, dtype=dtype)
+            full_distance_matrix_orig = full_distance_matrix.copy()
+            outlier_genes = detect_outlier_genes(
+                species_set=['IIII'],
+                gene_bitvector_map=gene_bitvector_map,
+                full_distance_matrix=full_distance_matrix,
+                stdev_offset=1.5,
+                outlier_hgt=0.5,
+                num_species=4,
+                total_genes=5)
+            self.assertSetEqual(outlier_genes, set([0]))
+            # the tensor is not rounded in place
+            npt.assert_array_equal(full_distance_matrix,
+                                   full_distance_matrix_orig)
+
+    def test_detect_outlier_genes_sparse(self):
+        """ Test detect_outlier_genes() on sparse distance storage
+        """
+        gene_bitvector_map = {0: 'IIII', 1: 'IIII', 2: 'IIII',
+                              3: 'IIII', 4: 'IIII'}
+        full_distance_matrix = SparseDistanceMatrix(5, 4)
+        for gene, distances in enumerate(outlier_distances):
+            full_distance_matrix.set_gene(gene, [0, 1, 2, 3], distances)
+        npt.assert_array_equal(full_distance_matrix.toarray(),
+                               numpy.array(outlier_distances))
+        outlier_genes = detect_outlier_genes(
+            species_set=['IIII'],
+            gene_bitvector_map=gene_bitvector_map,
+            full_distance_matrix=full_distance_matrix,
+            stdev_offset=1.5,
+            outlier_hgt=0.5,
+            num_species=4,
+            total_genes=5)
+        self.assertSetEqual(outlier_genes, set([0]))
+
+    def test_detect_hgts_results(self):
+        """ Test detect_hgts() outputs the outliers and the results file
+        """
+        gene_id = dict((gene, 'G%s_SE001' % gene) for gene in range(5))
+        output_hgt_fp = join(self.working_dir, "hgts.txt")
+        results_fp = join(self.working_dir, "results.npz")
+        for sparse in [False, True]:
+            if sparse:
+                full_distance_matrix = SparseDistanceMatrix(5, 4)
+                for gene, distances in enumerate(outlier_distances):
+                    full_distance_matrix.set_gene(gene, [0, 1, 2, 3],
+                                                  distances)
+            else:
+                full_distance_matrix = numpy.array(outlier_distances)
+            detect_hgts(full_distance_matrix=full_distance_matrix,
+                        species_set_dict={'IIII': 5},
+                        gene_bitvector_map=dict.fromkeys(range(5), 'IIII'),
+                        gene_id=gene_id,
+                        done=list(range(5)),
+                        num_species=4,
+                        output_hgt_fp=output_hgt_fp,
+                        stdev_offset=1.5,
+                        results_fp=results_fp)
+            # fewer genes than species_set_size: the largest species set
+            # is the core cluster (none was before, so no HGT was output)
+            with open(output_hgt_fp, 'r') as output_hgt_f:
+                self.assertEqual(output_hgt_f.read(),
+                                 "\n# Candidate HGT genes: \nG0_SE001\n")
+            results = read_results(results_fp)
+            self.assertListEqual(results['genes'].tolist(),
+                                 [gene_id[gene] for gene in range(5)])
+            self.assertListEqual(results['bitvectors'].tolist(),
+                                 ['IIII'] * 5)
+            self.assertListEqual(results['cluster_cores'].tolist(), ['IIII'])
+            npt.assert_array_equal(results['clusters'], [0] * 5)
+            npt.assert_array_equal(results['outliers'],
+                                   [True, False, False, False, False])
+            self.assertEqual(results['outlier_counts'].shape, (5, 4))
+            self.assertTrue((results['outlier_counts'][0] > 2).any())
+            self.assertEqual(
+                isinstance(results['distances'], SparseDistanceMatrix),
+                sparse)
+            distances = results['distances']
+            if sparse:
+                distances = distances.toarray()
+            npt.assert_array_equal(distances, numpy.array(outlier_distances))
+
+    def test_kernels(self):
+        """ Test the loop and NumPy kernels give the same results
+        """
+        rng = numpy.random.RandomState(0)
+        distances = rng.uniform(0, 2, size=(6, 6))
+        distances = (distances + distances.T) / 2
+        distances[1, 2] = distances[2, 1] = numpy.nan
+        # a single distance (zero stdev) and no distance in a row
+        distances[3, :] = distances[:, 3] = numpy.nan
+        distances[3, 4] = distances[4, 3] = 0.5
+        small = numpy.array([[0.0]])
+        species_sets = rng.randint(0, 2, size=(7, 12)).astype(numpy.uint8)
+        tensor = rng.normal(size=(40, 5, 5)).astype(numpy.float16)
+        tensor[rng.uniform(size=tensor.shape) < 0.2] = numpy.nan
+        tensor[:, 2, 4] = tensor[0, 2, 4]
+        modes = [('numpy', NUMPY_KERNELS), ('loops', LOOP_KERNELS)]
+        if find_spec('numba') is not None:
+            self.assertEqual(set_kernels('numba'), 'numba')
+            modes.append(('numba', dict(KERNELS)))
+        else:
+            self.assertRaises(ValueError, set_kernels, 'numba')
+        self.assertRaises(ValueError, set_kernels, 'cuda')
+        outputs = {}
+        try:
+            for mode, kernels in modes:
+                KERNELS.update(kernels)
+                counts = numpy.zeros((40, 5), dtype=int)
+                bounds = [KERNELS['count_species_outliers'](
+                    tensor[:, i, :].astype(numpy.float32), i, 1.0, counts)
+                    for i in range(5)]
+                outputs[mode] = (
+                    KERNELS['zscore_rows'](distances),
+                    KERNELS['zscore_rows'](small),
+                    KERNELS['hamming_matrix'](species_sets[:3],
+                                              species_sets),
+                    counts, bounds,
+                    count_outliers(tensor, 1.0, 5, 40),
+                    cluster_distances(
+                        {'IIII': 40, 'IIIO': 35, 'OIIO': 5, 'IOOI': 2,
+                         'OOOI': 1},
+                        species_set_size=30, hamming_distance=1),
+                    cluster_distances(
+                        {'IIIO': 4, 'IIII': 5, 'OOII': 1},
+                        species_set_size=30, hamming_distance=1))
+        finally:
+            set_kernels('numpy')
+        expected = outputs['numpy']
+        self.assertTrue(numpy.isnan(expected[0][3]).all())
+        self.assertEqual(expected[3].sum(), (expected[5]).sum())
+        self.assertListEqual(expected[6], [
+            ('IIII', ['IIII', 'IIIO', 'IOOI', 'OOOI']), ('IIIO', ['OIIO'])])
+        self.assertListEqual(expected[7], [
+            ('IIII', ['IIII', 'IIIO', 'OOII'])])
+        for mode, _ in modes[1:]:
+            actual = outputs[mode]
+            npt.assert_allclose(actual[0], expected[0])
+            npt.assert_array_equal(actual[1], expected[1])
+            for actual_output, expected_output in zip(actual[2:],
+                                                      expected[2:]):
+                npt.assert_equal(actual_output, expected_output)
+
+    def test_count_outliers_jobs(self):
+        """ Test count_outliers() counts blocks of species in parallel
+        """
+        rng = numpy.random.RandomState(1)
+        tensor = rng.normal(size=(30, 7, 7))
+        tensor[rng.uniform(size=tensor.shape) < 0.2] = numpy.nan
+        try:
+            for kernels in [NUMPY_KERNELS, LOOP_KERNELS]:
+                KERNELS.update(kernels)
+                expected = count_outliers(tensor, 1.5, 7, 30)
+                self.assertGreater(expected.sum(), 0)
+                for jobs in [2, 3, 7, 16]:
+                    npt.assert_array_equal(
+                        count_outliers(tensor, 1.5, 7, 30, jobs=jobs),
+                        expected)
+        finally:
+            set_kernels('numpy')
+
+    def test_kmer_profiles(self):
+        """ Test functionality of kmer_profiles()
+        """
+        profiles = kmer_profiles(["MKVLA", "mkvx", "KVLAKV", "MK"], k=3)
+        # distinct k-mers: MKV, KVL, VLA, LAK, AKV
+        self.assertEqual(profiles.shape, (4, 5))
+        npt.assert_equal(profiles.sum(axis=1), [3, 1, 4, 0])
+        self.assertEqual((profiles[0] & profiles[2]).sum(), 2)
+        self.assertTrue((profiles[1] <= profiles[0]).all())
+        # the longest k-mers whose ids do not overflow
+        profiles = kmer_profiles(["Y" * 15, "W" + "Y" * 14], k=14)
+        self.assertEqual(profiles.shape, (2, 2))
+        npt.assert_equal(profiles.sum(axis=1), [1, 2])
+        for k in [0, 15]:
+            with self.assertRaisesRegex(ValueError, "between 1 and 14"):
+                kmer_profiles(["Y" * 20], k=k)
+
+    def test_kmer_distances(self):
+        """ Test functionality of kmer_distances()
+        """
+        seq = "MKVLAAGIVALLLAAGCSSSKEETPAPKAEEPKAEEKPAEEQ"
+        mutated_1 = seq[:10] + "W" + seq[11:30] + "W" + seq[31:]
+        mutated_2 = "".join("W" if i % 4 == 0 else aa
+                            for i, aa in enumerate(seq))
+        labels, distances = kmer_distances(
+            [('0_0', seq), ('1_0', mutated_1), ('2_0', mutated_2),
+             ('3_0', seq)], k=3)
+        self.assertListEqual(labels, ['0_0', '1_0', '2_0', '3_0'])
+        npt.assert_almost_equal(distances, distances.T)
+        npt.assert_equal(numpy.diag(distances), 0.0)
+        self.assertEqual(distances[0][3], 0.0)
+        self.assertGreater(distances[0][1], 0.0)
+        self.assertGreater(distances[0][2], distances[0][1])
+        self.assertTrue(numpy.isfinite(distances).all())
+        # sequences without shared k-mers remain at a finite distance
+        labels, distances = kmer_distances([('0_0', 'MKVL'), ('1_0', 'WWWW')])
+        self.assertTrue(numpy.isfinite(distances).all())
+
+    def test_protdist_distances(self):
+        """ Test functionality of protdist_distances()
+        """
+        alignments = [[('G1_SE001', 'MKVL'), ('G1_SE002', 'MKVA'),
+                       ('G1_SE003', 'MK-A')],
+                      [('G2_SE001', 'WWPP'), ('G2_SE002', 'WWPA')]]
+        tmp_dir = join(self.working_dir, "protdist")
+        makedirs(tmp_dir)
+        distances = protdist_distances(alignments, tmp_dir=tmp_dir)
+        self.assertEqual(len(distances), 2)
+        # same distances as protdist run on each relabeled MSA
+        for alignment, family_distances in zip(alignments, distances):
+            labels, distances_exp = compute_distances_batch(
+                [format_phylip_alignment(relabel_family(alignment)[0])],
+                join(self.working_dir, "msa.phy"),
+                join(self.working_dir, "protdist_command.txt"),
+                join(self.working_dir, "msa.dis"))[0]
+            self.assertListEqual(
+                labels, [str(i) for i in range(len(alignment))])
+            npt.assert_almost_equal(family_distances, distances_exp)
+        # the temporary directory is removed
+        self.assertListEqual(listdir(tmp_dir), [])
+
+    def test_protdist_row(self):
+        """ Test functionality of pair_alignments() and protdist_row()
+        """
+        alignment = [('A0', 'MKVLAA-'), ('A1', 'MKVLACW'), ('A2', 'MK-LCCW'),
+                     ('A3', 'MKVACCW'), ('A4', 'WKVLAAW')]
+        tmp_dir = join(self.working_dir, "protdist")
+        makedirs(tmp_dir)
+        distances = protdist_distances([alignment], tmp_dir=tmp_dir)[0]
+        for index in [0, 2, 4]:
+            npt.assert_almost_equal(
+                protdist_row(alignment, index, tmp_dir=tmp_dir),
+                distances[index])
+        self.assertListEqual(listdir(tmp_dir), [])
+        npt.assert_equal(protdist_row(alignment[:1], 0), [0])
+        # protdist is given one pair of sequences per family member, so
+        # its input grows linearly with the size of the family
+        for size in [2, 10, 100]:
+            family = [('G%s' % i, 'MKVLAAW') for i in range(size)]
+            pairs = pair_alignments(family, size - 1)
+            self.assertEqual(len(pairs), size - 1)
+            self.assertEqual(sum(len(pair) for pair in pairs),
+                             2 * (size - 1))
+            for pair in pairs:
+                self.assertEqual(pair[0], family[-1])
+
+    def test_reference_families(self):
+        """ Test build_reference_families() and ReferenceFamilies
+        """
+        class ProfileBackend(StubBackend):
+            name = 'profile'
+
+            def align(self, sequences, timeout=None, tmp_dir=None):
+                return 0, list(sequences)
+
+            def profile_command(self, profile_fp, fasta_in_fp):
+                # append the new sequences padded to the profile length
+                return [sys.executable, "-c", (
+                    "import sys\n"
+                    "profile = open(sys.argv[1]).read().split()\n"
+                    "new = open(sys.argv[2]).read().split()\n"
+                    "length = len(profile[1])\n"
+                    "new[1::2] = [(s + '-' * length)[:length] "
+                    "for s in new[1::2]]\n"
+                    "sys.stdout.write('\\n'.join(profile + new))\n"),
+                    profile_fp, fasta_in_fp]
+
+        gene_map = {}
+        ref_db = {}
+        seqs = {'A': ['MKVLAA', 'MKVLAC', 'MKVLCC'],
+                'B': ['WWPPWW', 'WWPPWA', 'WWPPAA'],
+                'C': ['KKKKKK']}
+        for family, members in sorted(seqs.items()):
+            for species, seq in enumerate(members):
+                gene = "%s%s" % (family, species)
+                gene_map[gene] = species
+                ref_db[gene] = seq
+        hits = {gene: ["%s%s" % (gene[0], i)
+                       for i in range(len(seqs[gene[0]]))]
+                for gene in ref_db}
+        families_dir = join(self.working_dir, "families")
+        num_families = build_reference_families(
+            families_dir, hits, gene_map, ref_db, min_num_homologs=2,
+            msa_backend=ProfileBackend())
+        self.assertEqual(num_families, 2)
+        families = ReferenceFamilies(families_dir)
+        self.assertDictEqual(families.members, {
+            'family_0': ['A0', 'A1', 'A2'], 'family_1': ['B0', 'B1', 'B2']})
+        self.assertEqual(families.find_family(['C0', 'B1', 'A2', 'B0']),
+                         'family_1')
+        self.assertIsNone(families.find_family(['C0']))
+        # query gene member of its family
+        labels, distances = families.query_distances(
+            'A1', ['A0', 'A1'], gene_map, ref_db, ProfileBackend())
+        self.assertListEqual(labels, ['A0', 'A1', 'A2'])
+        npt.assert_almost_equal(distances, protdist_distances(
+            [[(gene, ref_db[gene]) for gene in ['A0', 'A1', 'A2']]])[0])
+        # query gene of a new species added by profile alignment
+        query_fp = join(self.working_dir, "query.faa")
+        with open(query_fp, 'w') as query_f:
+            query_f.write(">Q0\nMKVLAW\n")
+        self.assertEqual(
+            add_query_proteome(query_fp, gene_map, ref_db, 3), 4)
+        self.assertEqual(gene_map['Q0'], 3)
+        self.assertEqual(
+            add_query_proteome(query_fp, gene_map, ref_db, 4), 4)
+        labels, distances = families.query_distances(
+            'Q0', ['A0', 'A2'], gene_map, ref_db, ProfileBackend(),
+            tmp_dir=self.working_dir)
+        self.assertListEqual(labels, ['A0', 'A1', 'A2', 'Q0'])
+        npt.assert_almost_equal(distances, protdist_distances(
+            [[(gene, str(ref_db[gene]))
+              for gene in ['A0', 'A1', 'A2', 'Q0']]])[0])
+        # the family MSAs are read once
+        self.assertListEqual(list(families.alignments), ['family_0'])
+        remove(join(families_dir, "family_0.fa"))
+        labels_cached, distances_cached = families.query_distances(
+            'Q0', ['A0', 'A2'], gene_map, ref_db, ProfileBackend(),
+            tmp_dir=self.working_dir)
+        self.assertListEqual(labels_cached, labels)
+        npt.assert_almost_equal(distances_cached, distances)
+
+    def test_kmer_index(self):
+        """ Test KmerIndex and prefilter_query_proteome()
+        """
+        seq = "MKVLAAGIVALLLAAGCSSSKEETPAPKAEEPKAEEKPAEEQ"
+        ref_db = {'A0': seq, 'A1': seq[5:], 'A2': seq[:20] + "WWWW",
+                  'B0': "WPWPWPWPWPWP", 'B1': "X" * 30}
+        gene_map = {}
+        for gene in ref_db:
+            gene_map[gene] = int(gene[1])
+        index_dir = join(self.working_dir, "kmer_index")
+        self.assertFalse(KmerIndex.exists(index_dir))
+        with self.assertRaises(ValueError):
+            KmerIndex.build(index_dir, gene_map, ref_db, 3, k=15)
+        self.assertFalse(KmerIndex.exists(index_dir))
+        KmerIndex.build(index_dir, gene_map, ref_db, 3, k=4)
+        self.assertTrue(KmerIndex.exists(index_dir))
+        index = KmerIndex(index_dir)
+        self.assertIsInstance(index.genes, numpy.memmap)
+        self.assertEqual((index.k, index.num_genes, index.num_species),
+                         (4, 5, 3))
+        self.assertEqual(index.candidate_species(seq), 3)
+        self.assertEqual(index.candidate_species(seq[20:]), 2)
+        self.assertEqual(
+            index.candidate_species(seq[20:], min_shared_kmers=30), 0)
+        self.assertEqual(index.candidate_species("WPWPWPWP"), 0)
+        self.assertEqual(
+            index.candidate_species("WPWPWPWP", min_shared_kmers=2), 1)
+        self.assertEqual(index.candidate_species("CCCCCCCC"), 0)
+        query_fp = join(self.working_dir, "query.faa")
+        with open(query_fp, 'w') as query_f:
+            query_f.write(">Q0\n%s\n>Q1\n%s\n>Q2\nWPWPWPWP\n" % (
+                seq, seq[20:]))
+        output_fp = join(self.working_dir, "query_prefiltered.faa")
+        kept, dropped = prefilter_query_proteome(
+            query_fp, output_fp, index, min_num_homologs=2)
+        self.assertEqual((kept, dropped), (2, 1))
+        with open(output_fp, 'r') as output_f:
+            self.assertEqual(output_f.read(), ">Q0\n%s\n>Q1\n%s\n" % (
+                seq, seq[20:]))
+        # an index older than one of the proteomes is stale
+        self.assertFalse(index.up_to_date([query_fp]))
+        meta_mtime = getmtime(join(index_dir, "meta.npy"))
+        utime(query_fp, (meta_mtime - 10, meta_mtime - 10))
+        self.assertTrue(index.up_to_date([query_fp]))
+
+    def test_estimate_family_cost(self):
+        """ Test functionality of estimate_family_cost()
+        """
+        cost, memory = estimate_family_cost(['A'*100, 'A'*300])
+        self.assertEqual(cost, 400.0**2)
+        self.assertEqual(memory, 64*2*300 + 8*2**2)
+        self.assertEqual(estimate_family_cost([]), (0.0, 0))
+
+    def test_family_timeout(self):
+        """ Test family_timeout() scales the timeout to the family size
+        """
+        small = ['A'*100]*5
+        large = ['A'*800]*40
+        # scaled up to 10 times the timeout by default
+        self.assertEqual(family_timeout(large, 120), 1200)
+        self.assertEqual(family_timeout(small, 120), 120)
+        self.assertEqual(family_timeout(large, 120, 120), 120)
+        self.assertEqual(family_timeout(small, 120, 1000), 120)
+        self.assertEqual(family_timeout(['A'*400]*40, 120, 1000), 480)
+        self.assertEqual(family_timeout(large, 120, 1000), 1000)
+
+    def test_subsample_family(self):
+        """ Test subsample_family() keeps the query species' genes
+        """
+        gene_map = {'Q1': 0, 'Q2': 0, 'A': 1, 'B': 2, 'C': 3}
+        self.assertListEqual(
+            subsample_family(['A', 'Q1', 'B', 'C'], 'Q1', gene_map, 3),
+            ['Q1', 'A', 'B'])
+        self.assertListEqual(
+            subsample_family(['A', 'Q1', 'B', 'C', 'Q2'], 'Q1', gene_map, 3),
+            ['Q1', 'Q2', 'A'])
+
+    def test_command_timeout(self):
+        """ Test Command.run() reports the commands it terminated
+        """
+        status, _, _ = Command(
+            [sys.executable, "-c", "import time; time.sleep(30)"]).run(
+                timeout=0.5)
+        self.assertEqual(status, Command.TIMEOUT)
+        status, _, _ = Command(
+            [sys.executable, "-c", "import sys; sys.exit(2)"]).run(timeout=5)
+        self.assertEqual(status, 2)
+        # a command killed by another signal did not time out
+        status, _, _ = Command(
+            [sys.executable, "-c",
+             "import os, signal; os.kill(os.getpid(), signal.SIGTERM)"]).run(
+                 timeout=5)
+        self.assertEqual(status, -15)
+
+    def test_align_families_failures(self):
+        """ Test align_families() retries and records failed alignments
+        """
+        class SleepBackend(StubBackend):
+            name = 'sleep'
+
+            def command(self):
+                return [sys.executable, "-c", "import time; time.sleep(30)"]
+
+        class FailBackend(StubBackend):
+            name = 'fail'
+
+            def command(self):
+                return [sys.executable, "-c", "import sys; sys.exit(2)"]
+
+        gene_map = {'Q': 0, 'A': 1, 'B': 2, 'C': 3}
+        ref_db = {'Q': 'MKVLAA', 'A': 'MKVLAC', 'B': 'MKVLCC', 'C': 'MKVCCC'}
+        hits = {'Q': ['Q', 'A', 'B', 'C']}
+        failures = []
+        results = align_families(
+            [(0, 'Q')], prepare_workspace(join(self.working_dir, "ws")),
+            gene_map, ref_db, hits, timeout=5,
+            msa_backend=SleepBackend(), msa_fallback=FailBackend(),
+            msa_subsample_size=3, failures=failures)
+        self.assertListEqual(results, [(0, 'Q', None, None)])
+        self.assertListEqual(failures, [
+            ('Q', 4, 24, 5, 'sleep', 'timeout', 'retry: fail, 4 homologs'),
+            ('Q', 4, 24, 5, 'fail', 2, 'retry: fail, 3 homologs'),
+            ('Q', 3, 18, 5, 'fail', 2, 'skipped')])
+        failures_fp = join(self.working_dir, "msa_failures.tsv")
+        write_msa_failures(failures_fp, failures[-1:])
+        with open(failures_fp) as failures_f:
+            self.assertEqual(failures_f.read(), (
+                "#query\thomologs\tresidues\ttimeout\tsoftware\tstatus\t"
+                "resolution\nQ\t3\t18\t5\tfail\t2\tskipped\n"))
+
+    def test_compute_family_distances_scratch_dir(self):
+        """ Test compute_family_distances() works in a private scratch dir
+        """
+        class ScratchBackend(StubBackend):
+            name = 'scratch'
+            fail = False
+
+            def align(self, sequences, timeout=None, tmp_dir=None):
+                workspaces.append((tmp_dir, exists(
+                    join(tmp_dir, "phylip_command.txt"))))
+                if self.fail:
+                    raise OSError("alignment failed")
+                return 0, list(sequences)
+
+        workspaces = []
+        gene_map = {'A0': 0, 'A1': 1, 'A2': 2, 'B0': 0, 'B1': 1, 'B2': 2}
+        ref_db = {'A0': 'MKVLAA', 'A1': 'MKVLAC', 'A2': 'MKVLCC',
+                  'B0': 'WWPPWW', 'B1': 'WWPPWA', 'B2': 'WWPPAA'}
+        hits = OrderedDict([('A0', ['A0', 'A1', 'A2']),
+                            ('B0', ['B0', 'B1', 'B2'])])
+        scratch_dir = join(self.working_dir, "scratch")
+        makedirs(scratch_dir)
+        backend = ScratchBackend()
+        MSA_BACKENDS['scratch'] = backend
+        try:
+            for jobs in [1, 2]:
+                done = compute_family_distances(
+                    hits, gene_map, ref_db, 3, self.working_dir,
+                    msa_software='scratch', msa_fallback=None, jobs=jobs,
+                    scratch_dir=scratch_dir)[3]
+                self.assertListEqual(sorted(done), [0, 1])
+            # per-family files are written under the scratch dir only
+            self.assertEqual(len(workspaces), 4)
+            for workspace_dir, prepared in workspaces:
+                self.assertTrue(prepared)
+                self.assertTrue(workspace_dir.startswith(
+                    join(scratch_dir, "distance_method_")))
+            self.assertFalse(exists(join(self.working_dir, "msa.phy")))
+            # the private directory is removed on success and on failure
+            self.assertListEqual(listdir(scratch_dir), [])
+            backend.fail = True
+            with self.assertRaisesRegex(OSError, "alignment failed"):
+                compute_family_distances(
+                    hits, gene_map, ref_db, 3, self.working_dir,
+                    msa_software='scratch', msa_fallback=None,
+                    scratch_dir=scratch_dir)
+            self.assertGreater(len(workspaces), 4)
+            self.assertListEqual(listdir(scratch_dir), [])
+        finally:
+            del MSA_BACKENDS['scratch']
+
+    def test_estimate_run(self):
+        """ Test estimate_run() with and without a calibration table
+        """
+        estimate = estimate_run(self.species_1_fp, self.target_proteomes_dir,
+                                ['fasta'], tabular_alignments_fp=self.blast_fp,
+                                msa_software='mafft', jobs=2)
+        self.assertEqual(estimate['num_species'], 4)
+        self.assertEqual(estimate['query_genes'], 5)
+        self.assertEqual(estimate['target_sequences'], 20)
+        self.assertEqual(estimate['families'], 5)
+        self.assertTrue(estimate['families_counted'])
+        self.assertEqual(estimate['tensor_bytes'], 5*4*4*8)
+        self.assertEqual(estimate['search_seconds'], 0)
+        self.assertAlmostEqual(
+            estimate['msa_seconds'],
+            DEFAULT_MSA_RATES['mafft']*estimate['family_cost']/2)
+        calibration_fp = join(self.working_dir, "calibration.tsv")
+        for seconds in [10, 30, 20]:
+            record = dict(estimate)
+            record.update(align_software='blast', msa_software='mafft',
+                          search_seconds=seconds,
+                          msa_seconds=seconds/2.0,
+                          peak_memory=2*estimate['peak_memory'])
+            write_calibration(calibration_fp, record)
+        calibration = read_calibration(calibration_fp)
+        self.assertAlmostEqual(calibration['search_rates']['blast'], 20.0/(
+            estimate['query_residues']*estimate['target_residues']))
+        self.assertEqual(calibration['search_rates']['diamond'],
+                         DEFAULT_SEARCH_RATES['diamond'])
+        self.assertAlmostEqual(calibration['msa_rates']['mafft'],
+                               20.0/estimate['family_cost'])
+        self.assertAlmostEqual(calibration['family_fraction'], 1.0)
+        self.assertAlmostEqual(calibration['memory_scale'], 2.0)
+        # malformed rows, such as a truncated last row, are skipped
+        with open(calibration_fp, 'r') as calibration_f:
+            lines = calibration_f.readlines()
+        partial_fp = join(self.working_dir, "partial_calibration.tsv")
+        with open(partial_fp, 'w') as partial_f:
+            partial_f.writelines(lines)
+            fields = lines[1].replace('blast', 'diamond').split('\t')
+            fields[CALIBRATION_FIELDS.index('jobs')] = 'x'
+            partial_f.write('\t'.join(fields))
+            partial_f.write(lines[1][:len(lines[1]) // 2])
+        out_f = StringIO()
+        with redirect_stdout(out_f):
+            self.assertDictEqual(read_calibration(partial_fp), calibration)
+        self.assertEqual(out_f.getvalue().count("Skipping malformed row"), 2)
+        # a table lacking columns is rejected
+        with open(partial_fp, 'w') as partial_f:
+            partial_f.write(lines[0].replace('\tpeak_memory', ''))
+            partial_f.writelines(lines[1:])
+        with self.assertRaisesRegex(ValueError, "lacks the columns: "
+                                                "peak_memory"):
+            read_calibration(partial_fp)
+        # gene families predicted from the calibrated fraction
+        estimate = estimate_run(self.species_1_fp, self.target_proteomes_dir,
+                                ['fasta'], align_software='blast',
+                                calibration_fp=calibration_fp)
+        self.assertEqual(estimate['families'], 5)
+        self.assertFalse(estimate['families_counted'])
+        self.assertAlmostEqual(estimate['search_seconds'], 20.0)
+        self.assertEqual(suggest_jobs(estimate, cpus=16), 16)
+        node_memory = (estimate['peak_memory'] +
+                       2.5*estimate['memory_scale'] *
+                       estimate['max_family_memory']) / (1024*1024)
+        self.assertEqual(suggest_jobs(estimate, cpus=16,
+                                      node_memory=node_memory), 3)
+
+    def test_schedule_families(self):
+        """ Test schedule_families() orders gene families longest-first
+        """
+        ref_db = {'a': 'A'*10, 'b': 'A'*500, 'c': 'A'*20, 'd': 'A'*200}
+        hits = {'q1': ['a', 'c'], 'q2': ['b', 'd'], 'q3': ['a'],
+                'q4': ['d', 'c']}
+        batches = schedule_families(hits, ref_db)
+        self.assertListEqual(
+            [families for families, _ in batches],
+            [[(1, 'q2')], [(3, 'q4')], [(0, 'q1')], [(2, 'q3')]])
+        self.assertListEqual(
+            [memory for _, memory in batches],
+            [estimate_family_cost(['A'*500, 'A'*200])[1],
+             estimate_family_cost(['A'*200, 'A'*20])[1],
+             estimate_family_cost(['A'*10, 'A'*20])[1],
+             estimate_family_cost(['A'*10])[1]])
+        batches = schedule_families(hits, ref_db, batch_size=3)
+        self.assertListEqual(
+            [families for families, _ in batches],
+            [[(1, 'q2'), (3, 'q4'), (0, 'q1')], [(2, 'q3')]])
+        self.assertEqual(batches[0][1],
+                         estimate_family_cost(['A'*500, 'A'*200])[1])
+
+    def test_memory_budget(self):
+        """ Test MemoryBudget caps the memory of concurrent work
+        """
+        budget = MemoryBudget(100)
+        budget.acquire(60)
+        started = []
+        worker = Thread(target=lambda: (budget.acquire(60),
+                                        started.append(True)))
+        worker.start()
+        worker.join(0.2)
+        # the second 60 would exceed the budget until the first is released
+        self.assertListEqual(started, [])
+        budget.release(60)
+        worker.join(5)
+        self.assertListEqual(started, [True])
+        budget.release(60)
+        # work larger than the whole budget runs alone
+        budget.acquire(500)
+        self.assertEqual(budget.used, 500)
+        budget.release(500)
+        # no budget never blocks
+        budget = MemoryBudget()
+        budget.acquire(10**12)
+        budget.acquire(10**12)
+        self.assertEqual(budget.used, 2*10**12)
+
+    def test_compact_genes(self):
+        """ Test compact_genes() removes genes without distances
+        """
+        gene_bitvector_map = {0: 'IIII', 2: 'IOII', 4: 'IIOI'}
+        gene_id = {0: 'q0', 1: 'q1', 2: 'q2', 3: 'q3', 4: 'q4'}
+        distances = numpy.array(outlier_distances)
+        sparse = SparseDistanceMatrix(5, 4)
+        for gene in range(5):
+            sparse.set_gene(gene, [0, 1, 2, 3], distances[gene])
+        for full_distance_matrix in [distances.copy(), sparse]:
+            full_distance_matrix, bitvectors, ids = compact_genes(
+                full_distance_matrix, gene_bitvector_map, gene_id,
+                [0, 2, 4])
+            self.assertEqual(len(full_distance_matrix), 3)
+            if isinstance(full_distance_matrix, SparseDistanceMatrix):
+                full_distance_matrix = full_distance_matrix.toarray()
+            npt.assert_array_equal(full_distance_matrix, distances[[0, 2, 4]])
+            self.assertDictEqual(bitvectors, {0: 'IIII', 1: 'IOII',
+                                              2: 'IIOI'})
+            self.assertDictEqual(ids, {0: 'q0', 1: 'q2', 2: 'q4'})
+
+    def test_memory_report(self):
+        """ Test functionality of MemoryReport
+        """
+        memory = MemoryReport(enabled=True, top=5)
+        matrix = numpy.zeros(shape=(100, 50, 50), dtype=float)
+        memory.checkpoint("allocate")
+        del matrix
+        memory.checkpoint("free")
+        out_f = StringIO()
+        memory.report(out_f)
+        self.assertEqual([stage[0] for stage in memory.stages],
+                         ["allocate", "free"])
+        # the 2 MB tensor dominates the first stage and is freed in the second
+        self.assertGreaterEqual(memory.stages[0][1], 100*50*50*8)
+        self.assertLess(memory.stages[1][1], -100*50*50*4)
+        self.assertGreaterEqual(memory.peak, 100*50*50*8)
+        report = out_f.getvalue()
+        self.assertIn("Peak traced memory", report)
+        self.assertIn("Top allocation sites for stage 'allocate'", report)
+        self.assertIn("test_distance_method.py", report)
+
+    def test_memory_report_disabled(self):
+        """ Test MemoryReport is a no-op when disabled
+        """
+        memory = MemoryReport(enabled=False)
+        memory.checkpoint("stage")
+        out_f = StringIO()
+        memory.report(out_f)
+        self.assertListEqual(memory.stages, [])
+        self.assertEqual(out_f.getvalue(), "")
+
     def test_launch_blast(self):
         """Test functionality of launch_blast()
         """
@@ -388,6 +1629,30 @@ class DistanceMethodTests(TestCase):
                                         'bitscore', 'qcovs'])
         self.assert_frames_equal(df_exp, df_act)
 
+    def test_write_query_coverage(self):
+        """ Test write_query_coverage() merges the HSPs of each subject
+        """
+        alignments = [
+            # two overlapping HSPs cover 1-60 of a query of 100 residues
+            "Q1\tS1\t90.0\t50\t5\t0\t1\t50\t1\t50\t1e-20\t80.0\t100\n",
+            "Q1\tS1\t90.0\t21\t2\t0\t40\t60\t70\t90\t1e-05\t30.0\t100\n",
+            "Q1\tS2\t50.0\t33\t9\t1\t68\t100\t1\t33\t1e-10\t40.0\t100\n",
+            "\n",
+            "Q2\tS1\t70.0\t3\t1\t0\t3\t1\t1\t3\t1e-01\t10.0\t9\n"]
+        out_f = StringIO()
+        write_query_coverage(alignments, out_f)
+        lines = out_f.getvalue().splitlines()
+        self.assertListEqual([line.split('\t')[12] for line in lines],
+                             ['60', '60', '33', '33'])
+        self.assertListEqual([line.split('\t')[:12] for line in lines],
+                             [line.split('\t')[:12] for line in
+                              alignments if line.strip()])
+        # filtered as BLAST's qcovs
+        hit_filter = HitFilter(min_qcovs=50)
+        self.assertListEqual([hit_filter.accept(line.split('\t'))
+                              for line in lines],
+                             [True, True, False, False])
+
     def test_launch_diamond(self):
         """Test functionality of launch_diamond()
         """
@@ -506,6 +1771,330 @@ class DistanceMethodTests(TestCase):
                     hgt_act.append(line.strip().split()[0])
         self.assertListEqual(hgt_exp, hgt_act)
 
+    def test_distance_method_service(self):
+        """ Test DistanceMethodService jobs submitted over HTTP
+        """
+        service = DistanceMethodService(
+            self.target_proteomes_dir, join(self.working_dir, "service"),
+            'diamond', build_databases=False,
+            input_dir=self.target_proteomes_dir)
+        num_genes = len(service.panel.gene_map)
+        server = ServiceHTTPServer(('127.0.0.1', 0), service)
+        Thread(target=server.serve_forever).start()
+        url = "http://127.0.0.1:%s/jobs" % server.server_address[1]
+
+        def post(request):
+            return json.loads(urlopen(Request(
+                url, data=json.dumps(request).encode(),
+                headers={'Content-Type': 'application/json'})).read())
+
+        def wait(job_id):
+            for _ in range(600):
+                status = json.loads(urlopen("%s/%s" % (url, job_id)).read())
+                if status['status'] not in ['queued', 'running']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(status['status'], 'done', status.get('error'))
+            return status
+        try:
+            # query proteome in the input directory, uploaded alignments
+            job_id = post({'query_proteome_fp': "species_1.fasta",
+                           'tabular_alignments': blast_alignments})['job_id']
+            status = wait(job_id)
+            self.assertListEqual(status['hgts'], [])
+            self.assertSetEqual(set(status['timing']), set(['queued', 'run']))
+            self.assertEqual(len(service.panel.gene_map), num_genes)
+            # uploaded alignments of a genome outside the panel
+            alignments = ''.join(
+                "G%s_SE005\tG%s_SE00%s\n" % (gene, gene, species)
+                for gene in range(1, 6) for species in range(1, 5))
+            new_job_id = post({
+                'query_proteome': species_1.replace("_SE001", "_SE005"),
+                'tabular_alignments': alignments,
+                'options': {'min_num_homologs': 3}})['job_id']
+            status = wait(new_job_id)
+            self.assertListEqual(status['hgts'], [])
+            self.assertEqual(len(service.panel.gene_map), num_genes)
+            # finished jobs are deleted or expire with their directory
+            job_dir = join(self.working_dir, "service", "jobs", job_id)
+            self.assertTrue(isdir(job_dir))
+            self.assertEqual(json.loads(urlopen(Request(
+                "%s/%s" % (url, job_id), method='DELETE')).read()),
+                {'job_id': job_id, 'status': 'deleted'})
+            self.assertFalse(isdir(job_dir))
+            for method in ['GET', 'DELETE']:
+                with self.assertRaises(HTTPError) as context:
+                    urlopen(Request("%s/%s" % (url, job_id), method=method))
+                self.assertEqual(context.exception.code, 404)
+            service.expire()
+            self.assertIn(new_job_id, service.jobs)
+            service.job_ttl = 0
+            time.sleep(0.01)
+            service.expire()
+            self.assertDictEqual(service.jobs, {})
+            self.assertListEqual(
+                listdir(join(self.working_dir, "service", "jobs")), [])
+            # filepaths outside the input directory are rejected
+            for request in [
+                    {'query_proteome': species_1, 'options': {'ext': []}},
+                    {'query_proteome_fp': "../blast.txt"},
+                    {'query_proteome_fp': "/etc/passwd"},
+                    {'query_proteome': species_1,
+                     'options': {'tabular_alignments_fp': self.blast_fp}},
+                    {'query_proteome': species_1,
+                     'tabular_alignments': alignments,
+                     'options': {'tabular_alignments_fp': self.blast_fp}}]:
+                with self.assertRaises(HTTPError) as context:
+                    post(request)
+                self.assertEqual(context.exception.code, 400)
+            with self.assertRaises(ValueError):
+                DistanceMethodService(
+                    self.target_proteomes_dir,
+                    join(self.working_dir, "service"), 'diamond',
+                    build_databases=False).submit(
+                        query_proteome_fp=self.species_1_fp)
+            with self.assertRaises(HTTPError) as context:
+                urlopen("%s/unknown" % url)
+            self.assertEqual(context.exception.code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.shutdown()
+
+    def test_distance_method_new_query(self):
+        """ Test distance_method() adds a query proteome outside the panel
+        """
+        query_fp = join(self.working_dir, "species_5.fasta")
+        with open(query_fp, 'w') as query_f:
+            query_f.write(species_1.replace("_SE001", "_SE005"))
+        alignments_fp = join(self.working_dir, "query_alignments.txt")
+        with open(alignments_fp, 'w') as alignments_f:
+            for gene in range(1, 6):
+                for species in range(1, 5):
+                    alignments_f.write("G%s_SE005\tG%s_SE00%s\n" % (
+                        gene, gene, species))
+        results_fp = join(self.working_dir, "results.npz")
+        distance_method(query_fp, self.target_proteomes_dir,
+                        self.working_dir,
+                        join(self.working_dir, "hgt_result.txt"), 'diamond',
+                        tabular_alignments_fp=alignments_fp,
+                        distance_mode='kmer', results_fp=results_fp)
+        results = read_results(results_fp)
+        self.assertListEqual(results['genes'].tolist(),
+                             ['G%s_SE005' % gene for gene in range(1, 6)])
+        self.assertListEqual(results['bitvectors'].tolist(), ['IIIII'] * 5)
+        self.assertEqual(results['distances'].shape, (5, 5, 5))
+
+    def test_shards(self):
+        """ Test the plan, shard and reduce steps of distance_method()
+        """
+        self.assertListEqual([shard_range(5, i, 3) for i in range(3)],
+                             [(0, 1), (1, 3), (3, 5)])
+        with self.assertRaises(ValueError):
+            shard_range(5, 3, 3)
+        output_hgt_fp = join(self.working_dir, "hgt_result.txt")
+        distance_method(self.species_1_fp, self.target_proteomes_dir,
+                        self.working_dir, output_hgt_fp, 'diamond',
+                        tabular_alignments_fp=self.blast_fp,
+                        distance_mode='kmer')
+        manifest_fp = join(self.working_dir, "manifest.json")
+        distance_method(self.species_1_fp, self.target_proteomes_dir,
+                        self.working_dir, None, 'diamond',
+                        tabular_alignments_fp=self.blast_fp,
+                        distance_mode='kmer', manifest_fp=manifest_fp)
+        manifest = read_manifest(manifest_fp)
+        self.assertListEqual(list(manifest['hits']), [
+            'G1_SE001', 'G2_SE001', 'G3_SE001', 'G4_SE001', 'G5_SE001'])
+        self.assertSetEqual(set(manifest['gene_map']),
+                            set(manifest['ref_db']))
+        # only the genes of the work units are written
+        small_manifest_fp = join(self.working_dir, "small_manifest.json")
+        write_manifest(small_manifest_fp, OrderedDict([('A0', ['A0', 'A1'])]),
+                       {'A0': 0, 'A1': 1, 'B0': 0, 'B1': 1},
+                       {'A0': 'MKV', 'A1': 'MKW', 'B0': 'WPW', 'B1': 'WPP'},
+                       2, {})
+        small_manifest = read_manifest(small_manifest_fp)
+        self.assertDictEqual(small_manifest['gene_map'], {'A0': 0, 'A1': 1})
+        self.assertDictEqual(small_manifest['ref_db'],
+                             {'A0': 'MKV', 'A1': 'MKW'})
+        partial_fps = []
+        for shard, (start, end) in enumerate([(0, 2), (2, None)]):
+            partial_fps.append(join(self.working_dir, "part_%s.npz" % shard))
+            run_shard(manifest_fp, join(self.working_dir, "shard_%s" % shard),
+                      partial_fps[-1], start=start, end=end)
+        with numpy.load(partial_fps[1]) as partial:
+            npt.assert_equal(partial['offsets'], [2, 3, 4])
+            self.assertEqual(partial['distances'].shape, (3, 4, 4))
+            self.assertListEqual(list(partial['bitvectors']), ['IIII'] * 3)
+        reduced_hgt_fp = join(self.working_dir, "hgt_reduced.txt")
+        reduce_shards(manifest_fp, partial_fps, reduced_hgt_fp)
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            with open(reduced_hgt_fp, 'r') as reduced_hgt_f:
+                self.assertEqual(reduced_hgt_f.read(), output_hgt_f.read())
+        with self.assertRaises(ValueError):
+            reduce_shards(manifest_fp, partial_fps * 2, reduced_hgt_fp)
+        # sparse distances are kept sparse in the partial outputs
+        sparse_manifest_fp = join(self.working_dir, "sparse_manifest.json")
+        distance_method(self.species_1_fp, self.target_proteomes_dir,
+                        self.working_dir, None, 'diamond',
+                        tabular_alignments_fp=self.blast_fp,
+                        distance_mode='kmer', sparse_distances=True,
+                        manifest_fp=sparse_manifest_fp)
+        sparse_partial_fps = []
+        for shard, (start, end) in enumerate([(0, 2), (2, None)]):
+            sparse_partial_fps.append(
+                join(self.working_dir, "sparse_part_%s.npz" % shard))
+            run_shard(sparse_manifest_fp,
+                      join(self.working_dir, "sparse_shard_%s" % shard),
+                      sparse_partial_fps[-1], start=start, end=end)
+        with numpy.load(sparse_partial_fps[1]) as partial:
+            self.assertNotIn('distances', partial)
+            npt.assert_equal(partial['offsets'], [2, 3, 4])
+            npt.assert_equal(partial['species_offsets'], [0, 4, 8, 12])
+            self.assertEqual(partial['packed_distances'].shape, (48,))
+        with numpy.load(partial_fps[1]) as dense_partial:
+            with numpy.load(sparse_partial_fps[1]) as partial:
+                for distances, (species, sparse) in zip(
+                        dense_partial['distances'], unpack_distances(
+                            partial['species'], partial['species_offsets'],
+                            partial['packed_distances'])):
+                    npt.assert_equal(sparse,
+                                     distances[numpy.ix_(species, species)])
+        reduce_shards(sparse_manifest_fp, sparse_partial_fps, reduced_hgt_fp)
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            with open(reduced_hgt_fp, 'r') as reduced_hgt_f:
+                self.assertEqual(reduced_hgt_f.read(), output_hgt_f.read())
+
+    def test_screen_all_vs_all(self):
+        """ Test screen_all_vs_all() matches a run per genome
+        """
+        alignments_fp = join(self.working_dir, "all_vs_all.txt")
+        with open(alignments_fp, 'w') as alignments_f:
+            for query in range(1, 5):
+                for gene in range(1, 6):
+                    for ref in [query] + [species for species in range(1, 5)
+                                          if species != query]:
+                        alignments_f.write("G%s_SE00%s\tG%s_SE00%s\n" % (
+                            gene, query, gene, ref))
+        output_dir = join(self.working_dir, "hgts")
+        screen_all_vs_all(self.target_proteomes_dir,
+                          join(self.working_dir, "all_vs_all"), output_dir,
+                          'diamond', tabular_alignments_fp=alignments_fp,
+                          distance_mode='kmer', jobs=2, save_results=True)
+        output_hgt_fp = join(self.working_dir, "hgt_result.txt")
+        distance_method(self.species_1_fp, self.target_proteomes_dir,
+                        self.working_dir, output_hgt_fp, 'diamond',
+                        tabular_alignments_fp=self.blast_fp,
+                        distance_mode='kmer')
+        for species in range(1, 5):
+            self.assertTrue(exists(join(
+                output_dir, "species_%s.hgt.txt" % species)))
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            with open(join(output_dir, "species_1.hgt.txt")) as screen_f:
+                self.assertEqual(screen_f.read(), output_hgt_f.read())
+        # a genome's own paralogs are not in its reference families, even
+        # when they are its best hits in its own genome
+        paralogs_fp = join(self.working_dir, "all_vs_all_paralogs.txt")
+        with open(alignments_fp, 'r') as alignments_f:
+            with open(paralogs_fp, 'w') as paralogs_f:
+                for line in alignments_f:
+                    query, ref = line.split()
+                    if query == ref:
+                        paralogs_f.write("%s\tG%s_%s\n" % (
+                            query, int(query[1]) % 5 + 1,
+                            query.split('_')[1]))
+                    paralogs_f.write(line)
+        paralogs_dir = join(self.working_dir, "hgts_paralogs")
+        screen_all_vs_all(self.target_proteomes_dir,
+                          join(self.working_dir, "all_vs_all_paralogs"),
+                          paralogs_dir, 'diamond',
+                          tabular_alignments_fp=paralogs_fp,
+                          distance_mode='kmer', jobs=2, save_results=True)
+        for species in range(1, 5):
+            results = read_results(join(
+                output_dir, "species_%s.results.npz" % species))
+            paralogs_results = read_results(join(
+                paralogs_dir, "species_%s.results.npz" % species))
+            npt.assert_equal(paralogs_results['genes'], results['genes'])
+            npt.assert_equal(paralogs_results['distances'],
+                             results['distances'])
+
+        # the shared gene families are aligned once and their protdist
+        # distances split per query gene
+        class PadBackend(StubBackend):
+            name = 'pad'
+
+            def align(self, sequences, timeout=None, tmp_dir=None):
+                families.append(tuple(sorted(seq for _, seq in sequences)))
+                length = max(len(seq) for _, seq in sequences)
+                return 0, [(label, seq.ljust(length, '-'))
+                           for label, seq in sequences]
+
+        families = []
+        MSA_BACKENDS['pad'] = PadBackend()
+        try:
+            output_dir = join(self.working_dir, "hgts_protdist")
+            screen_all_vs_all(self.target_proteomes_dir,
+                              join(self.working_dir, "all_vs_all_protdist"),
+                              output_dir, 'diamond',
+                              tabular_alignments_fp=alignments_fp,
+                              msa_software='pad', msa_fallback=None, jobs=2)
+            # one alignment per gene family instead of one per genome
+            self.assertEqual(len(families), 5)
+            self.assertEqual(len(set(families)), 5)
+            distance_method(self.species_1_fp, self.target_proteomes_dir,
+                            join(self.working_dir, "protdist"),
+                            output_hgt_fp, 'diamond',
+                            tabular_alignments_fp=self.blast_fp,
+                            msa_software='pad', msa_fallback=None)
+        finally:
+            del MSA_BACKENDS['pad']
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            with open(join(output_dir, "species_1.hgt.txt")) as screen_f:
+                self.assertEqual(screen_f.read(), output_hgt_f.read())
+
+    def test_distance_method_kmer(self):
+        """ Test distance_method() with alignment-free k-mer distances
+        """
+        output_hgt_fp = join(self.working_dir, "hgt_result.txt")
+        distance_method(self.species_1_fp,
+                        self.target_proteomes_dir,
+                        self.working_dir,
+                        output_hgt_fp,
+                        'diamond',
+                        tabular_alignments_fp=self.blast_fp,
+                        distance_mode='kmer')
+        hgt_act = []
+        with open(output_hgt_fp, 'r') as output_hgt_f:
+            for line in output_hgt_f:
+                if line.startswith('#'):
+                    continue
+                if line not in ['\n', '\r\n']:
+                    hgt_act.append(line.strip().split()[0])
+        self.assertListEqual([], hgt_act)
+
+
+outlier_distances = [
+    [[numpy.nan, 1.20467207, 0.03920422, -1.24387629],
+     [0.70710678, numpy.nan, -1.41421356, 0.70710678],
+     [0.70710678, 1.41421356, numpy.nan, -0.70710678],
+     [1.24387629, 1.20467207, 0.03920422, numpy.nan]],
+    [[numpy.nan, 1.26889551, -1.175214, -0.09368151],
+     [1.16820922, numpy.nan, -1.27436935, 0.10616013],
+     [0.50122985, 0.89462587, numpy.nan, -1.39585572],
+     [0.55177142, 0.85179386, -1.40356529, numpy.nan]],
+    [[numpy.nan, 1.33958186, -1.06239803, -0.27718382],
+     [1.2373387, numpy.nan, -0.02558867, -1.21175004],
+     [0.284687, 1.05732936, numpy.nan, -1.34201637],
+     [0.78533243, 0.62588164, -1.41121407, numpy.nan]],
+    [[numpy.nan, 1.38826553, -0.92766886, -0.46059667],
+     [1.15415521, numpy.nan, -1.2848518, 0.13069659],
+     [0.28409367, 1.05773152, numpy.nan, -1.34182519],
+     [0.26316662, 1.0717693, -1.33493592, numpy.nan]],
+    [[numpy.nan, 1.25537801, -1.19162122, -0.06375679],
+     [1.04237928, numpy.nan, -1.3488877, 0.30650842],
+     [0.25673322, 1.07602786, numpy.nan, -1.33276108],
+     [0.38082407, 0.989092, -1.36991607, numpy.nan]]]
 
 phylip_output = """    4
 2_1         0.000000  0.379562  0.473355  0.521700
@@ -514,6 +2103,12 @@ phylip_output = """    4
 1_1         0.521700  0.660393  0.722046  0.000000
 """
 
+phylip_output_missing_species = """    3
+2_1         0.000000  0.300000  0.500000
+0_4         0.300000  0.000000  0.400000
+3_0         0.500000  0.400000  0.000000
+"""
+
 blast_alignments = """G1_SE001    G1_SE001    100.00  862 0   0   1   862 1  \
  862 0.0  1803   100
 G2_SE001   G2_SE001    100.00  494 0   0   1   494 1   494 0.0  1023   100
@@ -46,7 +46,9 @@ setup(name='wgshgt',
       scripts=glob('benchmark/*py') + glob('distance-method/*py') +
       glob('benchmark/tests/*py'),
       extras_require={'test': ["nose", "pep8", "flake8"],
-                      'doc': ["Sphinx == 1.3.3"]},
+                      'doc': ["Sphinx == 1.3.3"],
+                      'zstd': ["zstandard"],
+                      'numba': ["numba"]},
       install_requires=['click >= 6',
                         'scikit-bio >= 0.4.0'],
       classifiers=classifiers